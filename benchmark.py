@@ -0,0 +1,188 @@
+from __future__ import print_function
+import argparse
+import json
+import resource
+import sys
+from multiprocessing import Process, Queue
+from time import strftime, time
+import numpy as np
+from utils import color_codes
+
+
+# Configured defaults of every architecture we train. They mirror the argparse defaults of the script that
+# builds them, so the numbers we get here are the ones we pay on the real runs:
+# (builder name, number of channels, patch width, conv blocks, filters, dense size)
+architectures = {
+    'iseg-baseline': ('get_iseg_baseline', 2, 17, 5, 32, 256),
+    'iseg-experimental1': ('get_iseg_experimental1', 2, 17, 5, 32, 256),
+    'iseg-experimental2': ('get_iseg_experimental2', 2, 17, 5, 32, 256),
+    'iseg-experimental3': ('get_iseg_experimental3', 2, 17, 5, 32, 256),
+    'iseg-experimental4': ('get_iseg_experimental4', 2, 17, 5, 32, 256),
+    'brats-sequential': ('get_brats_sequential', 4, 13, 5, 32, 256),
+    'brats-multioutput': ('get_brats_multioutput', 4, 13, 5, 32, 256),
+    'brats-recurrent': ('get_brats_multioutput', 4, 13, 5, 32, 256),
+    'brats-fc': ('get_brats_fc', 4, 17, 4, 32, 256),
+}
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    parser = argparse.ArgumentParser(description='Benchmark the throughput of the different nets.')
+    parser.add_argument('-a', '--architectures', dest='architectures', nargs='+', default=sorted(architectures))
+    parser.add_argument('-i', '--patch-width', dest='patch_width', type=int, default=None)
+    parser.add_argument('-k', '--kernel-size', dest='conv_width', type=int, default=3)
+    parser.add_argument('-c', '--conv-blocks', dest='conv_blocks', type=int, default=None)
+    parser.add_argument('-n', '--num-filters', dest='n_filters', type=int, default=None)
+    parser.add_argument('-d', '--dense-size', dest='dense_size', type=int, default=None)
+    parser.add_argument('-b', '--batch-sizes', dest='batch_sizes', nargs='+', type=int, default=[256, 1024, 2048])
+    parser.add_argument('-B', '--train-batch-size', dest='train_batch_size', type=int, default=1024)
+    parser.add_argument('-s', '--steps', dest='steps', type=int, default=5)
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    return vars(parser.parse_args())
+
+
+def get_configuration(name, options):
+    # The command line parameters (if given) override the configured defaults of every architecture.
+    func_name, n_channels, patch_width, conv_blocks, n_filters, dense_size = architectures[name]
+    patch_width = options['patch_width'] if options.get('patch_width') else patch_width
+    conv_blocks = options['conv_blocks'] if options.get('conv_blocks') else conv_blocks
+    n_filters = options['n_filters'] if options.get('n_filters') else n_filters
+    dense_size = options['dense_size'] if options.get('dense_size') else dense_size
+    return {
+        'name': name,
+        'func': func_name,
+        'input_shape': (n_channels,) + (patch_width,) * 3,
+        'filters_list': [n_filters] * conv_blocks,
+        'kernel_size_list': [options.get('conv_width', 3)] * conv_blocks,
+        'dense_size': dense_size,
+        'recurrent': name == 'brats-recurrent',
+    }
+
+
+def build_network(config):
+    # Keras is imported here on purpose. Every architecture is measured on a fresh process, so we can't afford
+    # to import the backend on the parent process.
+    import nets
+    builder = getattr(nets, config['func'])
+    args = (config['input_shape'], config['filters_list'], config['kernel_size_list'], config['dense_size'])
+    return builder(*args, recurrent=True) if config['recurrent'] else builder(*args)
+
+
+def random_targets(net, n_samples):
+    # Random one-hot targets for every output of the net (including the fully convolutional ones).
+    shapes = net.output_shape if isinstance(net.output_shape, list) else [net.output_shape]
+    targets = list()
+    for shape in shapes:
+        labels = np.random.randint(shape[-1], size=(n_samples,) + tuple(shape[1:-1]))
+        targets.append(np.eye(shape[-1], dtype=np.float32)[labels])
+    return targets
+
+
+def peak_memory():
+    # ru_maxrss is given in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure_network(config, batch_sizes, train_batch_size, steps):
+    results = {'name': config['name'], 'input_shape': list(config['input_shape'])}
+
+    init = time()
+    net = build_network(config)
+    results['build_time'] = time() - init
+    results['parameters'] = net.count_params()
+
+    # Keras compiles the train and predict functions lazily, so we force it to measure that time too.
+    init = time()
+    net._make_train_function()
+    net._make_predict_function()
+    results['compile_time'] = time() - init
+
+    x = np.random.normal(size=(train_batch_size,) + config['input_shape']).astype(np.float32)
+    y = random_targets(net, train_batch_size)
+    net.train_on_batch(x, y)
+    init = time()
+    for _ in range(steps):
+        net.train_on_batch(x, y)
+    results['train_samples_s'] = steps * train_batch_size / (time() - init)
+
+    results['test_samples_s'] = dict()
+    for batch_size in batch_sizes:
+        x = np.random.normal(size=(batch_size,) + config['input_shape']).astype(np.float32)
+        net.predict_on_batch(x)
+        init = time()
+        for _ in range(steps):
+            net.predict_on_batch(x)
+        results['test_samples_s'][str(batch_size)] = steps * batch_size / (time() - init)
+
+    results['peak_memory'] = peak_memory()
+
+    return results
+
+
+def measure_worker(queue, config, batch_sizes, train_batch_size, steps):
+    try:
+        queue.put(measure_network(config, batch_sizes, train_batch_size, steps))
+    except Exception as e:
+        queue.put({'name': config['name'], 'error': repr(e)})
+
+
+def run_isolated(func, *args):
+    # We run each measure on its own process to get a clean peak memory and a clean backend graph.
+    queue = Queue()
+    worker = Process(target=func, args=(queue,) + args)
+    worker.start()
+    results = queue.get()
+    worker.join()
+    return results
+
+
+def print_table(header, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    row_format = ' | '.join(['%%%ds' % w for w in widths])
+    print(row_format % tuple(header))
+    print('-+-'.join(['-' * w for w in widths]))
+    for row in rows:
+        print(row_format % tuple(row))
+
+
+def print_results(results, batch_sizes):
+    header = ['architecture', 'params', 'build (s)', 'compile (s)', 'train (smp/s)'] +\
+             ['test@%d (smp/s)' % b for b in batch_sizes] + ['peak (MB)']
+    rows = list()
+    for r in results:
+        if 'error' in r:
+            rows.append([r['name'], r['error']] + [''] * (len(header) - 2))
+        else:
+            rows.append(
+                [r['name'], '%d' % r['parameters'], '%.2f' % r['build_time'], '%.2f' % r['compile_time'],
+                 '%.1f' % r['train_samples_s']] +
+                ['%.1f' % r['test_samples_s'][str(b)] for b in batch_sizes] +
+                ['%.1f' % r['peak_memory']]
+            )
+    print_table(header, rows)
+
+
+def main():
+    options = parse_inputs()
+    c = color_codes()
+
+    batch_sizes = options['batch_sizes']
+    results = list()
+    for name in options['architectures']:
+        config = get_configuration(name, options)
+        shape_s = 'x'.join(['%d' % s for s in config['input_shape']])
+        print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Benchmarking ' +
+              c['b'] + name + c['nc'] + c['g'] + ' (input = ' + shape_s + ')' + c['nc'])
+        sys.stdout.flush()
+        results.append(
+            run_isolated(measure_worker, config, batch_sizes, options['train_batch_size'], options['steps'])
+        )
+
+    print_results(results, batch_sizes)
+
+    if options['output'] is not None:
+        json.dump(results, open(options['output'], 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+from __future__ import print_function
+import os
+import pickle
+import re
+import numpy as np
+from nibabel import load as load_nii
+from instrumentation import stage
+
+
+def list_directories(path):
+    return filter(os.path.isdir, [os.path.join(path, f) for f in os.listdir(path)])
+
+
+def natural_key(name):
+    # subject-2 should go before subject-10
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+
+def list_patients(path, suffixes, layout='brats'):
+    # BraTS has a folder per patient (with the images named after the folder), while iSeg has all the images
+    # on the same folder (named after the subject).
+    if layout == 'brats':
+        return sorted([os.path.basename(p) for p in list_directories(path)])
+    files = [f for f in os.listdir(path) if f.endswith(suffixes[0])]
+    return sorted([f[:-len(suffixes[0])] for f in files], key=natural_key)
+
+
+def get_patient_names(path, patient, suffixes, labels, layout='brats'):
+    patient_path = os.path.join(path, patient) if layout == 'brats' else path
+    image_names = [os.path.join(patient_path, patient + suffix) for suffix in suffixes]
+    label_name = os.path.join(patient_path, patient + labels)
+    return image_names, label_name
+
+
+def scan_patient(image_names, label_name):
+    # Shapes and types come from the headers. Only the first image (brain mask) and the labels are read, to get
+    # the number of brain voxels and the histogram of the labels (None for patients without labels).
+    missing = [name for name in image_names if not os.path.isfile(name)]
+    if missing:
+        raise IOError('Missing images: ' + ', '.join(missing))
+    niis = [load_nii(name) for name in image_names]
+    shapes = [nii.shape[:3] for nii in niis]
+    if len(set(shapes)) > 1:
+        raise ValueError('Images with different shapes: ' + ', '.join(image_names))
+    with stage('nifti_load', image=image_names[0]):
+        brain_voxels = int(np.count_nonzero(niis[0].get_data()))
+    histogram = None
+    if os.path.isfile(label_name):
+        with stage('nifti_load', image=label_name):
+            counts = np.bincount(np.asarray(load_nii(label_name).get_data(), dtype=np.int64).flatten())
+        histogram = dict((l, int(c)) for l, c in enumerate(counts) if c > 0)
+    return {
+        'shape': shapes[0],
+        'dtype': [str(nii.get_data_dtype()) for nii in niis],
+        'affine': niis[0].affine,
+        'brain_voxels': brain_voxels,
+        'labels': histogram,
+        'labeled': histogram is not None,
+    }
+
+
+def get_stamps(names):
+    # Modification times of the files of a patient (None for the ones that do not exist), so the metadata of
+    # replaced files is scanned again.
+    return tuple(os.path.getmtime(name) if os.path.isfile(name) else None for name in names)
+
+
+def load_catalog(path, suffixes, labels, layout='brats', index_name='catalog.pkl'):
+    """
+    Function to get the catalog of a dataset. The metadata of each patient (shape, types, number of brain voxels and
+    histogram of the labels) is computed once and kept on an index file (on the dataset folder), so later calls only
+    need to list the dataset folder. Patients whose files changed since they were scanned are scanned again.
+    :param path: Root folder of the dataset.
+    :param suffixes: Suffixes of the images (one per modality) in the order we want them.
+    :param labels: Suffix of the labels.
+    :param layout: 'brats' (one folder per patient) or 'iseg' (all the patients on the same folder).
+    :param index_name: Name of the index file.
+    :return: Dictionary with the list of patients, their image and label names and their metadata.
+    """
+    index_path = os.path.join(path, index_name)
+    try:
+        index = pickle.load(open(index_path, 'rb'))
+    except (IOError, EOFError):
+        index = dict()
+
+    patients = list_patients(path, suffixes, layout)
+    metadata = dict()
+    updated = False
+    for patient in patients:
+        image_names, label_name = get_patient_names(path, patient, suffixes, labels, layout)
+        key = (patient, tuple(suffixes), labels)
+        stamps = get_stamps(image_names + [label_name])
+        # Entries from older indexes (without the brain and label counts) are scanned again too.
+        entry = index.get(key, dict())
+        if entry.get('stamps') != stamps or 'brain_voxels' not in entry.get('metadata', dict()):
+            index[key] = {'stamps': stamps, 'metadata': scan_patient(image_names, label_name)}
+            updated = True
+        metadata[patient] = dict(index[key]['metadata'], image_names=image_names, label_name=label_name)
+
+    if updated:
+        try:
+            pickle.dump(index, open(index_path, 'wb'))
+        except IOError:
+            # Read only datasets are still fine, we just pay the scan on every run.
+            pass
+
+    return {
+        'path': path,
+        'patients': patients,
+        'metadata': metadata,
+    }
+
+
+def get_names(catalog, patients=None):
+    # Same output as the old get_names_from_path functions: an array of image names (patients x modalities)
+    # and an array of label names.
+    patients = catalog['patients'] if patients is None else patients
+    image_names = np.array([catalog['metadata'][p]['image_names'] for p in patients])
+    label_names = np.array([catalog['metadata'][p]['label_name'] for p in patients])
+    return image_names, label_names
+
+
+def get_labeled_patients(catalog):
+    # Patients with labels (training and cross-validation can not use the others).
+    return [p for p in catalog['patients'] if catalog['metadata'][p]['labeled']]
+
+
+def get_metadata(catalog, label_names, key):
+    # Metadata of a list of patients given their label names (the way the scripts keep track of the patients).
+    by_label = dict((m['label_name'], m) for m in catalog['metadata'].values())
+    return [by_label[name][key] for name in label_names]
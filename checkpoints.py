@@ -0,0 +1,133 @@
+from __future__ import print_function
+import os
+import pickle
+import threading
+from collections import deque
+from time import time
+from instrumentation import stage
+
+
+def new_stream(checkpoint=None):
+    # Stream state for the resumable generators (see data_creation.resumable_batches). If we resume from a
+    # checkpoint, the stream starts right after the last batch that was trained.
+    stream = {'batches': deque(), 'last': None}
+    if checkpoint is not None:
+        stream['position'] = checkpoint['position']
+    return stream
+
+
+def load_checkpoint(checkpoint_name):
+    # None if there is no checkpoint to resume from.
+    if not os.path.isfile(checkpoint_name):
+        return None
+    with open(checkpoint_name, 'rb') as f:
+        return pickle.load(f)
+
+
+def restore_checkpoint(net, checkpoint):
+    # The optimizer weights (moments, accumulators, iterations) only exist once the train function is built
+    # (same as keras.models.load_model does).
+    from keras.models import Sequential
+    net.set_weights(checkpoint['weights'])
+    if checkpoint['optimizer']:
+        (net.model if isinstance(net, Sequential) else net)._make_train_function()
+        net.optimizer.set_weights(checkpoint['optimizer'])
+
+
+def write_checkpoint(checkpoint_name, checkpoint):
+    # The checkpoint is written with a temporary name, so an interruption never leaves a broken checkpoint.
+    with stage('checkpoint_write'):
+        with open(checkpoint_name + '.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(checkpoint_name + '.tmp', checkpoint_name)
+
+
+def get_checkpoint_callback(checkpoint_name, net, stream, data=None, steps=None, minutes=None, initial_batch=0):
+    """
+    Function to create a callback that checkpoints training every steps batches and/or every minutes minutes.
+    A checkpoint has the weights of the net, the state of the optimizer, the epoch and batch of Keras and the
+    position of the training stream after the last trained batch (samples of the epoch, step and random states).
+    The weights are copied on the training thread, but pickling and writing them is done on a background thread.
+    If the previous checkpoint is still being written when the next one is due, it is postponed.
+    :param checkpoint_name: Name of the checkpoint file.
+    :param net: Keras model being trained.
+    :param stream: Stream of the training generator (see new_stream).
+    :param data: Extra data needed to resume (usually the center index, to avoid recomputing it).
+    :param steps: Number of batches between checkpoints.
+    :param minutes: Minutes between checkpoints.
+    :param initial_batch: Batch of the first epoch we resume from.
+    :return: Keras callback.
+    """
+    from keras.callbacks import LambdaCallback
+    state = {'epoch': 0, 'batch': 0, 'initial_batch': initial_batch, 'steps': 0, 'time': time(), 'thread': None}
+
+    def epoch_begin(epoch, logs):
+        state['epoch'] = epoch
+        state['batch'] = state.pop('initial_batch', 0)
+
+    def batch_end(batch, logs):
+        stream['last'] = stream['batches'].popleft()
+        state['batch'] += 1
+        state['steps'] += 1
+        due = (steps is not None and state['steps'] >= steps) or\
+            (minutes is not None and time() - state['time'] >= minutes * 60)
+        if due and (state['thread'] is None or not state['thread'].is_alive()):
+            checkpoint = {
+                'weights': net.get_weights(),
+                'optimizer': net.optimizer.get_weights(),
+                'epoch': state['epoch'],
+                'batch': state['batch'],
+                'position': stream['last'],
+                'data': data,
+            }
+            state['thread'] = threading.Thread(target=write_checkpoint, args=(checkpoint_name, checkpoint))
+            state['thread'].start()
+            state['steps'] = 0
+            state['time'] = time()
+
+    def train_end(logs):
+        if state['thread'] is not None:
+            state['thread'].join()
+
+    return LambdaCallback(on_epoch_begin=epoch_begin, on_batch_end=batch_end, on_train_end=train_end)
+
+
+def fit_resumable(net, generator_func, stream, steps_per_epoch, epochs, checkpoint=None, callbacks=None, **kwargs):
+    """
+    Function to train a net with fit_generator from a checkpoint (or from scratch). Keras epochs can not start
+    in the middle, so the rest of an interrupted epoch is trained first with its own fit_generator call.
+    :param net: Keras model (with the checkpoint already restored, see restore_checkpoint).
+    :param generator_func: Function that creates the training generator for the stream.
+    :param stream: Stream of the training generator (see new_stream).
+    :param steps_per_epoch: Number of batches per epoch.
+    :param epochs: Total number of epochs.
+    :param checkpoint: Checkpoint to resume from (None to start from scratch).
+    :param callbacks: Keras callbacks (including the checkpoint callback).
+    The rest of the parameters are passed to fit_generator.
+    """
+    initial_epoch, initial_batch = (checkpoint['epoch'], checkpoint['batch']) if checkpoint is not None else (0, 0)
+    if initial_batch >= steps_per_epoch:
+        initial_epoch, initial_batch = initial_epoch + 1, 0
+    if initial_batch > 0:
+        net.fit_generator(
+            generator=generator_func(),
+            steps_per_epoch=steps_per_epoch - initial_batch,
+            epochs=initial_epoch + 1,
+            initial_epoch=initial_epoch,
+            callbacks=callbacks,
+            **kwargs
+        )
+        # The batches Keras prefetched but did not train are lost, so the next generator continues from the
+        # last trained one.
+        stream['batches'].clear()
+        stream['position'] = stream['last']
+        initial_epoch += 1
+    if initial_epoch < epochs:
+        net.fit_generator(
+            generator=generator_func(),
+            steps_per_epoch=steps_per_epoch,
+            epochs=epochs,
+            initial_epoch=initial_epoch,
+            callbacks=callbacks,
+            **kwargs
+        )
@@ -0,0 +1,109 @@
+from __future__ import print_function
+import argparse
+import os
+import sys
+from multiprocessing import Pool
+from time import strftime
+import numpy as np
+import h5py
+from nibabel import load as load_nii
+from utils import color_codes
+from catalog import load_catalog, get_names
+from data_creation import norm, get_bounding_box
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    parser = argparse.ArgumentParser(description='Convert a dataset into an uncompressed chunked store (HDF5).')
+    parser.add_argument('-f', '--folder', dest='dir_name', default='/home/mariano/DATA/Brats17Test-Training/')
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    parser.add_argument('-d', '--dataset', dest='dataset', choices=['brats', 'iseg'], default='brats')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=4)
+    parser.add_argument('-C', '--chunk-size', dest='chunk_size', type=int, default=32)
+    parser.add_argument('--flair', action='store', dest='flair', default='_flair.nii.gz')
+    parser.add_argument('--t1', action='store', dest='t1', default=None)
+    parser.add_argument('--t1ce', action='store', dest='t1ce', default='_t1ce.nii.gz')
+    parser.add_argument('--t2', action='store', dest='t2', default=None)
+    parser.add_argument('--labels', action='store', dest='labels', default=None)
+    return vars(parser.parse_args())
+
+
+def get_dataset_names(options):
+    # We use the same layout the training and testing scripts understand, with their default suffixes.
+    if options['dataset'] == 'iseg':
+        suffixes = [options['t1'] or '-T1.hdr', options['t2'] or '-T2.hdr']
+        catalog = load_catalog(options['dir_name'], suffixes, options['labels'] or '-label.hdr', layout='iseg')
+    else:
+        suffixes = [options['flair'], options['t2'] or '_t2.nii.gz', options['t1'] or '_t1.nii.gz', options['t1ce']]
+        catalog = load_catalog(options['dir_name'], suffixes, options['labels'] or '_seg.nii.gz')
+    image_names, label_names = get_names(catalog)
+    return catalog['patients'], image_names, label_names
+
+
+def convert_patient(args):
+    # Everything that needs decompression is done here (on the worker processes). The main process only writes.
+    patient, image_names, label_name = args
+    images = list()
+    masks = list()
+    for name in image_names:
+        image = np.squeeze(load_nii(name).get_data())
+        masks.append(image != 0)
+        images.append(norm(image).astype(dtype=np.float32))
+    label_nii = load_nii(label_name)
+    return {
+        'patient': patient,
+        'images': np.stack(images),
+        'masks': np.stack(masks),
+        'labels': np.squeeze(label_nii.get_data()).astype(dtype=np.uint8),
+        'crop': get_bounding_box(masks[0]),
+        'affine': label_nii.affine,
+        'header': np.void(label_nii.header.binaryblock),
+        'image_class': type(label_nii).__name__,
+        'image_names': [os.path.abspath(name) for name in image_names],
+        'label_name': os.path.abspath(label_name),
+    }
+
+
+def write_patient(store, data, chunk_size):
+    group = store.create_group(data['patient'])
+    shape = data['labels'].shape
+    chunks = tuple(min(chunk_size, s) for s in shape)
+    # Images and masks are chunked per channel, that way a crop of one channel only reads its own blocks.
+    group.create_dataset('images', data=data['images'], chunks=(1,) + chunks)
+    group.create_dataset('masks', data=data['masks'], chunks=(1,) + chunks)
+    group.create_dataset('labels', data=data['labels'], chunks=chunks)
+    for key in ['crop', 'affine', 'header', 'image_class', 'image_names', 'label_name']:
+        group.attrs[key] = data[key]
+
+
+def main():
+    options = parse_inputs()
+    c = color_codes()
+
+    patients, image_names, label_names = get_dataset_names(options)
+    output = options['output'] if options['output'] is not None\
+        else os.path.join(options['dir_name'], options['dataset'] + '.h5')
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Converting ' + c['b'] + '%d' % len(patients) +
+          c['nc'] + c['g'] + ' patients into ' + c['b'] + output + c['nc'])
+
+    store = h5py.File(output, 'a')
+    # Patients that were already converted (in a previous, maybe interrupted, run) are skipped.
+    pending = [
+        (p, list(names), label) for p, names, label in zip(patients, image_names, label_names) if p not in store
+    ]
+    pool = Pool(options['jobs'])
+    try:
+        for i, data in enumerate(pool.imap_unordered(convert_patient, pending)):
+            write_patient(store, data, options['chunk_size'])
+            store.flush()
+            print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Patient ' + c['b'] + data['patient'] +
+                  c['nc'] + c['g'] + ' (%d/%d)' % (i + 1, len(pending)) + c['nc'])
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
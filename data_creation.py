@@ -1,7 +1,14 @@
 from __future__ import print_function
+import os
+import pickle
+import random
 import sys
+import threading
+from collections import OrderedDict, deque
 from operator import itemgetter
 import numpy as np
+import h5py
+import nibabel
 from nibabel import load as load_nii
 from data_manipulation.generate_features import get_mask_voxels, get_patches
 from itertools import izip, chain
@@ -9,34 +16,211 @@ from scipy.ndimage.morphology import binary_dilation as imdilate
 from numpy import logical_and as log_and
 from numpy import logical_or as log_or
 from numpy import logical_not as log_not
-import keras
+from instrumentation import stage
+
+
+# Brain crops are computed once per patient and cached both in memory and on disk (next to the mask image).
+_crops = dict()
+
+# Converted datasets (see convert_dataset.py). Once a store is opened, the loaders read the images, masks and labels
+# of its patients from the store instead of decompressing the original files. Each original name is mapped to
+# its patient group and channel (None for the labels).
+_stores = {
+    'files': list(),
+    'names': dict(),
+}
+
+
+# Training patches are cached (if enabled) by patient, center, patch size and crop. Balanced sampling keeps all the
+# lesion voxels, so the same positive centers are extracted again on every epoch (and in every fold). The cache
+# is bounded (in bytes) and the least recently used patches are evicted first.
+_patch_cache = {
+    'patches': OrderedDict(),
+    'lock': threading.Lock(),
+    'size': 0,
+    'max_size': 0,
+    'hits': 0,
+    'misses': 0,
+}
+
+
+def enable_patch_cache(max_size):
+    # Max size is in megabytes (0 disables the cache). Enabling it again with the same size keeps the cached
+    # patches (and counters), so several runs on the same process can share them (see sweep.py).
+    if _patch_cache['max_size'] != max_size * 2 ** 20:
+        clear_patch_cache()
+        _patch_cache['max_size'] = max_size * 2 ** 20
+
+
+def clear_patch_cache():
+    with _patch_cache['lock']:
+        _patch_cache['patches'] = OrderedDict()
+        _patch_cache['size'] = 0
+        _patch_cache['hits'] = 0
+        _patch_cache['misses'] = 0
+
+
+def patch_cache_stats():
+    hits, misses = _patch_cache['hits'], _patch_cache['misses']
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / (hits + misses) if hits + misses > 0 else 0.,
+        'patches': len(_patch_cache['patches']),
+        'size': _patch_cache['size'],
+    }
+
+
+def patch_cache_get(key):
+    with _patch_cache['lock']:
+        patch = _patch_cache['patches'].pop(key, None)
+        if patch is None:
+            _patch_cache['misses'] += 1
+        else:
+            # Reinserting the patch makes it the most recently used one.
+            _patch_cache['patches'][key] = patch
+            _patch_cache['hits'] += 1
+    return patch
+
+
+def patch_cache_put(key, patch):
+    # The patch is copied, otherwise a view would keep the whole batch alive.
+    patch = np.array(patch)
+    if patch.nbytes > _patch_cache['max_size']:
+        return
+    with _patch_cache['lock']:
+        old = _patch_cache['patches'].pop(key, None)
+        _patch_cache['size'] += patch.nbytes - (old.nbytes if old is not None else 0)
+        _patch_cache['patches'][key] = patch
+        while _patch_cache['size'] > _patch_cache['max_size']:
+            _, evicted = _patch_cache['patches'].popitem(last=False)
+            _patch_cache['size'] -= evicted.nbytes
+
+
+def open_store(store_name):
+    store = h5py.File(store_name, 'r')
+    _stores['files'].append(store)
+    for patient in store.values():
+        for channel, name in enumerate(patient.attrs['image_names']):
+            _stores['names'][os.path.abspath(name)] = (patient, channel)
+        _stores['names'][os.path.abspath(patient.attrs['label_name'])] = (patient, None)
+    return store
+
+
+def close_stores():
+    for store in _stores['files']:
+        store.close()
+    _stores['files'] = list()
+    _stores['names'] = dict()
+
+
+def store_lookup(name):
+    return _stores['names'].get(os.path.abspath(name)) if _stores['names'] else None
+
+
+def crop_slices(crop):
+    return tuple(slice(None) for _ in range(3)) if crop is None else tuple(slice(c[0], c[1]) for c in crop)
+
+
+def load_store_volume(name, dataset, crop=None):
+    # Only the chunks that overlap with the crop are read from the store.
+    patient, channel = store_lookup(name)
+    slices = crop_slices(crop) if channel is None else (channel,) + crop_slices(crop)
+    with stage('store_load', image=name):
+        volume = patient[dataset][slices]
+    return volume
+
+
+def load_image(name):
+    # Nibabel image of an input volume. Used to get the reference (shape, affine and header) to save the results
+    # and the masks. If the name is on a store, the image is rebuilt from its metadata. Since images are stored
+    # normalized, the data of an image is its (nonzero) mask, while the data of the labels are the labels.
+    entry = store_lookup(name)
+    if entry is None:
+        return load_nii(name)
+    patient, channel = entry
+    data = load_store_volume(name, 'labels' if channel is None else 'masks').astype(dtype=np.uint8)
+    image_class = getattr(nibabel, patient.attrs['image_class'])
+    header = image_class.header_class(binaryblock=patient.attrs['header'].tostring())
+    return image_class(data.reshape(header.get_data_shape()), patient.attrs['affine'], header)
+
+
+def get_bounding_box(roi):
+    # Bounding box of the roi as [min, max) coordinates for each axis. Instead of looking for all the nonzero voxels
+    # we use the projections of the mask on each axis, which are way smaller.
+    roi = np.squeeze(roi).astype(dtype=np.bool)
+    box = list()
+    for axis in range(roi.ndim):
+        projection = np.flatnonzero(roi.any(axis=tuple(a for a in range(roi.ndim) if a != axis)))
+        box.append((projection[0], projection[-1] + 1) if len(projection) > 0 else (0, 0))
+    return np.array(box, dtype=np.int)
 
 
 def clip_to_roi(images, roi):
     # We clip with padding for patch extraction
-    min_coord = np.stack(np.nonzero(roi.astype(dtype=np.bool))).min(axis=1)
-    max_coord = np.stack(np.nonzero(roi.astype(dtype=np.bool))).max(axis=1)
-
-    clip = np.array([(min_c, max_c) for min_c, max_c in zip(min_coord, max_coord)], dtype=np.uint8)
+    clip = get_bounding_box(roi)
     im_clipped = images[:, clip[0, 0]:clip[0, 1], clip[1, 0]:clip[1, 1], clip[2, 0]:clip[2, 1]]
 
     return im_clipped, clip
 
 
+def get_brain_crop(mask_name, margin=0):
+    # Crop descriptor of a patient (the bounding box of its brain). The mask is usually the first image
+    # (where every nonzero voxel is brain). The margin should be at least half the patch size, that way the
+    # patches extracted from the cropped volume are exactly the ones we would get from the whole volume.
+    if mask_name not in _crops:
+        crop_name = mask_name + '.crop.pkl'
+        entry = store_lookup(mask_name)
+        if entry is not None:
+            _crops[mask_name] = (entry[0].attrs['crop'], entry[0]['labels'].shape)
+        elif os.path.isfile(crop_name):
+            _crops[mask_name] = pickle.load(open(crop_name, 'rb'))
+        else:
+            with stage('nifti_load', image=mask_name):
+                mask = np.squeeze(load_nii(mask_name).get_data())
+            _crops[mask_name] = (get_bounding_box(mask), mask.shape)
+            pickle.dump(_crops[mask_name], open(crop_name, 'wb'))
+    box, shape = _crops[mask_name]
+    return np.stack([np.maximum(box[:, 0] - margin, 0), np.minimum(box[:, 1] + margin, shape)], axis=1)
+
+
+def crop_volume(image, crop):
+    image = np.squeeze(image)
+    return image if crop is None else np.ascontiguousarray(image[crop_slices(crop)])
+
+
+def uncrop_volume(image, crop, shape):
+    # Inverse of crop_volume. We pad the cropped volume with zeros back to the original shape.
+    if crop is None:
+        return image
+    padded = np.zeros(shape, dtype=image.dtype)
+    padded[crop_slices(crop)] = image
+    return padded
+
+
+def crop_centers(centers, crop):
+    return centers if crop is None else [tuple(c) for c in np.array(centers) - crop[:, 0]]
+
+
+@stage('normalization')
 def norm(image):
     image = np.squeeze(image)
     image_nonzero = image[np.nonzero(image)]
     return (image - image_nonzero.mean()) / image_nonzero.std()
 
 
-def norm_load(image_name, verbose=0):
+def norm_load(image_name, verbose=0, crop=None):
     if verbose:
         print(''.join([' '] * 15) + '- Norm image ' + image_name)
-    return norm(load_nii(image_name).get_data())
+    if store_lookup(image_name) is not None:
+        return load_store_volume(image_name, 'images', crop)
+    with stage('nifti_load', image=image_name):
+        image = crop_volume(load_nii(image_name).get_data(), crop)
+    return norm(image)
 
 
-def load_norm_list(image_list):
-    return [norm(load_nii(image).get_data()) for image in image_list]
+def load_norm_list(image_list, crop=None):
+    return [norm_load(image, crop=crop) for image in image_list]
 
 
 def subsample(center_list, sizes, random_state):
@@ -46,15 +230,81 @@ def subsample(center_list, sizes, random_state):
     return [itemgetter(*idx)(centers) if idx else [] for centers, idx in izip(center_list, indices)]
 
 
-def get_image_patches(image_list, centers, size, preload):
-    patches = [get_patches(image, centers, size) for image in image_list] if preload\
-        else [get_patches(norm_load(name), centers, size) for name in image_list]
+def morton_code(centers):
+    # Z-order (Morton) code of each voxel. We interleave the bits of the 3 coordinates (up to 10 bits each, which
+    # is enough for any volume under 1024 voxels per axis), so that sorting by the code gives compact 3D blocks.
+    coords = np.asarray(centers, dtype=np.uint64).reshape((-1, 3))
+    code = np.zeros(len(coords), dtype=np.uint64)
+    for axis in range(3):
+        x = coords[:, axis] & np.uint64(0x3ff)
+        x = (x | (x << np.uint64(16))) & np.uint64(0x030000ff)
+        x = (x | (x << np.uint64(8))) & np.uint64(0x0300f00f)
+        x = (x | (x << np.uint64(4))) & np.uint64(0x030c30c3)
+        x = (x | (x << np.uint64(2))) & np.uint64(0x09249249)
+        code |= x << np.uint64(2 - axis)
+    return code
+
+
+def sort_centers(centers, order='raster'):
+    # Testing centers are sorted following a space filling curve (if asked), so that each batch covers a
+    # compact block of the volume instead of a thin strip. The results are scattered back using the same centers.
+    if order == 'morton' and len(centers) > 0:
+        return [tuple(centers[i]) for i in np.argsort(morton_code(centers), kind='mergesort')]
+    return centers
+
+
+def sort_image_centers(centers, order='raster'):
+    # Same as sort_centers for centers with their image reference (image, center). We sort by image first.
+    if order == 'morton' and len(centers) > 0:
+        images = np.array([c[0] for c in centers])
+        codes = morton_code([c[1] for c in centers])
+        return centers[np.lexsort((codes, images))]
+    return centers
+
+
+def get_subvolume_patches(image, centers, size):
+    # Instead of extracting the patches from the whole (padded) image, we only use the block of the image that
+    # contains all the patches. With compact batches (morton order) that block is way smaller than the image.
+    # Voxels outside of the image are still 0 because of the padding in get_patches.
+    centers_array = np.array(centers)
+    patch_half = np.array(size) // 2
+    min_coord = np.maximum(centers_array.min(axis=0) - patch_half, 0)
+    max_coord = np.minimum(centers_array.max(axis=0) - patch_half + size, image.shape)
+    subvolume = image[tuple(slice(min_c, max_c) for min_c, max_c in zip(min_coord, max_coord))]
+    return get_patches(subvolume, [tuple(c) for c in centers_array - min_coord], size)
+
+
+def get_image_patches(image_list, centers, size, preload, subvolume=False, crop=None, patient=None):
+    # If the patch cache is enabled and we know the patient, only the patches that are not cached are extracted
+    # (if all of them are cached, the images are not even loaded).
+    if patient is not None and _patch_cache['max_size'] > 0:
+        crop_key = None if crop is None else tuple(tuple(c) for c in crop)
+        keys = [(patient, tuple(center), tuple(size), crop_key) for center in centers]
+        patches = [patch_cache_get(key) for key in keys]
+        missing = [i for i, patch in enumerate(patches) if patch is None]
+        if missing:
+            missing_patches = get_image_patches(
+                image_list, [centers[i] for i in missing], size, preload, subvolume, crop
+            )
+            for i, patch in izip(missing, missing_patches):
+                patch_cache_put(keys[i], patch)
+                patches[i] = patch
+        return np.stack(patches)
+    patches_func = get_subvolume_patches if subvolume else get_patches
+    patches = [patches_func(image, centers, size) for image in image_list] if preload\
+        else [patches_func(norm_load(name, crop=crop), centers, size) for name in image_list]
     return np.stack(patches, axis=1)
 
 
-def get_patches_list(list_of_image_list, centers_list, size, preload):
-    patch_list = [get_image_patches(image_list, centers, size, preload)
-                  for image_list, centers in izip(list_of_image_list, centers_list) if centers]
+@stage('patch_extraction')
+def get_patches_list(list_of_image_list, centers_list, size, preload, subvolume=False, crops=None, patients=None):
+    # Patients are only used as keys for the patch cache (the name of their first image). Without them (testing),
+    # patches are never cached.
+    crops = [None] * len(list_of_image_list) if crops is None else crops
+    patients = [None] * len(list_of_image_list) if patients is None else patients
+    patch_list = [get_image_patches(image_list, centers, size, preload, subvolume, crop, patient)
+                  for image_list, centers, crop, patient in izip(list_of_image_list, centers_list, crops, patients)
+                  if centers]
     return patch_list
 
 
@@ -67,9 +317,15 @@ def centers_and_idx(centers, n_images):
     return centers, idx
 
 
-def labels_generator(image_names):
-    for patient in image_names:
-        yield np.squeeze(load_nii(patient).get_data())
+def labels_generator(image_names, crops=None):
+    crops = [None] * len(image_names) if crops is None else crops
+    for patient, crop in izip(image_names, crops):
+        if store_lookup(patient) is not None:
+            label = load_store_volume(patient, 'labels', crop)
+        else:
+            with stage('nifti_load', image=patient):
+                label = crop_volume(load_nii(patient).get_data(), crop)
+        yield label
 
 
 def get_xy(
@@ -83,20 +339,43 @@ def get_xy(
         split,
         iseg,
         experimental,
-        datatype
+        datatype,
+        subvolume=False,
+        crops=None,
+        patients=None
 ):
     n_images = len(image_list)
     centers, idx = centers_and_idx(batch_centers, n_images)
     print(''.join([' '] * 15) + 'Loading x')
-    x = filter(lambda z: z.any(), get_patches_list(image_list, centers, size, preload))
-    x = np.concatenate(x)
+    x = get_patches_list(image_list, centers, size, preload, subvolume, crops, patients)
     print(''.join([' '] * 15) + '- Concatenation')
-    x[idx] = x
+    x = scatter_batch(x, idx, datatype)
     print(''.join([' '] * 15) + 'Loading y')
-    y = [np.array([l[c] for c in lc]) for l, lc in izip(labels_generator(label_names), centers)]
+    y = [l[tuple(np.transpose(lc))] for l, lc in izip(labels_generator(label_names, crops), centers) if lc]
     print(''.join([' '] * 15) + '- Concatenation')
-    y = np.concatenate(y)
-    y[idx] = y
+    y = scatter_batch(y, idx)
+    y = encode_targets(y, label_names, centers, idx, fc_shape, nlabels, split, iseg, experimental, crops)
+    return x, y
+
+
+def scatter_batch(arrays, idx, datatype=None):
+    # The arrays of each image (in the order given by centers_and_idx) are written directly in their final position
+    # of the batch. That way we avoid the copies of concatenating them, reordering them and changing their type.
+    arrays = [array for array in arrays if len(array) > 0]
+    datatype = arrays[0].dtype if datatype is None else datatype
+    batch = np.empty((len(idx),) + arrays[0].shape[1:], dtype=datatype)
+    idx = np.asarray(idx, dtype=np.int)
+    offset = 0
+    for array in arrays:
+        batch[idx[offset:offset + len(array)]] = array
+        offset += len(array)
+    return batch
+
+
+@stage('target_encoding')
+def encode_targets(y, label_names, centers, idx, fc_shape, nlabels, split, iseg, experimental, crops=None):
+    # Keras is only needed to encode training targets. Testing (numpy_net included) can skip importing it.
+    import keras
     if split:
         if iseg:
             vals = [0, 10, 150, 250]
@@ -108,9 +387,8 @@ def get_xy(
             y_cat = [keras.utils.to_categorical(y_cat, num_classes=labels)]
             if experimental >= 3:
                 y_fc = [np.asarray(get_patches(l, lc, fc_shape))
-                        for l, lc in izip(labels_generator(label_names), centers)]
-                y_fc = np.concatenate(y_fc)
-                y_fc[idx] = y_fc
+                        for l, lc in izip(labels_generator(label_names, crops), centers) if lc]
+                y_fc = scatter_batch(y_fc, idx)
                 y_fc_cat = np.sum(
                     map(lambda (lab, val): (y_fc == val).astype(dtype=np.uint8) * lab, enumerate(vals)), axis=0
                 )
@@ -124,9 +402,8 @@ def get_xy(
         else:
             if experimental == 1:
                 y_fc = [np.asarray(get_patches(l, lc, fc_shape), dtype=np.bool)
-                        for l, lc in izip(labels_generator(label_names), centers)]
-                y_fc = np.concatenate(y_fc)
-                y_fc[idx] = y_fc
+                        for l, lc in izip(labels_generator(label_names, crops), centers) if lc]
+                y_fc = scatter_batch(y_fc, idx)
                 y = [
                     keras.utils.to_categorical(np.copy(y).astype(dtype=np.bool), num_classes=nlabels),
                     keras.utils.to_categorical(y_fc, num_classes=nlabels).reshape((len(y_fc), -1, nlabels))
@@ -148,7 +425,60 @@ def get_xy(
                 ]
     else:
         y = keras.utils.to_categorical(np.copy(y).astype(dtype=np.bool), num_classes=2)
-    return x.astype(dtype=datatype), y
+    return y
+
+
+def get_patch_batch_functions(
+        image_names,
+        label_names,
+        centers,
+        size,
+        fc_shape,
+        nlabels,
+        dfactor=10,
+        datatype=np.float32,
+        preload=False,
+        split=False,
+        iseg=False,
+        experimental=False,
+        order='raster',
+        subvolume=False,
+        crops=None,
+):
+    """
+    Function to get the two steps of the training batches of load_patch_batch_train as functions: the sampling of
+    the centers of an epoch (1 / dfactor of them) and the loading of the batch of a subset of those samples. They
+    are used by the generators that need to control the samples of each batch (see resumable_batches and
+    data_parallel.py).
+    The parameters are the same as load_patch_batch_train.
+    :return: Tuple (sample function, batch function).
+    """
+    if preload:
+        crops = [None] * len(image_names) if crops is None else crops
+        image_list = [load_norm_list(patient, crop) for patient, crop in izip(image_names, crops)]
+    else:
+        image_list = image_names
+    patients = [str(patient[0]) for patient in image_names]
+    sample_func = lambda: sample_centers(centers, dfactor)
+    # The order of the samples inside a batch does not matter for training, so we sort them to extract the patches
+    # from compact blocks of each image.
+    batch_func = lambda batch_centers: get_xy(
+        image_list,
+        label_names,
+        sort_image_centers(batch_centers, order),
+        size,
+        fc_shape,
+        nlabels,
+        preload,
+        split,
+        iseg,
+        experimental,
+        datatype,
+        subvolume,
+        crops,
+        patients
+    )
+    return sample_func, batch_func
 
 
 def load_patch_batch_train(
@@ -165,8 +495,25 @@ def load_patch_batch_train(
         split=False,
         iseg=False,
         experimental=False,
+        order='raster',
+        subvolume=False,
+        crops=None,
+        stream=None,
 ):
-    image_list = [load_norm_list(patient) for patient in image_names] if preload else image_names
+    # With a stream (see resumable_batches) training can be resumed from the middle of an epoch.
+    if stream is not None:
+        sample_func, batch_func = get_patch_batch_functions(
+            image_names, label_names, centers, size, fc_shape, nlabels, dfactor, datatype, preload, split, iseg,
+            experimental, order, subvolume, crops
+        )
+        for x, y in resumable_batches(stream, sample_func, batch_func, batch_size):
+            yield x, y
+    if preload:
+        crops = [None] * len(image_names) if crops is None else crops
+        image_list = [load_norm_list(patient, crop) for patient, crop in izip(image_names, crops)]
+    else:
+        image_list = image_names
+    patients = [str(patient[0]) for patient in image_names]
     while True:
         gen = load_patch_batch_generator_train(
             image_list=image_list,
@@ -181,7 +528,11 @@ def load_patch_batch_train(
             preload=preload,
             split=split,
             iseg=iseg,
-            experimental=experimental
+            experimental=experimental,
+            order=order,
+            subvolume=subvolume,
+            crops=crops,
+            patients=patients
         )
         for x, y in gen:
             yield x, y
@@ -200,9 +551,14 @@ def load_patches_train(
         split=False,
         iseg=False,
         experimental=False,
+        crops=None,
 ):
-    image_list = [load_norm_list(patient) for patient in image_names] if preload else image_names
-    batch_centers = np.random.permutation(centers)[::dfactor]
+    if preload:
+        crops = [None] * len(image_names) if crops is None else crops
+        image_list = [load_norm_list(patient, crop) for patient, crop in izip(image_names, crops)]
+    else:
+        image_list = image_names
+    batch_centers = sample_centers(centers, dfactor)
     x, y = get_xy(
         image_list,
         label_names,
@@ -214,11 +570,204 @@ def load_patches_train(
         split,
         iseg,
         experimental,
-        datatype
+        datatype,
+        crops=crops,
+        patients=[str(patient[0]) for patient in image_names]
     )
     return x, y
 
 
+def write_patch_dataset(
+        dataset_name,
+        image_names,
+        label_names,
+        centers,
+        size,
+        fc_shape,
+        nlabels,
+        dfactor=10,
+        datatype=np.float32,
+        preload=False,
+        split=False,
+        iseg=False,
+        experimental=False,
+        crops=None,
+        val_rate=0.25,
+        batch_size=1024,
+        block_size=256,
+):
+    """
+    Function to write the training patches and targets of load_patches_train to disk (HDF5) instead of keeping
+    them in memory. The sampled centers are already shuffled, so any block of the file is a random sample. The
+    last val_rate of the samples (the same ones validation_split would take) are the validation set. If the file
+    already exists, it is reused.
+    :param dataset_name: Name of the HDF5 file.
+    :param val_rate: Rate of samples for validation.
+    :param batch_size: Number of samples extracted at once (rounded to a multiple of block_size).
+    :param block_size: Number of samples per chunk of the file.
+    The rest of the parameters are the same as load_patches_train.
+    :return: Number of training and validation samples.
+    """
+    if not os.path.isfile(dataset_name):
+        if preload:
+            crops = [None] * len(image_names) if crops is None else crops
+            image_list = [load_norm_list(patient, crop) for patient, crop in izip(image_names, crops)]
+        else:
+            image_list = image_names
+        batch_centers = sample_centers(centers, dfactor)
+        n_samples = len(batch_centers)
+        # Writing whole chunks avoids reading them back to update them.
+        step = block_size * max(1, batch_size / block_size)
+        # The file is written with a temporary name, so an interrupted run never leaves a partial dataset.
+        dataset = h5py.File(dataset_name + '.tmp', 'w')
+        for i in range(0, n_samples, step):
+            x, y = get_xy(
+                image_list,
+                label_names,
+                batch_centers[i:i + step],
+                size,
+                fc_shape,
+                nlabels,
+                preload,
+                split,
+                iseg,
+                experimental,
+                datatype,
+                crops=crops,
+                patients=[str(patient[0]) for patient in image_names]
+            )
+            arrays = [('x', x)] + [('y%d' % j, y_j) for j, y_j in enumerate(y if isinstance(y, list) else [y])]
+            with stage('dataset_write'):
+                for name, array in arrays:
+                    if i == 0:
+                        dataset.create_dataset(
+                            name, shape=(n_samples,) + array.shape[1:], dtype=array.dtype,
+                            chunks=(min(block_size, n_samples),) + array.shape[1:]
+                        )
+                    dataset[name][i:i + len(array)] = array
+        dataset.attrs['n_train'] = int(n_samples * (1. - val_rate))
+        dataset.attrs['outputs'] = len(arrays) - 1
+        dataset.attrs['split'] = isinstance(y, list)
+        dataset.close()
+        os.rename(dataset_name + '.tmp', dataset_name)
+    dataset = h5py.File(dataset_name, 'r')
+    n_samples, n_train = len(dataset['x']), dataset.attrs['n_train']
+    dataset.close()
+    return n_train, n_samples - n_train
+
+
+def load_patch_dataset_generator(dataset_name, batch_size, validation=False, block_size=256, stream=None):
+    """
+    Generator of batches from a patch dataset (see write_patch_dataset). Training batches are made of random
+    blocks of the file (each one is a contiguous read) and their samples are shuffled. Validation batches are
+    read in order.
+    :param dataset_name: Name of the HDF5 file.
+    :param batch_size: Number of samples per batch (it should be a multiple of block_size).
+    :param validation: Whether to read the validation samples instead of the training ones.
+    :param block_size: Number of samples per block.
+    :param stream: Stream state to resume training from the middle of an epoch (see resumable_batches).
+    """
+    dataset = h5py.File(dataset_name, 'r')
+    n_train = dataset.attrs['n_train']
+    names = ['x'] + ['y%d' % i for i in range(dataset.attrs['outputs'])]
+    start, stop = (n_train, len(dataset['x'])) if validation else (0, n_train)
+    blocks = [(b, min(b + block_size, stop)) for b in range(start, stop, block_size)]
+    blocks_per_batch = max(1, batch_size / block_size)
+
+    def load_blocks(batch_blocks):
+        with stage('dataset_load'):
+            arrays = [np.concatenate([dataset[name][b0:b1] for b0, b1 in batch_blocks]) for name in names]
+        if not validation:
+            shuffle = np.random.permutation(len(arrays[0]))
+            arrays = [array[shuffle] for array in arrays]
+        return arrays[0], arrays[1:] if dataset.attrs['split'] else arrays[1]
+
+    if stream is not None:
+        batches = resumable_batches(
+            stream, lambda: [blocks[b] for b in np.random.permutation(len(blocks))], load_blocks, blocks_per_batch
+        )
+        for x, y in batches:
+            yield x, y
+    while True:
+        order = range(len(blocks)) if validation else np.random.permutation(len(blocks))
+        for i in range(0, len(blocks), blocks_per_batch):
+            yield load_blocks([blocks[b] for b in order[i:i + blocks_per_batch]])
+
+
+def resumable_batches(stream, sample_func, batch_func, batch_size):
+    """
+    Generator of training batches that can be resumed from any batch. Each epoch, the samples are drawn with
+    sample_func and split into batches of batch_size samples that are loaded with batch_func. The position after each
+    batch (the samples of its epoch, the next step and the state of the random generator) is appended to
+    stream['batches']. Keras trains the batches in the order they are yielded, so a callback can pop them to know
+    where training is (see checkpoints.py). If stream['position'] is set, we resume from that position.
+    :param stream: Dictionary with the state of the stream.
+    :param sample_func: Function that returns the (random) samples of an epoch.
+    :param batch_func: Function that loads the batch of a subset of samples.
+    :param batch_size: Number of samples per batch.
+    """
+    position = stream.pop('position', None)
+    while True:
+        if position is None:
+            samples, step = sample_func(), 0
+        else:
+            samples, step = position['samples'], position['step']
+            np.random.set_state(position['np_random'])
+            position = None
+        for i in range(step, -(-len(samples) / batch_size)):
+            batch = batch_func(samples[i * batch_size:(i + 1) * batch_size])
+            stream['batches'].append({
+                'samples': samples,
+                'step': i + 1,
+                'np_random': np.random.get_state(),
+            })
+            yield batch
+
+
+def load_validation_set(
+        image_names,
+        label_names,
+        centers,
+        size,
+        fc_shape,
+        nlabels,
+        dfactor=10,
+        datatype=np.float32,
+        preload=False,
+        split=False,
+        iseg=False,
+        experimental=False,
+        crops=None,
+        cache=None,
+):
+    """
+    Function to get a fixed validation set. The centers are sampled once (1 / dfactor of them) and their patches
+    and targets are extracted once, so every epoch is validated on the same samples (and only pays the forward
+    passes).
+    :param cache: Prefix of the .npy files where the patches (cache + '.x.npy') and the targets of each output
+     (cache + '.y%d.npy') are kept. They are memory-mapped, and if they already exist they are used instead of
+     sampling the validation set again.
+    The rest of the parameters are the same as load_patches_train.
+    :return: Tuple (x, y) to use as the validation_data of fit or fit_generator.
+    """
+    if cache is None or not os.path.isfile(cache + '.x.npy'):
+        x, y = load_patches_train(
+            image_names, label_names, centers, size, fc_shape, nlabels, dfactor, datatype, preload, split, iseg,
+            experimental, crops
+        )
+        if cache is None:
+            return x, y
+        # The patches are saved last, so their file is only there if the cache is complete.
+        for i, y_i in enumerate(y if isinstance(y, list) else [y]):
+            np.save(cache + '.y%d.npy' % i, y_i)
+        np.save(cache + '.x.npy', x)
+    x = np.load(cache + '.x.npy', mmap_mode='r')
+    y = list()
+    while os.path.isfile(cache + '.y%d.npy' % len(y)):
+        y.append(np.load(cache + '.y%d.npy' % len(y), mmap_mode='r'))
+    return x, y if len(y) > 1 else y[0]
+
+
 def load_patch_batch_generator_train(
         image_list,
         label_names,
@@ -232,7 +781,11 @@ def load_patch_batch_generator_train(
         split=False,
         iseg=False,
         experimental=False,
-        datatype=np.float32
+        datatype=np.float32,
+        order='raster',
+        subvolume=False,
+        crops=None,
+        patients=None
 ):
     # The following line is important to understand the goal of the down scaling factor.
     # The idea of this parameter is to speed up training when using a large pool of samples, while trying
@@ -240,14 +793,17 @@ def load_patch_batch_generator_train(
     # by the center of the patch) and then get a subsample of this set. By randomly selecting at each step,
     # we can train with a larger dataset while also training each lesion with a smaller pool.
     # The random shuffle is important to guarantee the sample proportion in the original samples when the numbers
-    # of epochs tends to infinite.
-    batch_centers = np.random.permutation(center_list)[::dfactor]
+    # of epochs tends to infinite. Only the subsample is drawn (see sample_centers), the whole list of centers (or
+    # the center index) is never permuted.
+    batch_centers = sample_centers(center_list, dfactor)
     n_centers = len(batch_centers)
     for i in range(0, n_centers, batch_size):
+        # The order of the samples inside a batch does not matter for training, so we can sort them to
+        # extract the patches from compact blocks of each image.
         x, y = get_xy(
             image_list,
             label_names,
-            batch_centers[i:i + batch_size],
+            sort_image_centers(batch_centers[i:i + batch_size], order),
             size,
             fc_shape,
             nlabels,
@@ -255,11 +811,69 @@ def load_patch_batch_generator_train(
             split,
             iseg,
             experimental,
-            datatype
+            datatype,
+            subvolume,
+            crops,
+            patients
         )
         yield x, y
 
 
+def load_hard_patch_batch_train(
+        sampler,
+        image_names,
+        label_names,
+        batch_size,
+        size,
+        fc_shape,
+        nlabels,
+        dfactor=10,
+        datatype=np.float32,
+        preload=False,
+        split=False,
+        iseg=False,
+        experimental=False,
+        crops=None,
+):
+    """
+    Generator of training batches with loss-driven sampling. Every epoch samples 1 / dfactor of the centers of the
+    sampler index with a probability proportional to their last loss. The positions of each batch are kept on the
+    sampler until the training step updates the losses of its centers, so the net has to be trained with the
+    training function of set_hard_sampler_train_function.
+    :param sampler: Sampler state (from create_hard_sampler).
+    The rest of the parameters are the same as load_patch_batch_train.
+    """
+    if preload:
+        crops = [None] * len(image_names) if crops is None else crops
+        image_list = [load_norm_list(patient, crop) for patient, crop in izip(image_names, crops)]
+    else:
+        image_list = image_names
+    patients = [str(patient[0]) for patient in image_names]
+    index = sampler['index']
+    n_samples = -(-count_centers(index) / dfactor)
+    while True:
+        positions = sample_hard_center_positions(sampler, n_samples)
+        for i in range(0, len(positions), batch_size):
+            batch_positions = positions[i:i + batch_size]
+            x, y = get_xy(
+                image_list,
+                label_names,
+                index_centers(index, batch_positions),
+                size,
+                fc_shape,
+                nlabels,
+                preload,
+                split,
+                iseg,
+                experimental,
+                datatype,
+                crops=crops,
+                patients=patients
+            )
+            sampler['batches'].append(batch_positions)
+            yield x, y
+
+
 def load_patch_batch_generator_test(
         image_names,
         centers,
@@ -267,45 +881,261 @@ def load_patch_batch_generator_test(
         size,
         preload=False,
         datatype=np.float32,
+        subvolume=False,
+        crop=None,
 ):
+    # If a crop is given, centers should be in the coordinates of the cropped volume.
     while True:
         n_centers = len(centers)
-        image_list = load_norm_list(image_names) if preload else image_names
+        image_list = load_norm_list(image_names, crop) if preload else image_names
         for i in range(0, n_centers, batch_size):
             print('%f%% tested (step %d)' % (100.0*i/n_centers, (i/batch_size)+1), end='\r')
             sys.stdout.flush()
-            x = get_patches_list([image_list], [centers[i:i + batch_size]], size, preload)
+            x = get_patches_list([image_list], [centers[i:i + batch_size]], size, preload, subvolume, [crop])
             x = np.concatenate(x).astype(dtype=datatype)
             yield x
 
 
-def load_masks(mask_names):
-    for image_name in mask_names:
-        yield np.squeeze(load_nii(image_name).get_data().astype(dtype=np.bool))
-
-
-def get_cnn_centers(names, labels_names, balanced=True, neigh_width=15):
-    rois = list(load_masks(names))
-    rois_p = list(load_masks(labels_names))
-    rois_p_neigh = [log_and(log_and(imdilate(roi_p, iterations=neigh_width), log_not(roi_p)), roi)
-                    for roi, roi_p in izip(rois, rois_p)]
-    rois_n_global = [log_and(roi, log_not(log_or(roi_pn, roi_p)))
-                     for roi, roi_pn, roi_p in izip(rois, rois_p_neigh, rois_p)]
-    rois = list()
-    for roi_pn, roi_ng, roi_p in izip(rois_p_neigh, rois_n_global, rois_p):
-        # The goal of this for is to randomly select the same number of nonlesion and lesion samples for each image.
-        # We also want to make sure that we select the same number of boundary negatives and general negatives to
-        # try to account for the variability in the brain.
-        n_positive = np.count_nonzero(roi_p)
-        if balanced:
-            roi_pn[roi_pn] = np.random.permutation(xrange(np.count_nonzero(roi_pn))) < n_positive / 2
-        roi_ng[roi_ng] = np.random.permutation(xrange(np.count_nonzero(roi_ng))) < n_positive / 2
-        rois.append(log_or(log_or(roi_ng, roi_pn), roi_p))
+def load_patch_batch_generator_sample(image_names, n_samples, batch_size, size, datatype=np.float32):
+    # Batches of random brain patches (without labels) from a list of patients. They are used to calibrate
+    # or to gather statistics of a trained net, so only one pass is done.
+    patient_samples = n_samples / len(image_names)
+    for patient in image_names:
+        centers = get_mask_voxels(load_image(patient[0]).get_data().astype(dtype=np.bool))
+        # The random centers are sorted, so each batch is extracted from a compact block of the image.
+        centers = sort_centers(
+            [centers[i] for i in np.random.permutation(len(centers))[:patient_samples]], order='morton'
+        )
+        generator = load_patch_batch_generator_test(patient, centers, batch_size, size, preload=True,
+                                                    subvolume=True, datatype=datatype)
+        for _ in range(-(-len(centers) / batch_size)):
+            yield next(generator)
+
 
-    # In order to be able to permute the centers to randomly select them, or just shuffle them for training, we need
-    # to keep the image reference with the center. That's why we are doing the next following lines of code.
-    centers_list = [get_mask_voxels(roi) for roi in rois]
-    idx_lesion_centers = np.concatenate([np.array([(i, c) for c in centers], dtype=object)
-                                         for i, centers in enumerate(centers_list)])
+def load_masks(mask_names, crops=None):
+    crops = [None] * len(mask_names) if crops is None else crops
+    for image_name, crop in izip(mask_names, crops):
+        entry = store_lookup(image_name)
+        if entry is not None:
+            mask = load_store_volume(image_name, 'masks' if entry[1] is not None else 'labels', crop)
+            mask = mask.astype(dtype=np.bool)
+        else:
+            with stage('nifti_load', image=image_name):
+                mask = crop_volume(load_nii(image_name).get_data().astype(dtype=np.bool), crop)
+        yield mask
+
+
+def random_sampler():
+    # The stdlib sampler draws positions without building the whole list of candidates. We only seed np.random,
+    # so we seed a new one from it to keep seeded runs reproducible.
+    return random.Random(np.random.randint(2 ** 31))
+
+
+def random_subset(mask, n):
+    # Keeps n random voxels of a mask (in place). Only the positions we keep are drawn, the voxels of the mask
+    # are never permuted.
+    count = np.count_nonzero(mask)
+    selected = np.zeros(count, dtype=np.bool)
+    selected[random_sampler().sample(xrange(count), min(n, count))] = True
+    mask[mask] = selected
+
+
+@stage('center_generation')
+def get_patient_centers(roi, label, balanced=True, neigh_width=15):
+    # The goal of this function is to randomly select the same number of nonlesion and lesion samples for an
+    # image. We also want to make sure that we select the same number of boundary negatives and general
+    # negatives to try to account for the variability in the brain. Centers are sorted by label.
+    label = np.asarray(label)
+    roi_p = label.astype(dtype=np.bool)
+    roi_pn = log_and(log_and(imdilate(roi_p, iterations=neigh_width), log_not(roi_p)), roi)
+    roi_ng = log_and(roi, log_not(log_or(roi_pn, roi_p)))
+    n_positive = np.count_nonzero(roi_p)
+    if balanced:
+        random_subset(roi_pn, n_positive / 2)
+    random_subset(roi_ng, n_positive / 2)
+    roi = log_or(log_or(roi_ng, roi_pn), roi_p)
+    roi_labels = label[roi].astype(dtype=np.uint8)
+    order = np.argsort(roi_labels, kind='mergesort')
+    return np.stack(np.nonzero(roi), axis=1).astype(dtype=np.uint16)[order], roi_labels[order]
+
+
+def load_patient_centers(name, label_name, balanced=True, neigh_width=15, crop=None):
+    # Centers of a patient cached on disk (next to the mask image, like the crops). They are kept in the
+    # coordinates of the whole volume, so the same file works for any crop. That way, the centers of a patient
+    # are only computed once, no matter how many folds (or processes) use that patient.
+    centers_name = name + '.centers.%s%d.pkl' % ('b' if balanced else 'u', neigh_width)
+    if os.path.isfile(centers_name):
+        centers, labels = pickle.load(open(centers_name, 'rb'))
+    else:
+        roi = next(load_masks([name]))
+        label = next(labels_generator([label_name]))
+        centers, labels = get_patient_centers(roi, label, balanced, neigh_width)
+        # The file is written with a temporary name, other processes might be reading it.
+        pickle.dump((centers, labels), open(centers_name + '.tmp', 'wb'), pickle.HIGHEST_PROTOCOL)
+        os.rename(centers_name + '.tmp', centers_name)
+    if crop is not None:
+        centers = (centers - crop[:, 0]).astype(dtype=np.uint16)
+    return centers, labels
+
+
+def get_center_index(names, labels_names, balanced=True, neigh_width=15, crops=None, cache=False):
+    """
+    Function to get the training centers of a list of patients as a compact index (a few bytes per center
+    instead of an object array of tuples). For each image we keep all the lesion voxels and random subsets of
+    the negatives on the neighbourhood of the lesion and of the rest of the brain.
+    :param names: Names of the images that define the brain of each patient.
+    :param labels_names: Names of the labels of each patient.
+    :param balanced: Whether to keep the same number of negatives on the neighbourhood of the lesion and
+     elsewhere (half the number of lesion voxels each) or all the neighbourhood negatives.
+    :param neigh_width: Width of the neighbourhood of the lesion.
+    :param crops: Crops of each patient (the centers are given in the coordinates of the cropped volumes).
+    :param cache: Whether to reuse the centers of each patient from disk (see load_patient_centers). The random
+     negatives of a patient are then the same for every index that includes it.
+    :return: Dictionary with the image ('images'), the coordinates ('centers') and the label ('labels') of each
+     center. Centers are sorted by image and label, and 'groups' has the start and size of each of those groups.
+    """
+    crops = [None] * len(names) if crops is None else crops
+    if cache:
+        patient_centers = (
+            load_patient_centers(name, label_name, balanced, neigh_width, crop)
+            for name, label_name, crop in izip(names, labels_names, crops)
+        )
+    else:
+        patient_centers = (
+            get_patient_centers(roi, label, balanced, neigh_width)
+            for roi, label in izip(load_masks(names, crops), labels_generator(labels_names, crops))
+        )
+    images = list()
+    centers = list()
+    labels = list()
+    for i, (image_centers, image_labels) in enumerate(patient_centers):
+        images.append(np.full(len(image_labels), i, dtype=np.uint16))
+        centers.append(image_centers)
+        labels.append(image_labels)
+
+    images = np.concatenate(images)
+    labels = np.concatenate(labels)
+    starts = np.concatenate([[0], np.flatnonzero((np.diff(images) != 0) | (np.diff(labels) != 0)) + 1])
+    return {
+        'images': images,
+        'centers': np.concatenate(centers),
+        'labels': labels,
+        'groups': zip(starts, np.diff(np.concatenate([starts, [len(images)]]))),
+    }
+
+
+def count_centers(centers):
+    # Number of centers of a center index or of a list of centers with their image reference.
+    return len(centers['images']) if isinstance(centers, dict) else len(centers)
+
+
+def index_centers(index, positions):
+    # Centers with their image reference (the format of get_cnn_centers) from positions of a center index.
+    # Coordinates are converted back to ints, patch extraction subtracts from them.
+    return np.array(
+        [(i, tuple(c)) for i, c in izip(index['images'][positions].tolist(), index['centers'][positions].tolist())],
+        dtype=object
+    )
+
+
+def sample_center_positions(index, n_samples):
+    """
+    Function to draw a random subset (without replacement) of the centers of an index. The cost only depends on
+    the number of samples and groups, not on the number of centers. The samples are stratified: each group
+    (image and label) gets its share of the samples (rounded up or down at random, to keep the expected value).
+    :param index: Center index (from get_center_index).
+    :param n_samples: Number of samples.
+    :return: Shuffled positions of the samples on the index.
+    """
+    counts = np.array([count for _, count in index['groups']], dtype=np.float64)
+    quotas = counts * min(n_samples, counts.sum()) / counts.sum()
+    quotas = (np.floor(quotas) + (np.random.random(len(quotas)) < quotas - np.floor(quotas))).astype(np.int)
+    sampler = random_sampler()
+    positions = np.concatenate([
+        start + np.array(sampler.sample(xrange(count), min(q, count)), dtype=np.int)
+        for (start, count), q in izip(index['groups'], quotas)
+    ])
+    return np.random.permutation(positions)
+
+
+def sample_centers(centers, dfactor):
+    # Random subset (1 / dfactor) of the training centers for an epoch.
+    n_samples = -(-count_centers(centers) / dfactor)
+    if isinstance(centers, dict):
+        return index_centers(centers, sample_center_positions(centers, n_samples))
+    return centers[random_sampler().sample(xrange(len(centers)), n_samples)]
 
-    return idx_lesion_centers
+
+def create_hard_sampler(index, floor=0.1):
+    """
+    Function to create the state of a loss-driven (hard example) sampler over a center index. The loss of each
+    center is updated while training (see set_hard_sampler_train_function) and the centers of the next epochs are sampled
+    proportionally to their last loss (see sample_hard_center_positions).
+    :param index: Center index (from get_center_index).
+    :param floor: Rate of the sampling probability that is uniform, so that every center keeps a chance to be
+     sampled (and easy centers that become hard again are found).
+    :return: Dictionary with the state of the sampler.
+    """
+    return {
+        'index': index,
+        'losses': np.full(count_centers(index), np.nan, dtype=np.float32),
+        'floor': floor,
+        'batches': deque(),
+    }
+
+
+def sample_hard_center_positions(sampler, n_samples):
+    # Centers that were never sampled get the mean loss of the rest (the first epoch is uniform).
+    # Unlike sample_center_positions, the cost of each epoch depends on the total number of centers: every center
+    # has its own probability, so np.random.choice has to go through all of them. That is the price of weighting
+    # by the loss, and it is still small compared to the patch extraction of an epoch.
+    losses = sampler['losses']
+    seen = np.isfinite(losses)
+    weights = np.where(seen, losses, losses[seen].mean() if seen.any() else 1.).astype(np.float64)
+    weights = weights / weights.sum() if weights.sum() > 0 else np.ones_like(weights) / len(weights)
+    p = (1. - sampler['floor']) * weights + sampler['floor'] / len(weights)
+    return np.random.choice(len(p), min(n_samples, len(p)), replace=False, p=p / p.sum())
+
+
+def set_hard_sampler_train_function(net, sampler):
+    """
+    Function to replace the training function of a compiled Keras model with one that also gets the loss of each
+    sample (summed over outputs and averaged over voxels) from the same forward pass used for the gradients. Those
+    losses are stored on the sampler, so hard sampling does not need another pass over the batch. The batches are
+    trained in the same order the generator yields them, so the oldest positions on the sampler are the ones of
+    the batch being trained.
+    :param net: Compiled Keras model (trained with load_hard_patch_batch_train).
+    :param sampler: Sampler state (from create_hard_sampler).
+    """
+    import keras.backend as K
+    from keras.models import Sequential
+    # This is the training function Keras compiles (see Model._make_train_function) plus the losses.
+    model = net.model if isinstance(net, Sequential) else net
+    inputs = model._feed_inputs + model._feed_targets + model._feed_sample_weights
+    if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+        inputs += [K.learning_phase()]
+    losses = list()
+    for y_true, y_pred, loss_function in izip(model.targets, model.outputs, model.loss_functions):
+        if y_true is not None:
+            loss = loss_function(y_true, y_pred)
+            losses.append(K.mean(K.batch_flatten(loss), axis=1) if K.ndim(loss) > 1 else loss)
+    updates = model.updates + model.optimizer.get_updates(
+        model._collected_trainable_weights, model.constraints, model.total_loss
+    )
+    function = K.function(
+        inputs, [model.total_loss] + model.metrics_tensors + [sum(losses)], updates=updates, **model._function_kwargs
+    )
+
+    def train_function(ins):
+        outputs = function(ins)
+        sampler['losses'][sampler['batches'].popleft()] = outputs[-1]
+        return outputs[:-1]
+
+    model.train_function = train_function
+
+
+def get_cnn_centers(names, labels_names, balanced=True, neigh_width=15, crops=None):
+    # In order to be able to permute the centers to randomly select them, or just shuffle them for training, we need
+    # to keep the image reference with the center. For large datasets, use the index instead (get_center_index).
+    index = get_center_index(names, labels_names, balanced, neigh_width, crops)
+    return index_centers(index, np.arange(count_centers(index)))
@@ -0,0 +1,314 @@
+from __future__ import print_function
+import ctypes
+import multiprocessing
+import sys
+from time import strftime, time
+import numpy as np
+from keras import backend as K
+from keras.models import Sequential
+from utils import color_codes
+from inference import prefetch
+
+
+def create_barrier(parties):
+    # multiprocessing has no Barrier on Python 2, so we use a condition with a counter. The generation tells the
+    # processes that wake up whether the barrier they were waiting for was released (they might be notified by an
+    # abort too).
+    return {
+        'condition': multiprocessing.Condition(),
+        'count': multiprocessing.RawValue(ctypes.c_int, 0),
+        'generation': multiprocessing.RawValue(ctypes.c_int, 0),
+        'abort': multiprocessing.RawValue(ctypes.c_int, 0),
+        'parties': parties,
+    }
+
+
+def barrier_wait(barrier):
+    with barrier['condition']:
+        generation = barrier['generation'].value
+        barrier['count'].value += 1
+        if barrier['count'].value == barrier['parties']:
+            barrier['count'].value = 0
+            barrier['generation'].value += 1
+            barrier['condition'].notify_all()
+        while generation == barrier['generation'].value and not barrier['abort'].value:
+            # We wake up every second, a worker that died will never get to the barrier.
+            barrier['condition'].wait(1)
+        if barrier['abort'].value:
+            raise RuntimeError('Data-parallel training was aborted')
+
+
+def abort_barrier(barrier):
+    with barrier['condition']:
+        barrier['abort'].value = 1
+        barrier['condition'].notify_all()
+
+
+def get_parallel_updates(net):
+    """
+    Function to split the training step of a compiled Keras model (Sequential or functional) in two: the gradients
+    of the loss for a batch and the update of the weights (optimizer included) for a given gradient. That way, the
+    gradients of several processes can be averaged before the update. Only the graph is built here, each worker
+    compiles its own functions.
+    :param net: Compiled Keras model.
+    :return: Dictionary with the model, the inputs, loss and gradients of the batch and the placeholders (for the
+     averaged gradients) and updates of the optimizer.
+    """
+    model = net.model if isinstance(net, Sequential) else net
+    inputs = model._feed_inputs + model._feed_targets + model._feed_sample_weights
+    if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+        inputs += [K.learning_phase()]
+    weights = model._collected_trainable_weights
+    placeholders = [K.placeholder(ndim=K.ndim(w), dtype=K.dtype(w)) for w in weights]
+    # The optimizer computes its own gradients from the loss, so we make it take the placeholders instead.
+    model.optimizer.get_gradients = lambda loss, params: placeholders
+    try:
+        updates = model.optimizer.get_updates(weights, model.constraints, model.total_loss)
+    finally:
+        del model.optimizer.get_gradients
+    return {
+        'model': model,
+        'inputs': inputs,
+        'loss': model.total_loss,
+        'gradients': model.optimizer.get_gradients(model.total_loss, weights),
+        'placeholders': placeholders,
+        'updates': updates,
+        'shapes': [K.get_value(w).shape for w in weights],
+    }
+
+
+def seed_dropout(loss, seed):
+    # The dropout masks of the Theano backend come from random streams, whose states are shared variables of the
+    # graph. The workers are forked, so they would all draw the same masks unless each one seeds them again.
+    from theano.gof.graph import inputs
+    from theano.sandbox.rng_mrg import MRG_RandomStreams
+    random_state = np.random.RandomState(seed)
+    for variable in inputs([loss]):
+        if getattr(variable, 'default_update', None) is not None and hasattr(variable, 'get_value'):
+            state = variable.get_value()
+            if state.dtype == np.int32 and state.ndim == 2 and state.shape[1] == 6:
+                rng = MRG_RandomStreams(random_state.randint(1, 2 ** 30))
+                variable.set_value(rng.get_substream_rstates(state.shape[0], 'int32'))
+
+
+def get_array_batch_functions(x, y):
+    # Sampling and loading functions (see fit_data_parallel) for a training set that is already in memory. Each
+    # epoch is a permutation of the samples (same as fit with shuffle=True).
+    return (
+        lambda: np.random.permutation(len(x)),
+        lambda idx: (x[idx], [y_i[idx] for y_i in y] if isinstance(y, list) else y[idx])
+    )
+
+
+def split_validation(x, y, val_rate):
+    # Same split as the validation_split of fit (the last samples are used for validation).
+    n_train = int(len(x) * (1. - val_rate))
+    if isinstance(y, list):
+        return (x[:n_train], [y_i[:n_train] for y_i in y]), (x[n_train:], [y_i[n_train:] for y_i in y])
+    return (x[:n_train], y[:n_train]), (x[n_train:], y[n_train:])
+
+
+def flatten_arrays(arrays, buffer):
+    start = 0
+    for a in arrays:
+        buffer[start:start + a.size] = a.ravel()
+        start += a.size
+
+
+def unflatten_arrays(buffer, shapes):
+    arrays = list()
+    start = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        arrays.append(buffer[start:start + size].reshape(shape))
+        start += size
+    return arrays
+
+
+def weighted_average(rows, counts):
+    # The rows are added in the same order on every worker, so all of them get exactly the same average.
+    total = np.zeros(rows.shape[1], dtype=np.float64)
+    for row, count in zip(rows, counts):
+        if count > 0:
+            total += count * row
+    return (total / counts.sum()).astype(rows.dtype)
+
+
+def train_worker(rank, net, graph, sample_func, batch_func, shared, parameters):
+    """
+    Function with the training loop of a data-parallel worker. Every epoch, all the workers draw the same samples
+    (same seed) and split them into the same batches, and each worker only loads and trains its own part of each
+    batch. With sync_steps = 1, the gradients of the workers are averaged (weighted by the number of samples) and
+    all of them apply the same update, so the weights never diverge. Otherwise, each worker updates its weights with
+    its own gradients, and the weights and the state of the optimizer are averaged every sync_steps batches (and at
+    the end of each epoch).
+    :param rank: Number of the worker (the first one validates, reports the epochs and returns the final weights).
+    :param net: Keras model (copied by the fork).
+    :param graph: Gradients and updates of the model (see get_parallel_updates).
+    :param sample_func: Function that returns the (random) samples of an epoch.
+    :param batch_func: Function that loads the batch of a subset of samples.
+    :param shared: Shared memory (exchange buffers, sample counts, final state and barrier).
+    :param parameters: Training parameters (see fit_data_parallel).
+    """
+    c = color_codes()
+    workers = parameters['workers']
+    batch_size = parameters['batch_size']
+    sync_steps = parameters['sync_steps']
+    model = graph['model']
+    seed_dropout(graph['loss'], parameters['seed'] + rank + 1)
+    gradient_function = K.function(graph['inputs'], [graph['loss']] + graph['gradients'], updates=model.updates)
+    apply_function = K.function(graph['placeholders'], [], updates=graph['updates'])
+    learning_phase = [1.] if model.uses_learning_phase and not isinstance(K.learning_phase(), int) else []
+    n_weights = len(net.get_weights())
+
+    def local_batches(samples, steps):
+        for i in range(steps):
+            batch = samples[i * batch_size:(i + 1) * batch_size]
+            start, end = len(batch) * rank / workers, len(batch) * (rank + 1) / workers
+            yield end - start, batch_func(batch[start:end]) if end > start else None
+
+    step = 0
+    for epoch in range(parameters['epochs']):
+        epoch_start = time()
+        np.random.seed(parameters['seed'] + epoch)
+        samples = sample_func()
+        steps = -(-len(samples) / batch_size)
+        epoch_loss = 0.
+        local_samples, local_loss = 0, 0.
+        for i, (n_samples, batch) in enumerate(prefetch(local_batches(samples, steps), steps, parameters['queue'])):
+            slot = step % 2
+            if n_samples > 0:
+                x, y, sample_weights = model._standardize_user_data(batch[0], batch[1], check_batch_axis=True)
+                outputs = gradient_function(x + y + sample_weights + learning_phase)
+                loss, gradients = outputs[0], outputs[1:]
+                local_samples, local_loss = local_samples + n_samples, local_loss + loss * n_samples
+                if sync_steps > 1:
+                    apply_function(gradients)
+            if sync_steps == 1:
+                shared['counts'][slot, rank] = (local_samples, local_loss)
+                if n_samples > 0:
+                    flatten_arrays(gradients, shared['exchange'][slot, rank])
+            elif (i + 1) % sync_steps == 0 or i == steps - 1:
+                shared['counts'][slot, rank] = (local_samples, local_loss)
+                flatten_arrays(net.get_weights() + net.optimizer.get_weights(), shared['exchange'][slot, rank])
+            else:
+                continue
+            # The exchange buffers alternate between steps, so a worker can write its next step while the slower
+            # ones are still reading the previous one.
+            barrier_wait(shared['barrier'])
+            counts = shared['counts'][slot, :, 0]
+            epoch_loss += shared['counts'][slot, :, 1].sum()
+            local_samples, local_loss = 0, 0.
+            if sync_steps == 1:
+                apply_function(unflatten_arrays(
+                    weighted_average(shared['exchange'][slot, :, :shared['n_gradients']], counts), graph['shapes']
+                ))
+            else:
+                state = unflatten_arrays(weighted_average(shared['exchange'][slot], counts), shared['shapes'])
+                net.set_weights(state[:n_weights])
+                net.optimizer.set_weights(state[n_weights:])
+            step += 1
+
+        if rank == 0:
+            text = 'Epoch %d/%d - loss: %f' % (epoch + 1, parameters['epochs'], epoch_loss / len(samples))
+            validation_data = parameters['validation_data']
+            if validation_data is not None:
+                if isinstance(validation_data, tuple):
+                    val_loss = net.evaluate(validation_data[0], validation_data[1], batch_size=batch_size, verbose=0)
+                else:
+                    val_loss = net.evaluate_generator(
+                        validation_data, parameters['validation_steps'], max_q_size=parameters['queue']
+                    )
+                text += ' - val_loss: %f' % (val_loss[0] if isinstance(val_loss, list) else val_loss)
+            print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + text + c['b'] +
+                  ' (%.1fs)' % (time() - epoch_start) + c['nc'])
+            sys.stdout.flush()
+
+    if rank == 0:
+        flatten_arrays(net.get_weights() + net.optimizer.get_weights(), shared['state'])
+
+
+def fit_data_parallel(
+        net,
+        sample_func,
+        batch_func,
+        batch_size,
+        epochs,
+        workers,
+        sync_steps=1,
+        validation_data=None,
+        validation_steps=None,
+        queue=10,
+        seed=None
+):
+    """
+    Function to train a net with several processes (synchronous data parallelism). The workers are forked from
+    this process and exchange their gradients (or weights) through shared memory. With sync_steps = 1, training
+    is the same as training on a single process with batches of batch_size samples (up to the dropout masks and
+    rounding), but each worker only loads and computes the gradients of batch_size / workers samples. The number of
+    threads of each worker should be limited (OMP_NUM_THREADS) to share the cores between the workers.
+    Once the workers finish, the trained weights (and the state of the optimizer) are copied to net. Only the Theano
+    backend is supported: the workers are forked once the graph exists, and forking a live TensorFlow session hangs.
+    :param net: Compiled Keras model (Sequential or functional).
+    :param sample_func: Function that returns the (random) samples of an epoch.
+    :param batch_func: Function that loads the batch of a subset of samples (x, y).
+    :param batch_size: Number of samples per batch (for all the workers).
+    :param epochs: Number of epochs.
+    :param workers: Number of worker processes.
+    :param sync_steps: Number of batches between weight averages (1 averages the gradients of every batch).
+    :param validation_data: Validation set (x, y) or generator (validated by the first worker after each epoch).
+    :param validation_steps: Number of batches of the validation generator.
+    :param queue: Number of batches that each worker loads in advance.
+    :param seed: Seed for the samples of each epoch.
+    """
+    if K.backend() != 'theano':
+        raise NotImplementedError('Data-parallel training only works with the Theano backend (not %s)' % K.backend())
+    graph = get_parallel_updates(net)
+    shapes = [w.shape for w in net.get_weights() + net.optimizer.get_weights()]
+    n_gradients = sum([int(np.prod(shape)) for shape in graph['shapes']])
+    n_state = sum([int(np.prod(shape)) for shape in shapes])
+    n_exchange = n_gradients if sync_steps == 1 else n_state
+    shared = {
+        'exchange': np.frombuffer(
+            multiprocessing.RawArray(ctypes.c_float, 2 * workers * n_exchange), dtype=np.float32
+        ).reshape((2, workers, n_exchange)),
+        'counts': np.frombuffer(
+            multiprocessing.RawArray(ctypes.c_double, 2 * workers * 2), dtype=np.float64
+        ).reshape((2, workers, 2)),
+        'state': np.frombuffer(multiprocessing.RawArray(ctypes.c_float, n_state), dtype=np.float32),
+        'n_gradients': n_gradients,
+        'shapes': shapes,
+        'barrier': create_barrier(workers),
+    }
+    parameters = {
+        'workers': workers,
+        'batch_size': batch_size,
+        'epochs': epochs,
+        'sync_steps': sync_steps,
+        'validation_data': validation_data,
+        'validation_steps': validation_steps,
+        'queue': queue,
+        'seed': np.random.randint(2 ** 30) if seed is None else seed,
+    }
+    processes = [
+        multiprocessing.Process(
+            target=train_worker, args=(rank, net, graph, sample_func, batch_func, shared, parameters)
+        )
+        for rank in range(workers)
+    ]
+    for p in processes:
+        p.start()
+    # If a worker fails, the others would wait for it forever.
+    alive = processes
+    while alive:
+        alive[0].join(1)
+        alive = [p for p in processes if p.is_alive()]
+        if any([p.exitcode not in [None, 0] for p in processes]):
+            abort_barrier(shared['barrier'])
+    failed = [p for p in processes if p.exitcode != 0]
+    if failed:
+        raise RuntimeError('%d of the %d data-parallel workers failed' % (len(failed), workers))
+    state = unflatten_arrays(shared['state'], shapes)
+    n_weights = len(net.get_weights())
+    net.set_weights(state[:n_weights])
+    net.optimizer.set_weights(state[n_weights:])
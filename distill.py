@@ -0,0 +1,200 @@
+from __future__ import print_function
+import argparse
+from time import strftime
+import numpy as np
+from utils import color_codes
+from data_creation import get_center_index, count_centers, index_centers, sample_center_positions, get_xy
+from data_creation import load_norm_list
+from inference import compare_nets, measure_throughput
+from benchmark import get_configuration, build_network, print_table
+from convert_dataset import get_dataset_names
+from instrumentation import stage, enable_trace
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    parser = argparse.ArgumentParser(description='Train a small student net from the outputs of a trained one.')
+    parser.add_argument('teacher', help='Trained Keras model (.mdl)')
+    parser.add_argument('-f', '--folder', dest='dir_name', default='/home/mariano/DATA/Brats17Test-Training/')
+    parser.add_argument('-d', '--dataset', dest='dataset', choices=['brats', 'iseg'], default='brats')
+    parser.add_argument('-S', '--student', dest='student', default='brats-multioutput',
+                        choices=['brats-multioutput', 'iseg-baseline', 'iseg-experimental1'])
+    parser.add_argument('-c', '--conv-blocks', dest='conv_blocks', type=int, default=3)
+    parser.add_argument('-n', '--num-filters', action='store', dest='n_filters', type=int, default=16)
+    parser.add_argument('-k', '--kernel-size', dest='conv_width', type=int, default=3)
+    parser.add_argument('--dense-size', dest='dense_size', type=int, default=64)
+    parser.add_argument('-H', '--teacher-head', dest='teacher_head', type=int, default=None)
+    parser.add_argument('-a', '--alpha', dest='alpha', type=float, default=0.5)
+    parser.add_argument('-T', '--temperature', dest='temperature', type=float, default=2.0)
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=2048)
+    parser.add_argument('-D', '--down-factor', dest='dfactor', type=int, default=500)
+    parser.add_argument('-e', '--epochs', action='store', dest='epochs', type=int, default=50)
+    parser.add_argument('-q', '--queue', action='store', dest='queue', type=int, default=10)
+    parser.add_argument('-t', '--test-cases', dest='test_cases', type=int, default=2)
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    parser.add_argument('--preload', action='store_true', dest='preload', default=False)
+    parser.add_argument('--flair', action='store', dest='flair', default='_flair.nii.gz')
+    parser.add_argument('--t1', action='store', dest='t1', default=None)
+    parser.add_argument('--t1ce', action='store', dest='t1ce', default='_t1ce.nii.gz')
+    parser.add_argument('--t2', action='store', dest='t2', default=None)
+    parser.add_argument('--labels', action='store', dest='labels', default=None)
+    parser.add_argument('--trace', action='store', dest='trace', default=None)
+    parser.add_argument('--trace-rss', action='store', dest='trace_rss', type=float, default=None)
+    return vars(parser.parse_args())
+
+
+def get_teacher_head(teacher, n_classes):
+    # By default, the last output of the teacher that labels the center voxel with the classes of the student
+    # (the fully convolutional outputs are skipped).
+    shapes = teacher.output_shape if isinstance(teacher.output_shape, list) else [teacher.output_shape]
+    heads = [h for h, shape in enumerate(shapes) if len(shape) == 2 and shape[-1] == n_classes]
+    if not heads:
+        raise ValueError('The teacher has no output with %d classes' % n_classes)
+    return heads[-1]
+
+
+def soften(probabilities, temperature):
+    # Softmax with temperature from probabilities (softmax(log(p) / T)). Higher temperatures give more weight to
+    # the classes the teacher considers similar to the right one.
+    if temperature == 1:
+        return probabilities
+    logits = np.log(np.maximum(probabilities, 1e-8)) / temperature
+    logits -= logits.max(axis=-1, keepdims=True)
+    soft = np.exp(logits)
+    return soft / soft.sum(axis=-1, keepdims=True)
+
+
+def load_distillation_batch_train(
+        teacher,
+        teacher_head,
+        image_names,
+        label_names,
+        centers,
+        batch_size,
+        size,
+        nlabels,
+        dfactor,
+        alpha,
+        temperature,
+        preload=False,
+        iseg=False,
+):
+    """
+    Generator of training batches for a student net. The targets of the last output of the student mix the hard
+    labels (weighted by alpha) with the softened probabilities of the teacher (weighted by 1 - alpha). Since the
+    outputs of the teacher for each center never change, they are computed the first time that center is sampled
+    and then cached (float16, one row per center of the index).
+    The rest of the parameters are the same as load_patch_batch_train.
+    """
+    image_list = [load_norm_list(patient) for patient in image_names] if preload else image_names
+    patients = [str(patient[0]) for patient in image_names]
+    n_classes = teacher.output_shape[teacher_head][-1] if isinstance(teacher.output_shape, list)\
+        else teacher.output_shape[-1]
+    n_centers = count_centers(centers)
+    cache = np.zeros((n_centers, n_classes), dtype=np.float16)
+    cached = np.zeros(n_centers, dtype=np.bool)
+    while True:
+        # Same sampling as load_patch_batch_generator_train, but we keep the position of each center.
+        batch_indices = sample_center_positions(centers, -(-n_centers / dfactor))
+        for i in range(0, len(batch_indices), batch_size):
+            indices = batch_indices[i:i + batch_size]
+            x, y = get_xy(
+                image_list, label_names, index_centers(centers, indices), size, None, nlabels, preload, True, iseg,
+                False, np.float32, patients=patients
+            )
+            missing = np.logical_not(cached[indices])
+            if missing.any():
+                with stage('teacher_predict'):
+                    y_teacher = teacher.predict_on_batch(x[missing])
+                y_teacher = y_teacher[teacher_head] if isinstance(y_teacher, list) else y_teacher
+                cache[indices[missing]] = y_teacher
+                cached[indices[missing]] = True
+            y[-1] = alpha * y[-1] + (1 - alpha) * soften(cache[indices].astype(np.float32), temperature)
+            yield x, y
+
+
+def main():
+    from keras.models import load_model
+    options = parse_inputs()
+    c = color_codes()
+    if options['trace'] is not None:
+        enable_trace(options['trace'], rss_interval=options['trace_rss'])
+
+    batch_size = options['batch_size']
+    iseg = options['dataset'] == 'iseg'
+    teacher = load_model(options['teacher'])
+    patch_size = tuple(teacher.input_shape[2:])
+    student_config = get_configuration(options['student'], {
+        'patch_width': patch_size[0],
+        'conv_blocks': options['conv_blocks'],
+        'n_filters': options['n_filters'],
+        'conv_width': options['conv_width'],
+        'dense_size': options['dense_size'],
+    })
+    student = build_network(student_config)
+    nlabels = student.output_shape[-1][-1]
+    teacher_head = options['teacher_head'] if options['teacher_head'] is not None\
+        else get_teacher_head(teacher, nlabels)
+    output = options['output'] if options['output'] is not None\
+        else options['teacher'].rsplit('.', 1)[0] + '.student.%s.c%d.n%d.mdl' % (
+            options['student'], options['conv_blocks'], options['n_filters']
+        )
+
+    _, image_names, label_names = get_dataset_names(options)
+    # Held-out cases are taken from the end of the list.
+    n_test = options['test_cases']
+    train_names, train_labels = (image_names[:-n_test], label_names[:-n_test]) if n_test > 0\
+        else (image_names, label_names)
+    test_names, test_labels = (image_names[-n_test:], label_names[-n_test:]) if n_test > 0 else ([], [])
+    centers = get_center_index(train_names[:, 0], train_labels)
+    steps = -(-count_centers(centers) / options['dfactor'] / batch_size)
+
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Distilling ' + c['b'] + options['teacher'] +
+          c['nc'] + c['g'] + ' (%d parameters, output %d) into ' % (teacher.count_params(), teacher_head) +
+          c['b'] + options['student'] + c['nc'] + c['g'] + ' (%d parameters)' % student.count_params() + c['nc'])
+    with stage('fit', net='student'):
+        student.fit_generator(
+            generator=load_distillation_batch_train(
+                teacher=teacher,
+                teacher_head=teacher_head,
+                image_names=train_names,
+                label_names=train_labels,
+                centers=centers,
+                batch_size=batch_size,
+                size=patch_size,
+                nlabels=nlabels,
+                dfactor=options['dfactor'],
+                alpha=options['alpha'],
+                temperature=options['temperature'],
+                preload=options['preload'],
+                iseg=iseg
+            ),
+            steps_per_epoch=steps,
+            max_q_size=options['queue'],
+            epochs=options['epochs']
+        )
+    student.save(output)
+    print(c['g'] + '    Saved ' + c['b'] + output + c['nc'])
+
+    teacher_throughput = measure_throughput(teacher, batch_size)
+    student_throughput = measure_throughput(student, batch_size)
+    print_table(['net', 'params', 'test (smp/s)', 'speedup'], [
+        ['teacher', '%d' % teacher.count_params(), '%.1f' % teacher_throughput, '1.00'],
+        ['student', '%d' % student.count_params(), '%.1f' % student_throughput,
+         '%.2f' % (student_throughput / teacher_throughput)],
+    ])
+
+    if len(test_names) > 0:
+        print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Testing on ' + c['b'] + '%d' % len(test_names) +
+              c['nc'] + c['g'] + ' held-out cases' + c['nc'])
+        rows, times = compare_nets(
+            [teacher, student], test_names, test_labels, batch_size, patch_size, heads=[teacher_head, -1],
+            label_values=[0, 10, 150, 250] if iseg else None
+        )
+        print_table(['case', 'label', 'DSC student/teacher', 'DSC teacher', 'DSC student'], rows)
+        print(c['g'] + '    Testing time: teacher = %.1fs, student = %.1fs (%.2fx)' %
+              (times[0], times[1], times[0] / times[1]) + c['nc'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+from __future__ import print_function
+import argparse
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import strftime, sleep
+import numpy as np
+from utils import color_codes
+from data_creation import open_store, get_brain_crop, get_center_index
+from benchmark import print_table
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    # Unknown parameters are passed to the training script.
+    parser = argparse.ArgumentParser(description='Run the cross-validation folds of a training script in parallel.')
+    parser.add_argument('script', choices=['brats', 'iseg'])
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=2)
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=4)
+    parser.add_argument('--no-convert', action='store_false', dest='convert', default=True)
+    options, script_args = parser.parse_known_args()
+    return vars(options), script_args
+
+
+def get_script(name):
+    # Training script (module) of each dataset.
+    import train_test_brats2017
+    import train_test_iseg
+    return train_test_brats2017 if name == 'brats' else train_test_iseg
+
+
+def get_script_options(script, script_args):
+    # The options of the training script are parsed with its own parser, so the defaults are the same ones each
+    # fold will use.
+    argv = sys.argv
+    sys.argv = [script.__file__] + script_args
+    try:
+        return script.parse_inputs()
+    finally:
+        sys.argv = argv
+
+
+def convert_args(name, script_options, store_name, jobs):
+    # The suffixes of the training script are passed to convert_dataset, so the store has the same images.
+    dataset = 'brats' if name == 'brats' else 'iseg'
+    modalities = ['flair', 't1', 't1ce', 't2'] if name == 'brats' else ['t1', 't2']
+    args = ['-f', script_options['dir_name'], '-d', dataset, '-o', store_name, '-j', '%d' % jobs]
+    for m in modalities + ['labels']:
+        args += ['--' + m, script_options[m]]
+    return args
+
+
+def prepare_store(name, script_options, script_args, convert, jobs):
+    """
+    Function to share the normalized volumes through a store (see convert_dataset.py), which every process
+    opens read-only. If the training script has no store, the dataset is converted first (unless convert is False).
+    :param name: Name of the dataset ('brats' or 'iseg').
+    :param script_options: Options of the training script (updated with the new store).
+    :param script_args: Arguments of the training script.
+    :param convert: Whether to convert the dataset when there is no store.
+    :param jobs: Number of processes for the conversion.
+    :return: Arguments of the training script (with the new store).
+    """
+    c = color_codes()
+    if script_options['store'] is None and convert:
+        store_name = os.path.join(script_options['dir_name'], name + '.h5')
+        print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Converting the dataset into ' +
+              c['b'] + store_name + c['nc'])
+        sys.stdout.flush()
+        convert_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert_dataset.py')
+        subprocess.check_call([sys.executable, convert_name] + convert_args(name, script_options, store_name, jobs))
+        script_args = script_args + ['--store', store_name]
+        script_options['store'] = store_name
+    if script_options['store'] is not None:
+        open_store(script_options['store'])
+    return script_args
+
+
+def prepare_patients(name, script, script_options):
+    """
+    Function to compute the per-patient artifacts every fold needs (brain crops and training centers), so that
+    they are computed once instead of once per fold. Both are cached on disk (next to the images), and the fold
+    processes only read them.
+    :param name: Name of the dataset ('brats' or 'iseg').
+    :param script: Training script module.
+    :param script_options: Options of the training script.
+    :return: Number of folds.
+    """
+    data_names, label_names = script.get_names_from_path(script_options)
+    patch_width = script_options['patch_width']
+    crops = [get_brain_crop(p[0], patch_width / 2) for p in data_names] if script_options['crop'] else None
+    get_center_index(
+        data_names[:, 0], label_names, balanced=script_options.get('balanced', True), crops=crops, cache=True
+    )
+    return script_options['folds'] if name == 'brats' else len(data_names)
+
+
+def run_processes(commands, names, log_names, jobs, threads):
+    """
+    Function to run a list of commands on their own processes. At most jobs processes run at the same time, and
+    each one is limited to threads threads (OpenMP and BLAS).
+    :param commands: List of commands (lists of arguments).
+    :param names: Name of each command (for the progress messages).
+    :param log_names: File for the output of each command.
+    :param jobs: Number of concurrent processes.
+    :param threads: Number of threads per process.
+    :return: List with the exit code of each command.
+    """
+    c = color_codes()
+    env = dict(os.environ)
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[var] = '%d' % threads
+    pending = range(len(commands))
+    running = dict()
+    codes = [None] * len(commands)
+    while pending or running:
+        while pending and len(running) < jobs:
+            i = pending.pop(0)
+            log = open(log_names[i], 'w')
+            running[i] = (subprocess.Popen(commands[i], stdout=log, stderr=subprocess.STDOUT, env=env), log)
+            print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['b'] + names[i] + c['nc'] + c['g'] +
+                  ' started (log: ' + c['b'] + log_names[i] + c['nc'] + c['g'] + ')' + c['nc'])
+            sys.stdout.flush()
+        sleep(1)
+        for i, (process, log) in running.items():
+            if process.poll() is not None:
+                log.close()
+                codes[i] = process.returncode
+                del running[i]
+                status = c['g'] + ' finished' if codes[i] == 0 else c['r'] + ' failed (%d)' % codes[i]
+                print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['b'] + names[i] + c['nc'] + status + c['nc'])
+                sys.stdout.flush()
+    return codes
+
+
+def run_folds(script, script_args, folds, jobs, threads, dsc_path, log_path):
+    # Each fold runs the training script with --fold and writes its DSC results on dsc_path.
+    script_name = script.__file__.rsplit('.', 1)[0] + '.py'
+    log_prefix = os.path.join(log_path, os.path.basename(script_name)[:-len('py')])
+    commands = [
+        [sys.executable, script_name] + script_args + [
+            '--fold', '%d' % i, '--dsc-output', os.path.join(dsc_path, 'fold%d.pkl' % i), '--center-cache'
+        ]
+        for i in range(folds)
+    ]
+    names = ['Fold %d' % (i + 1) for i in range(folds)]
+    log_names = [log_prefix + 'fold%d.log' % i for i in range(folds)]
+    return run_processes(commands, names, log_names, jobs, threads)
+
+
+def main():
+    options, script_args = parse_inputs()
+    c = color_codes()
+    name = options['script']
+    script = get_script(name)
+    script_options = get_script_options(script, script_args)
+    path = script_options['dir_name']
+    jobs = options['jobs']
+    threads = options['threads']
+
+    script_args = prepare_store(name, script_options, script_args, options['convert'], jobs * threads)
+
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Preparing the patients' + c['nc'])
+    sys.stdout.flush()
+    folds = prepare_patients(name, script, script_options)
+
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Running ' + c['b'] + '%d' % folds + c['nc'] +
+          c['g'] + ' folds (' + c['b'] + '%d' % jobs + c['nc'] + c['g'] + ' at a time, ' + c['b'] +
+          '%d' % threads + c['nc'] + c['g'] + ' threads each)' + c['nc'])
+    dsc_path = tempfile.mkdtemp(prefix='folds')
+    try:
+        codes = run_folds(script, script_args, folds, jobs, threads, dsc_path, path)
+        dsc_results = list()
+        for i in range(folds):
+            dsc_name = os.path.join(dsc_path, 'fold%d.pkl' % i)
+            if os.path.isfile(dsc_name):
+                dsc_results += pickle.load(open(dsc_name, 'rb'))
+    finally:
+        shutil.rmtree(dsc_path)
+
+    # Final summary with the DSC of every tested patient (folds whose results were already there do not test
+    # their patients again, so they have no results).
+    if dsc_results:
+        dsc_results = sorted(dsc_results, key=lambda results: results[0])
+        n_labels = max(len(results) for results in dsc_results) - 1
+        rows = [[results[0]] + ['%f' % dsc for dsc in results[1:]] for results in dsc_results]
+        means = [np.mean([results[l + 1] for results in dsc_results if len(results) > l + 1]) for l in range(n_labels)]
+        print_table(
+            ['patient'] + ['DSC %d' % (l + 1) for l in range(n_labels)],
+            rows + [['mean'] + ['%f' % dsc for dsc in means]]
+        )
+    failed = [i + 1 for i, code in enumerate(codes) if code != 0]
+    if failed:
+        print(c['r'] + 'Failed folds: ' + ', '.join(['%d' % i for i in failed]) + c['nc'])
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
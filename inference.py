@@ -0,0 +1,230 @@
+from __future__ import print_function
+import os
+import sys
+from threading import Thread
+from time import time
+from Queue import Queue
+import numpy as np
+from numpy.lib.format import open_memmap
+from data_creation import load_patch_batch_generator_test, sort_centers, crop_centers, uncrop_volume, load_image
+from data_manipulation.generate_features import get_mask_voxels
+from data_manipulation.metrics import dsc_seg
+from instrumentation import stage
+
+
+def prefetch(generator, steps, queue_size=10):
+    # Same idea as the queue of Keras' predict_generator: a thread keeps loading batches while we predict.
+    queue = Queue(maxsize=queue_size)
+
+    def producer():
+        try:
+            for _ in range(steps):
+                queue.put(next(generator))
+        except Exception as e:
+            queue.put(e)
+
+    thread = Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+    for _ in range(steps):
+        item = queue.get()
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def get_heads(net, heads=None):
+    # Outputs are referenced as list indices (negative ones included) to avoid depending on layer names.
+    n_outputs = len(net.outputs)
+    return [h % n_outputs for h in heads] if heads is not None else range(n_outputs)
+
+
+def predict_to_volume(
+        net,
+        image_names,
+        centers,
+        batch_size,
+        patch_size,
+        shape,
+        heads=None,
+        preload=True,
+        queue=10,
+        probabilities=None,
+        order='raster',
+        subvolume=False,
+        crop=None,
+):
+    """
+    Function to test a net over a list of centers without keeping the predictions of the whole case in memory.
+    Each batch is predicted and its argmax is written directly into a label volume (one per output head).
+    :param net: Keras model. Outputs should be (n_samples, n_classes) arrays.
+    :param image_names: Image names for that patient (one per channel).
+    :param centers: List of voxel coordinates to test.
+    :param batch_size: Number of patches per batch.
+    :param patch_size: Size of the patches.
+    :param shape: Shape of the output volumes.
+    :param heads: Indices of the outputs we want to keep (all of them by default).
+    :param preload: Whether to preload the images before patch extraction.
+    :param queue: Number of batches that are loaded in advance.
+    :param probabilities: If given, the float16 probabilities of each head are also written to a memory-mapped
+     .npy file (probabilities + '.%d.npy' % head) with shape (shape + (n_classes,)).
+    :param order: Order of the centers for testing ('raster' or 'morton'). With 'morton' each batch covers a
+     compact 3D block of the image.
+    :param subvolume: Whether to extract the patches of each batch from the block of the image that contains them.
+    :param crop: Brain crop of the patient (from get_brain_crop). The images are cropped before patch extraction,
+     while the centers and the output volumes keep the coordinates of the whole image (the label volumes are
+     kept cropped while testing and padded back at the end).
+    :return: List of uint8 label volumes (one per head).
+    """
+    return predict_models_to_volume(
+        [net],
+        image_names,
+        centers,
+        batch_size,
+        patch_size,
+        shape,
+        heads=heads,
+        preload=preload,
+        queue=queue,
+        probabilities=probabilities,
+        order=order,
+        subvolume=subvolume,
+        crop=crop
+    )[0]
+
+
+def predict_models_to_volume(
+        nets,
+        image_names,
+        centers,
+        batch_size,
+        patch_size,
+        shape,
+        heads=None,
+        ensemble=False,
+        preload=True,
+        queue=10,
+        probabilities=None,
+        order='raster',
+        subvolume=False,
+        crop=None,
+        lock=None,
+):
+    """
+    Function to test a list of nets on the same patient. Each batch of patches is extracted only once and then
+    fed to all the nets, so the cost of patch extraction and normalization is paid once per case.
+    :param nets: List of Keras models. Each element can also be a list of models (with the same outputs) whose
+     probabilities are averaged as an ensemble.
+    :param ensemble: Whether to average all the nets as a single ensemble (the same as passing [nets]).
+    :param probabilities: If given, the float16 probabilities of each net and head are also written to a
+     memory-mapped .npy file (probabilities + '.%d.npy' % head if there is only one net or
+     probabilities + '.m%d.%d.npy' % (net, head) otherwise) with shape (shape + (n_classes,)).
+    :param lock: Lock to hold while predicting. Compiled functions can't be called from several threads at once,
+     so cases that are tested concurrently with the same nets should share it.
+    The rest of parameters are the same as predict_to_volume.
+    :return: List (one per net or ensemble) of lists of uint8 label volumes (one per head).
+    """
+    groups = [nets] if ensemble else [g if isinstance(g, list) else [g] for g in nets]
+    group_heads = [get_heads(g[0], heads) for g in groups]
+    volume_shape = shape if crop is None else tuple(crop[:, 1] - crop[:, 0])
+    volumes = [dict((h, np.zeros(volume_shape, dtype=np.uint8)) for h in set(g_heads)) for g_heads in group_heads]
+    probs = list()
+    for i, (g, g_heads) in enumerate(zip(groups, group_heads)):
+        output_shapes = g[0].output_shape if isinstance(g[0].output_shape, list) else [g[0].output_shape]
+        prob_names = ['.%d.npy' % h if len(groups) == 1 else '.m%d.%d.npy' % (i, h) for h in g_heads]
+        probs.append(dict(
+            (h, open_memmap(
+                probabilities + name, mode='w+', dtype=np.float16, shape=tuple(shape) + (output_shapes[h][-1],)
+            )) for h, name in zip(g_heads, prob_names)
+        ) if probabilities is not None else dict())
+
+    centers = sort_centers(centers, order)
+    cropped_centers = crop_centers(centers, crop)
+    n_centers = len(centers)
+    steps = -(-n_centers / batch_size)
+    generator = load_patch_batch_generator_test(
+        image_names=image_names,
+        centers=cropped_centers,
+        batch_size=batch_size,
+        size=patch_size,
+        preload=preload,
+        subvolume=subvolume,
+        crop=crop
+    )
+    for i, x in enumerate(prefetch(generator, steps, queue)):
+        batch_idx = tuple(np.stack(centers[i * batch_size:(i + 1) * batch_size], axis=1))
+        volume_idx = tuple(np.stack(cropped_centers[i * batch_size:(i + 1) * batch_size], axis=1))
+        for g, g_volumes, g_probs in zip(groups, volumes, probs):
+            y_pr_pred = None
+            for net in g:
+                with stage('predict_batch'):
+                    if lock is not None:
+                        with lock:
+                            y_net = net.predict_on_batch(x)
+                    else:
+                        y_net = net.predict_on_batch(x)
+                y_net = y_net if isinstance(y_net, list) else [y_net]
+                y_pr_pred = y_net if y_pr_pred is None else [y + y_n for y, y_n in zip(y_pr_pred, y_net)]
+            for h in g_volumes:
+                g_volumes[h][volume_idx] = np.argmax(y_pr_pred[h], axis=1)
+                if h in g_probs:
+                    g_probs[h][batch_idx] = y_pr_pred[h] / len(g)
+    print(' '.join([''] * 50), end='\r')
+    sys.stdout.flush()
+
+    for g_probs in probs:
+        for p in g_probs.values():
+            p.flush()
+
+    return [
+        [uncrop_volume(g_volumes[h], crop, shape) for h in g_heads] for g_volumes, g_heads in zip(volumes, group_heads)
+    ]
+
+
+def measure_throughput(net, batch_size, steps=5):
+    # Patches per second on random batches (the first call is not measured, it allocates memory).
+    x = np.random.normal(size=(batch_size,) + tuple(net.input_shape[1:])).astype(np.float32)
+    net.predict_on_batch(x)
+    init = time()
+    for _ in range(steps):
+        net.predict_on_batch(x)
+    return steps * batch_size / (time() - init)
+
+
+def compare_nets(nets, image_names, label_names, batch_size, patch_size, heads=None, label_values=None):
+    """
+    Function to compare the segmentations of several nets (usually a net and its compressed versions) on a list
+    of cases. Each net tests the whole brain of each case on its own, so their testing times can be compared.
+    :param nets: List of nets. The first one is the reference.
+    :param image_names: Image names of each case.
+    :param label_names: Label names of each case (the ones that don't exist are skipped).
+    :param heads: Output of each net that we compare (the last one by default).
+    :param label_values: Value of each class (index) on the ground truth (like [0, 10, 150, 250] for iSeg). By
+     default, the class index is the label value (BraTS nets are trained on the raw labels 0/1/2/4).
+    :return: Table rows (case, label, DSC of every other net against the reference and DSC of every net against
+     the ground truth) and the testing time of each net.
+    """
+    heads = [-1] * len(nets) if heads is None else heads
+    rows = list()
+    times = [0.0] * len(nets)
+    for p, gt_name in zip(image_names, label_names):
+        p_name = p[0].rsplit('/')[-2]
+        brain = load_image(p[0]).get_data().astype(dtype=np.bool)
+        centers = get_mask_voxels(brain)
+        segmentations = list()
+        for i, (net, head) in enumerate(zip(nets, heads)):
+            init = time()
+            segmentations.append(
+                predict_to_volume(net, p, centers, batch_size, patch_size, brain.shape, heads=[head])[0]
+            )
+            times[i] += time() - init
+        gt = load_image(gt_name).get_data() if os.path.isfile(gt_name) else None
+        for l in np.unique(segmentations[0])[1:]:
+            row = [p_name, '%d' % l] + ['%.4f' % dsc_seg(segmentations[0] == l, s == l) for s in segmentations[1:]]
+            if gt is not None and (label_values is None or l < len(label_values)):
+                value = l if label_values is None else label_values[l]
+                row += ['%.4f' % dsc_seg(gt == value, s == l) for s in segmentations]
+            else:
+                row += ['-'] * len(nets)
+            rows.append(row)
+    return rows, times
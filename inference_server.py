@@ -0,0 +1,274 @@
+from __future__ import print_function
+import argparse
+import glob
+import json
+import os
+import socket
+import sys
+import traceback
+from threading import Thread, Lock
+from Queue import Queue
+from SocketServer import ThreadingUnixStreamServer, StreamRequestHandler
+from time import strftime, sleep, time
+import numpy as np
+from utils import color_codes, get_biggest_region
+from instrumentation import stage, enable_trace
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    parser = argparse.ArgumentParser(description='Segmentation service that keeps the nets loaded and compiled.')
+    parser.add_argument('-m', '--models', dest='models', nargs='+', default=[])
+    parser.add_argument('-s', '--socket', dest='socket', default=None)
+    parser.add_argument('-S', '--spool', dest='spool', default=None)
+    parser.add_argument('-j', '--cases', dest='cases', type=int, default=2)
+    parser.add_argument('-i', '--patch-width', dest='patch_width', type=int, default=13)
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=2048)
+    parser.add_argument('-q', '--queue', action='store', dest='queue', type=int, default=10)
+    parser.add_argument('--morton', action='store_true', dest='morton', default=False)
+    parser.add_argument('--crop', action='store_true', dest='crop', default=False)
+    parser.add_argument('--poll', dest='poll', type=float, default=1.0)
+    parser.add_argument('--submit', dest='submit', nargs='+', default=None)
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    parser.add_argument('--trace', action='store', dest='trace', default=None)
+    parser.add_argument('--trace-rss', action='store', dest='trace_rss', type=float, default=None)
+    options = vars(parser.parse_args())
+    # Submitting a job needs the socket of the server and the name of the output segmentation.
+    if options['submit'] is not None and (options['socket'] is None or options['output'] is None):
+        parser.error('--submit requires the socket (-s) and the output segmentation (-o)')
+    return options
+
+
+def load_models(model_names):
+    # Models are loaded and their predict functions compiled only once. With tensorflow, the graph has to be
+    # the default one on every thread that predicts, so we also return it. Exported nets (.npz) run on the numpy
+    # engine, and if all of them are exported, Keras is not even imported.
+    nets = list()
+    graph = None
+    for name in model_names:
+        with stage('load_model', model=name):
+            if name.endswith('.npz'):
+                from numpy_net import load_network
+                net = load_network(name)
+            else:
+                import keras
+                import keras.backend as K
+                net = keras.models.load_model(name)
+                net._make_predict_function()
+                if K.backend() == 'tensorflow':
+                    import tensorflow
+                    graph = tensorflow.get_default_graph()
+        nets.append(net)
+    return nets, graph
+
+
+def warm_up(nets, input_shape, batch_size):
+    # The first call of each function is still slower (memory allocation, autotuning), so we pay it at startup.
+    x = np.zeros((batch_size,) + input_shape, dtype=np.float32)
+    for net in nets:
+        net.predict_on_batch(x)
+
+
+class Server(object):
+    """
+    Segmentation service. Jobs are dictionaries with the image names of a patient (one per channel, in the
+    order the nets expect them) and the name of the output segmentation:
+        {"images": ["flair.nii.gz", "t2.nii.gz", "t1.nii.gz", "t1ce.nii.gz"], "output": "seg.nii.gz"}
+    The configured nets are averaged as an ensemble. Each case goes through three stages that run on their
+    own threads: prediction (with the batches of patches prefetched), post-processing and saving. The number
+    of cases being predicted at the same time is configurable.
+    """
+
+    def __init__(self, nets, graph, options):
+        self.nets = nets
+        self.graph = graph
+        self.options = options
+        self.jobs = Queue()
+        self.results = Queue()
+        # Cases are predicted concurrently (overlapping their loading and patch extraction), but the calls to
+        # the compiled functions are serialized.
+        self.lock = Lock()
+        self.workers = [Thread(target=self.predict_worker) for _ in range(options['cases'])]
+        self.workers.append(Thread(target=self.save_worker))
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, job, callback):
+        job['submitted'] = time()
+        self.jobs.put((job, callback))
+
+    def predict_worker(self):
+        from data_creation import load_image, get_brain_crop
+        while True:
+            job, callback = self.jobs.get()
+            try:
+                images = job['images']
+                roi_nii = load_image(images[0])
+                brain = roi_nii.get_data().astype(dtype=np.bool)
+                crop = get_brain_crop(images[0], self.options['patch_width'] / 2) if self.options['crop'] else None
+                with stage('predict', patient=job['output']):
+                    if self.graph is not None:
+                        with self.graph.as_default():
+                            tumor, image = self.predict(images, brain, crop)
+                    else:
+                        tumor, image = self.predict(images, brain, crop)
+                job['predicted'] = time()
+                self.results.put((job, callback, roi_nii, tumor, image))
+            except Exception as e:
+                traceback.print_exc()
+                callback(job, error=repr(e))
+
+    def predict(self, images, brain, crop):
+        from inference import predict_models_to_volume
+        from data_manipulation.generate_features import get_mask_voxels
+        order = 'morton' if self.options['morton'] else 'raster'
+        return predict_models_to_volume(
+            [self.nets],
+            images,
+            get_mask_voxels(brain),
+            self.options['batch_size'],
+            (self.options['patch_width'],) * 3,
+            brain.shape,
+            heads=[0, -1],
+            queue=self.options['queue'],
+            order=order,
+            subvolume=order == 'morton',
+            crop=crop,
+            lock=self.lock
+        )[0]
+
+    def save_worker(self):
+        # Post-processing and saving are done here, so the GPU can start with the next case right away.
+        while True:
+            job, callback, roi_nii, tumor, image = self.results.get()
+            try:
+                is_roi = len(self.nets[0].outputs) == 1
+                image = tumor if is_roi else image
+                with stage('post_processing', patient=job['output']):
+                    image = get_biggest_region(image, is_roi)
+                roi_nii.get_data()[:] = image
+                with stage('nifti_save', image=job['output']):
+                    roi_nii.to_filename(job['output'])
+                job['finished'] = time()
+                callback(job)
+            except Exception as e:
+                traceback.print_exc()
+                callback(job, error=repr(e))
+
+
+class JobHandler(StreamRequestHandler):
+    # One job per line (JSON). The answer (another JSON line) is sent once the segmentation is on disk.
+    # Malformed lines (or jobs without an output) are answered with an error, and the connection is kept open.
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict) or 'output' not in job:
+                    raise ValueError('Jobs should be JSON objects with an output')
+            except ValueError as e:
+                self.answer({'output': None, 'error': repr(e)})
+                continue
+            done = Queue()
+            self.server.service.submit(job, lambda job, error=None: done.put((job, error)))
+            job, error = done.get()
+            answer = {'output': job['output'], 'error': error}
+            if error is None:
+                answer['time'] = job['finished'] - job['submitted']
+            self.answer(answer)
+
+    def answer(self, answer):
+        self.wfile.write(json.dumps(answer) + '\n')
+        self.wfile.flush()
+
+
+def serve_socket(service, socket_name):
+    if os.path.exists(socket_name):
+        os.remove(socket_name)
+    server = ThreadingUnixStreamServer(socket_name, JobHandler)
+    server.daemon_threads = True
+    server.service = service
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def spool_callback(name):
+    # Spool jobs are renamed to .done or .failed (with the timing or the error) when they finish.
+    def callback(job, error=None):
+        job['error'] = error
+        json.dump(job, open(name, 'w'))
+        os.rename(name, name.rsplit('.', 1)[0] + ('.failed' if error is not None else '.done'))
+    return callback
+
+
+def watch_spool(service, spool, poll):
+    # Jobs are .json files on the spool folder. To claim them we rename them (atomic on the same filesystem),
+    # so several servers can share the same spool folder.
+    while True:
+        for name in sorted(glob.glob(os.path.join(spool, '*.json'))):
+            running = name[:-len('.json')] + '.running'
+            try:
+                os.rename(name, running)
+            except OSError:
+                continue
+            try:
+                job = json.load(open(running))
+            except ValueError as e:
+                spool_callback(running)({'file': name}, error=repr(e))
+                continue
+            service.submit(job, spool_callback(running))
+        sleep(poll)
+
+
+def submit_job(socket_name, images, output):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_name)
+    stream = client.makefile('rw')
+    stream.write(json.dumps({'images': images, 'output': output}) + '\n')
+    stream.flush()
+    answer = json.loads(stream.readline())
+    client.close()
+    return answer
+
+
+def main():
+    options = parse_inputs()
+    c = color_codes()
+
+    if options['submit'] is not None:
+        answer = submit_job(options['socket'], [os.path.abspath(name) for name in options['submit']],
+                            os.path.abspath(options['output']))
+        if answer['error'] is not None:
+            print(c['r'] + answer['error'] + c['nc'])
+            sys.exit(1)
+        print(c['g'] + 'Segmentation saved on ' + c['b'] + answer['output'] + c['nc'] + c['g'] +
+              ' (%.2fs)' % answer['time'] + c['nc'])
+        return
+
+    if options['trace'] is not None:
+        enable_trace(options['trace'], rss_interval=options['trace_rss'])
+
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Loading ' + c['b'] + '%d' % len(options['models']) +
+          c['nc'] + c['g'] + ' model(s)' + c['nc'])
+    nets, graph = load_models(options['models'])
+    input_shape = nets[0].input_shape[1:]
+    warm_up(nets, input_shape, options['batch_size'])
+
+    service = Server(nets, graph, options)
+    if options['socket'] is not None:
+        serve_socket(service, options['socket'])
+        print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Listening on ' + c['b'] + options['socket'] +
+              c['nc'])
+    if options['spool'] is not None:
+        print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Watching ' + c['b'] + options['spool'] +
+              c['nc'])
+        watch_spool(service, options['spool'], options['poll'])
+    else:
+        while True:
+            sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+from __future__ import print_function
+import atexit
+import json
+import os
+import resource
+import threading
+from time import time
+
+
+# Global state of the tracer. Everything is a no-op until enable_trace is called, so the stages can stay on the
+# hot paths without slowing down normal runs.
+_trace = {
+    'file': None,
+    'chrome': None,
+    'events': list(),
+    'lock': threading.Lock(),
+    'sampler': None,
+}
+
+
+def get_rss():
+    # Resident set size in megabytes. We read /proc when we can (current value) and fall back to the peak value
+    # given by getrusage otherwise.
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.readline().split()[1])
+        return pages * resource.getpagesize() / 1048576.0
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _write_event(event):
+    with _trace['lock']:
+        if _trace['file'] is not None:
+            _trace['file'].write(json.dumps(event) + '\n')
+            _trace['file'].flush()
+        if _trace['chrome'] is not None:
+            _trace['events'].append(event)
+
+
+def _rss_sampler(interval, stop):
+    while not stop.wait(interval):
+        _write_event({'stage': 'rss', 'ph': 'C', 'start': time(), 'rss': get_rss(), 'pid': os.getpid()})
+
+
+def enable_trace(filename, chrome=True, rss_interval=None):
+    """
+    Function to start tracing the stages of a run. Every stage is written as a JSON line on filename
+    and (if chrome is True) also kept to write a Chrome trace (filename + '.chrome.json') when the
+    process exits. If rss_interval is given, the RSS is also sampled every rss_interval seconds.
+    """
+    disable_trace()
+    _trace['file'] = open(filename, 'w')
+    _trace['chrome'] = os.path.splitext(filename)[0] + '.chrome.json' if chrome else None
+    _trace['events'] = list()
+    if rss_interval:
+        stop = threading.Event()
+        sampler = threading.Thread(target=_rss_sampler, args=(rss_interval, stop))
+        sampler.daemon = True
+        sampler.start()
+        _trace['sampler'] = stop
+
+
+def disable_trace():
+    if _trace['sampler'] is not None:
+        _trace['sampler'].set()
+        _trace['sampler'] = None
+    if _trace['chrome'] is not None:
+        write_chrome_trace(_trace['chrome'], _trace['events'])
+        _trace['chrome'] = None
+    if _trace['file'] is not None:
+        _trace['file'].close()
+        _trace['file'] = None
+
+
+def tracing():
+    return _trace['file'] is not None
+
+
+def write_chrome_trace(filename, events):
+    # Chrome (chrome://tracing) expects complete events (X) and counters (C) with timestamps in microseconds.
+    trace_events = list()
+    for e in events:
+        if e['ph'] == 'C':
+            trace_events.append({
+                'name': 'rss (MB)', 'ph': 'C', 'ts': e['start'] * 1e6, 'pid': e['pid'], 'args': {'rss': e['rss']}
+            })
+        else:
+            trace_events.append({
+                'name': e['stage'], 'ph': 'X', 'ts': e['start'] * 1e6, 'dur': e['duration'] * 1e6,
+                'pid': e['pid'], 'tid': e['tid'], 'args': dict(e['args'], rss_start=e['rss_start'], rss_end=e['rss_end'])
+            })
+    json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, open(filename, 'w'))
+
+
+class stage(object):
+    """
+    Timer for a stage of the pipeline. It can be used as a context manager:
+        with stage('nifti_load', image=name):
+            ...
+    or as a decorator:
+        @stage('normalization')
+        def norm(image):
+            ...
+    Extra keyword arguments are stored with the event. Nothing is measured unless tracing is enabled.
+    """
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.args = kwargs
+        self.start = None
+        self.rss = None
+
+    def __enter__(self):
+        if tracing():
+            self.rss = get_rss()
+            self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.start is not None:
+            duration = time() - self.start
+            _write_event({
+                'stage': self.name,
+                'ph': 'X',
+                'start': self.start,
+                'duration': duration,
+                'rss_start': self.rss,
+                'rss_end': get_rss(),
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': self.args,
+            })
+            self.start = None
+        return False
+
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            with stage(self.name, **self.args):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+
+atexit.register(disable_trace)
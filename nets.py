@@ -1,7 +1,7 @@
 from keras import backend as K
 from keras.layers import Dense, Conv3D, Dropout, Flatten, Input, concatenate, Reshape, Lambda
 from keras.layers import BatchNormalization, LSTM, Permute, Activation, PReLU, Average
-from keras.models import Model
+from keras.models import Model, Sequential
 from itertools import product
 import numpy as np
 
@@ -260,3 +260,153 @@ def get_iseg_experimental4(input_shape, filters_list, kernel_size_list, dense_si
     outputs = [csf_out, gm_out, wm_out, brain, full_out]
 
     return compile_network(merged_inputs, outputs, weights)
+
+
+def get_brats_sequential(input_shape, filters_list, kernel_size_list, dense_size, nlabels=5):
+    # Sequential model that merges all 4 images. This architecture is just a set of convolutional blocks
+    # that end in a dense layer. This is supposed to be an original baseline.
+    net = Sequential()
+    net.add(Conv3D(
+        filters_list[0],
+        kernel_size=kernel_size_list[0],
+        input_shape=input_shape,
+        activation='relu',
+        data_format='channels_first'
+    ))
+    for filters, kernel_size in zip(filters_list[1:], kernel_size_list[1:]):
+        net.add(Dropout(0.5))
+        net.add(Conv3D(filters, kernel_size=kernel_size, activation='relu', data_format='channels_first'))
+    net.add(Dropout(0.5))
+    net.add(Flatten())
+    net.add(Dense(dense_size, activation='relu'))
+    net.add(Dropout(0.5))
+    net.add(Dense(nlabels, activation='softmax'))
+
+    net.compile(optimizer='adadelta', loss='categorical_crossentropy', metrics=['accuracy'])
+
+    return net
+
+
+def get_brats_multioutput(input_shape, filters_list, kernel_size_list, dense_size, nlabels=5, recurrent=False):
+    # This architecture is based on the functional Keras API to introduce 3 output paths:
+    # - Whole tumor segmentation
+    # - Core segmentation (including whole tumor)
+    # - Whole segmentation (tumor, core and enhancing parts)
+    # The idea is to let the network work on the three parts to improve the multiclass segmentation.
+    patch_size = input_shape[1:]
+    merged_inputs = Input(shape=(4,) + patch_size, name='merged_inputs')
+    flair = Reshape((1,) + patch_size)(
+        Lambda(
+            lambda l: l[:, 0, :, :, :],
+            output_shape=(1,) + patch_size)(merged_inputs),
+    )
+    t2 = Reshape((1,) + patch_size)(
+        Lambda(lambda l: l[:, 1, :, :, :], output_shape=(1,) + patch_size)(merged_inputs)
+    )
+    t1 = Lambda(lambda l: l[:, 2:, :, :, :], output_shape=(2,) + patch_size)(merged_inputs)
+    for filters, kernel_size in zip(filters_list, kernel_size_list):
+        flair = Conv3D(filters,
+                       kernel_size=kernel_size,
+                       activation='relu',
+                       data_format='channels_first'
+                       )(flair)
+        t2 = Conv3D(filters,
+                    kernel_size=kernel_size,
+                    activation='relu',
+                    data_format='channels_first'
+                    )(t2)
+        t1 = Conv3D(filters,
+                    kernel_size=kernel_size,
+                    activation='relu',
+                    data_format='channels_first'
+                    )(t1)
+        flair = Dropout(0.5)(flair)
+        t2 = Dropout(0.5)(t2)
+        t1 = Dropout(0.5)(t1)
+
+    # We only apply the RCNN to the multioutput approach (we keep the simple one, simple)
+    if recurrent:
+        flair = Conv3D(
+            dense_size,
+            kernel_size=(1, 1, 1),
+            activation='relu',
+            data_format='channels_first',
+            name='fcn_flair'
+        )(flair)
+        flair = Dropout(0.5)(flair)
+        t2 = concatenate([flair, t2], axis=1)
+        t2 = Conv3D(
+            dense_size,
+            kernel_size=(1, 1, 1),
+            activation='relu',
+            data_format='channels_first',
+            name='fcn_t2'
+        )(t2)
+        t2 = Dropout(0.5)(t2)
+        t1 = concatenate([t2, t1], axis=1)
+        t1 = Conv3D(
+            dense_size,
+            kernel_size=(1, 1, 1),
+            activation='relu',
+            data_format='channels_first',
+            name='fcn_t1'
+        )(t1)
+        t1 = Dropout(0.5)(t1)
+        flair = Dropout(0.5)(flair)
+        t2 = Dropout(0.5)(t2)
+        t1 = Dropout(0.5)(t1)
+        lstm_instance = LSTM(dense_size, implementation=1, name='rf_layer')
+        flair = lstm_instance(Permute((2, 1))(Reshape((dense_size, -1))(flair)))
+        t2 = lstm_instance(Permute((2, 1))(Reshape((dense_size, -1))(t2)))
+        t1 = lstm_instance(Permute((2, 1))(Reshape((dense_size, -1))(t1)))
+
+    else:
+        flair = Flatten()(flair)
+        t2 = Flatten()(t2)
+        t1 = Flatten()(t1)
+        flair = Dense(dense_size, activation='relu')(flair)
+        flair = Dropout(0.5)(flair)
+        t2 = concatenate([flair, t2])
+        t2 = Dense(dense_size, activation='relu')(t2)
+        t2 = Dropout(0.5)(t2)
+        t1 = concatenate([t2, t1])
+        t1 = Dense(dense_size, activation='relu')(t1)
+        t1 = Dropout(0.5)(t1)
+
+    tumor = Dense(2, activation='softmax', name='tumor')(flair)
+    core = Dense(3, activation='softmax', name='core')(t2)
+    enhancing = Dense(nlabels, activation='softmax', name='enhancing')(t1)
+
+    return compile_network(merged_inputs, [tumor, core, enhancing], None)
+
+
+def get_brats_fc(input_shape, filters_list, kernel_size_list, dense_size):
+    # Sequential model that merges all 4 images. This architecture is just a set of convolutional blocks
+    #  that end in a dense layer. This is supposed to be an original baseline.
+    inputs = Input(shape=input_shape, name='merged_inputs')
+    conv = inputs
+    for filters, kernel_size in zip(filters_list, kernel_size_list):
+        conv = Conv3D(filters, kernel_size=kernel_size, activation='relu', data_format='channels_first')(conv)
+        conv = Dropout(0.5)(conv)
+
+    full = Conv3D(dense_size, kernel_size=(1, 1, 1), data_format='channels_first')(conv)
+    full = PReLU()(full)
+    full = Conv3D(2, kernel_size=(1, 1, 1), data_format='channels_first')(full)
+
+    rf = concatenate([conv, full], axis=1)
+
+    while np.product(K.int_shape(rf)[2:]) > 1:
+        rf = Conv3D(dense_size, kernel_size=(3, 3, 3), data_format='channels_first')(rf)
+        rf = Dropout(0.5)(rf)
+
+    full = Reshape((2, -1))(full)
+    full = Permute((2, 1))(full)
+    full_out = Activation('softmax', name='fc_out')(full)
+
+    tumor = Dense(2, activation='softmax', name='tumor')(rf)
+
+    # Weights and outputs
+    weights = [0.8,   1.0]
+    outputs = [tumor, full_out]
+
+    return compile_network(inputs, outputs, weights)
@@ -0,0 +1,274 @@
+from __future__ import print_function
+import argparse
+import json
+from time import strftime, time
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+# The engine only needs numpy. Keras is only imported to export a model (or to check an exported one).
+# Each layer is a node of the graph with the name of its inputs, its configuration and its weights. Tensors
+# follow the Keras (channels first) layout, so the semantics of Flatten, Reshape or Permute are the same.
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    parser = argparse.ArgumentParser(description='Export a Keras patch network to a numpy inference file.')
+    parser.add_argument('model', help='Keras model (.mdl)')
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    parser.add_argument('-c', '--check', dest='check', type=int, default=32)
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float, default=1e-4)
+    return vars(parser.parse_args())
+
+
+def probe_lambda(layer):
+    # Lambda layers are arbitrary code, but the ones we use only select channels (the image modalities).
+    # We find out which ones by feeding each channel with its own index and then we check the result with
+    # a random input.
+    import keras.backend as K
+    function = K.function([layer.input], [layer.output])
+    input_shape = (1,) + tuple(layer.input_shape[1:])
+    probe = np.ones(input_shape, dtype=np.float32) * np.arange(1, input_shape[1] + 1).reshape((1, -1, 1, 1, 1))
+    output = function([probe])[0]
+    channels = output.reshape((output.shape[0], -1, np.prod(input_shape[2:])))[0, :, 0].astype(np.int) - 1
+    output_shape = tuple(layer.output_shape[1:])
+    x = np.random.normal(size=input_shape).astype(np.float32)
+    if not np.allclose(function([x])[0], x[:, channels].reshape((1,) + output_shape)):
+        raise NotImplementedError('Lambda layer %s is not a channel selection' % layer.name)
+    return {'channels': channels.tolist(), 'shape': list(output_shape)}
+
+
+def export_layer(layer, flip):
+    # Configuration and weights of each layer (only the parts the engine needs).
+    layer_type = type(layer).__name__
+    config = layer.get_config()
+    weights = layer.get_weights()
+    node = {'name': layer.name, 'type': layer_type}
+    if layer_type == 'Conv3D':
+        if config['padding'] != 'valid' or tuple(config['strides']) != (1, 1, 1):
+            raise NotImplementedError('Only valid and unstrided Conv3D layers are supported (%s)' % layer.name)
+        if config['data_format'] != 'channels_first':
+            raise NotImplementedError('Only channels first Conv3D layers are supported (%s)' % layer.name)
+        # Theano convolutions flip the kernel (true convolution), while the engine correlates.
+        kernel = weights[0][::-1, ::-1, ::-1] if flip else weights[0]
+        weights = [np.ascontiguousarray(kernel)] + weights[1:]
+        node['activation'] = config['activation']
+    elif layer_type == 'Dense':
+        node['activation'] = config['activation']
+    elif layer_type == 'Activation':
+        node['activation'] = config['activation']
+    elif layer_type == 'PReLU':
+        node['shared_axes'] = config['shared_axes']
+    elif layer_type == 'Reshape':
+        node['shape'] = list(config['target_shape'])
+    elif layer_type == 'Permute':
+        node['dims'] = list(config['dims'])
+    elif layer_type == 'Concatenate':
+        node['axis'] = config['axis']
+    elif layer_type == 'Lambda':
+        node.update(probe_lambda(layer))
+    elif layer_type not in ['InputLayer', 'Dropout', 'Flatten', 'Average']:
+        raise NotImplementedError('%s layers are not supported (%s)' % (layer_type, layer.name))
+    if len(layer.inbound_nodes) > 1:
+        raise NotImplementedError('Shared layers are not supported (%s)' % layer.name)
+    node['inputs'] = [l.name for l in layer.inbound_nodes[0].inbound_layers]
+    return node, weights
+
+
+def export_model(net, filename):
+    """
+    Function to export a Keras model (functional or sequential) to a numpy inference file (.npz). The file has
+    the graph of the model (as JSON) and the weights of each layer.
+    :param net: Keras model.
+    :param filename: Name of the exported file.
+    """
+    import keras.backend as K
+    # Sequential models keep the functional model inside (with the input layer).
+    model = net.model if hasattr(net, 'model') else net
+    nodes = list()
+    arrays = dict()
+    for layer in model.layers:
+        node, weights = export_layer(layer, K.backend() == 'theano')
+        node['weights'] = len(weights)
+        for i, w in enumerate(weights):
+            arrays['%s/%d' % (layer.name, i)] = w.astype(np.float32)
+        nodes.append(node)
+    graph = {
+        'nodes': nodes,
+        'inputs': [l.name for l in model.input_layers],
+        'outputs': [l.name for l in model.output_layers],
+        'input_shape': list(model.input_shape[1:]),
+        'output_shape': [list(s[1:]) for s in model.output_shape] if isinstance(model.output_shape, list)
+        else [list(model.output_shape[1:])],
+    }
+    np.savez(filename, graph=json.dumps(graph), **arrays)
+
+
+def activate(x, activation):
+    # Activations are applied in place on the output of the matrix products.
+    if activation == 'relu':
+        np.maximum(x, 0, out=x)
+    elif activation == 'softmax':
+        x -= x.max(axis=-1, keepdims=True)
+        np.exp(x, out=x)
+        x /= x.sum(axis=-1, keepdims=True)
+    elif activation == 'sigmoid':
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        x += 1
+        np.reciprocal(x, out=x)
+    elif activation == 'tanh':
+        np.tanh(x, out=x)
+    elif activation != 'linear':
+        raise NotImplementedError('Unknown activation %s' % activation)
+    return x
+
+
+def conv3d(x, kernel, bias, activation, max_elements=2 ** 26):
+    """
+    Valid 3D convolution as im2col + matrix product. The columns are a strided view of the input (channels last)
+    that is only copied when reshaped for the product. To bound memory, the batch is processed in chunks whose
+    columns have at most max_elements elements.
+    :param x: Input tensor (channels first).
+    :param kernel: Kernel with Keras layout (kx, ky, kz, input channels, filters).
+    :return: Output tensor (channels first). It's a view of a channels last array, so the next convolution
+     does not need to copy it.
+    """
+    kernel_size = kernel.shape[:3]
+    filters = kernel.shape[-1]
+    x = np.ascontiguousarray(np.moveaxis(x, 1, -1))
+    n, channels = x.shape[0], x.shape[-1]
+    out_size = tuple(s - k + 1 for s, k in zip(x.shape[1:4], kernel_size))
+    kernel = kernel.reshape((-1, filters))
+    strides = x.strides
+    y = np.empty((n,) + out_size + (filters,), dtype=np.float32)
+    n_cols = np.prod(out_size) * kernel.shape[0]
+    chunk = max(1, int(max_elements / n_cols))
+    for i in range(0, n, chunk):
+        x_i = x[i:i + chunk]
+        cols = as_strided(
+            x_i,
+            shape=(len(x_i),) + out_size + tuple(kernel_size) + (channels,),
+            strides=strides[:4] + strides[1:4] + strides[4:]
+        ).reshape((-1, kernel.shape[0]))
+        y_i = y[i:i + chunk].reshape((-1, filters))
+        np.dot(cols, kernel, out=y_i)
+        y_i += bias
+        activate(y_i, activation)
+    return np.moveaxis(y, -1, 1)
+
+
+def load_weights(data, node):
+    # Quantized layers (see quantize.py) keep an int8 kernel and the scale of each filter. Only the file is
+    # smaller: they are dequantized here, once, and then run on the same float32 path as the rest.
+    weights = [data['%s/%d' % (node['name'], i)] for i in range(node['weights'])]
+    if node.get('quantized'):
+        kernel, kernel_scale, bias = weights
+        weights = [kernel.astype(np.float32) * kernel_scale, bias]
+    return weights
+
+
+def prelu(x, alpha):
+    # Keras keeps an alpha per feature (unless shared), with the shape of the input without the batch axis.
+    return np.where(x > 0, x, x * alpha)
+
+
+class NumpyNet(object):
+    """
+    Inference engine for the exported nets. It mimics the parts of the Keras model interface we use for testing
+    (predict_on_batch, outputs, input_shape and output_shape), so it can be used on the same testing functions.
+    """
+
+    def __init__(self, filename):
+        data = np.load(filename)
+        graph = json.loads(str(data['graph']))
+        self.nodes = graph['nodes']
+        self.weights = dict((node['name'], load_weights(data, node)) for node in self.nodes)
+        self.inputs = graph['inputs']
+        self.outputs = graph['outputs']
+        self.input_shape = (None,) + tuple(graph['input_shape'])
+        output_shape = [(None,) + tuple(s) for s in graph['output_shape']]
+        self.output_shape = output_shape if len(output_shape) > 1 else output_shape[0]
+
+    def run_node(self, node, inputs):
+        layer_type = node['type']
+        weights = self.weights[node['name']]
+        x = inputs[0] if inputs else None
+        if layer_type == 'Conv3D':
+            bias = weights[1] if len(weights) > 1 else np.zeros(weights[0].shape[-1], dtype=np.float32)
+            return conv3d(x, weights[0], bias, node['activation'])
+        elif layer_type == 'Dense':
+            y = np.dot(x, weights[0])
+            if len(weights) > 1:
+                y += weights[1]
+            return activate(y, node['activation'])
+        elif layer_type == 'Activation':
+            return activate(np.array(x, dtype=np.float32), node['activation'])
+        elif layer_type == 'PReLU':
+            return prelu(x, weights[0])
+        elif layer_type == 'Flatten':
+            return x.reshape((len(x), -1))
+        elif layer_type == 'Reshape':
+            return x.reshape((len(x),) + tuple(node['shape']))
+        elif layer_type == 'Permute':
+            return np.transpose(x, [0] + node['dims'])
+        elif layer_type == 'Concatenate':
+            return np.concatenate(inputs, axis=node['axis'])
+        elif layer_type == 'Average':
+            return np.mean(inputs, axis=0)
+        elif layer_type == 'Lambda':
+            return x[:, node['channels']].reshape((len(x),) + tuple(node['shape']))
+        # InputLayer and Dropout
+        return x
+
+    def predict_on_batch(self, x):
+        tensors = dict((name, x) for name in self.inputs)
+        for node in self.nodes:
+            if node['type'] != 'InputLayer':
+                tensors[node['name']] = self.run_node(node, [tensors[name] for name in node['inputs']])
+        outputs = [tensors[name] for name in self.outputs]
+        return outputs if len(outputs) > 1 else outputs[0]
+
+    def predict(self, x, batch_size=32):
+        outputs = [self.predict_on_batch(x[i:i + batch_size]) for i in range(0, len(x), batch_size)]
+        if isinstance(outputs[0], list):
+            return [np.concatenate(o) for o in zip(*outputs)]
+        return np.concatenate(outputs)
+
+
+def load_network(filename):
+    return NumpyNet(filename)
+
+
+def main():
+    from keras.models import load_model
+    from utils import color_codes
+    options = parse_inputs()
+    c = color_codes()
+    output = options['output'] if options['output'] is not None else options['model'].rsplit('.', 1)[0] + '.npz'
+
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Exporting ' + c['b'] + options['model'] +
+          c['nc'] + c['g'] + ' to ' + c['b'] + output + c['nc'])
+    net = load_model(options['model'])
+    export_model(net, output)
+
+    # We check that the exported net gives the same outputs (within tolerance) for a random batch.
+    if options['check'] > 0:
+        init = time()
+        numpy_net = load_network(output)
+        load_time = time() - init
+        x = np.random.normal(size=(options['check'],) + net.input_shape[1:]).astype(np.float32)
+        y_keras = net.predict_on_batch(x)
+        y_numpy = numpy_net.predict_on_batch(x)
+        y_keras = y_keras if isinstance(y_keras, list) else [y_keras]
+        y_numpy = y_numpy if isinstance(y_numpy, list) else [y_numpy]
+        errors = [np.abs(y_k - y_n).max() for y_k, y_n in zip(y_keras, y_numpy)]
+        for name, error in zip(numpy_net.outputs, errors):
+            color = c['g'] if error < options['tolerance'] else c['r']
+            print(color + '    Output ' + c['b'] + name + c['nc'] + color + ' max error = %g' % error + c['nc'])
+        print(c['g'] + '    Load time = %.3fs' % load_time + c['nc'])
+        if max(errors) >= options['tolerance']:
+            raise ValueError('The exported net does not match the Keras model')
+
+
+if __name__ == '__main__':
+    main()
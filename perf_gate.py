@@ -0,0 +1,255 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from time import strftime, time
+import numpy as np
+from nibabel import Nifti1Image
+from utils import color_codes
+from benchmark import print_table, run_isolated
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    parser = argparse.ArgumentParser(description='Check the hot paths against the stored performance baselines.')
+    parser.add_argument('-b', '--baseline', dest='baseline', default='perf_baseline.json')
+    parser.add_argument('-B', '--benchmarks', dest='benchmarks', nargs='+', default=sorted(benchmarks))
+    parser.add_argument('-r', '--results', dest='results', nargs='+', default=[])
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float, default=0.1)
+    parser.add_argument('-T', '--metric-tolerance', dest='metric_tolerance', nargs='+', default=[])
+    parser.add_argument('-s', '--shape', dest='shape', nargs=3, type=int, default=[96, 96, 64])
+    parser.add_argument('-n', '--n-images', dest='n_images', type=int, default=2)
+    parser.add_argument('-i', '--patch-width', dest='patch_width', type=int, default=13)
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=2048)
+    parser.add_argument('-R', '--repeats', dest='repeats', type=int, default=3)
+    parser.add_argument('-u', '--update', action='store_true', dest='update', default=False)
+    return vars(parser.parse_args())
+
+
+def create_synthetic_data(path, shape, n_images, seed=42):
+    # We create BraTS-like patients (4 modalities and a label map with labels 0/1/2/4) with an ellipsoid brain
+    # and a spherical tumor. The values are not meaningful, but the sizes and the fraction of tumor are.
+    np.random.seed(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing='ij')
+    dist = np.sqrt(np.sum([g ** 2 for g in grid], axis=0))
+    brain = dist < 0.9
+    image_names = list()
+    label_names = list()
+    for i in range(n_images):
+        p_name = 'synthetic%d' % i
+        p_path = os.path.join(path, p_name)
+        os.mkdir(p_path)
+        center = np.random.uniform(-0.4, 0.4, size=3)
+        tumor_dist = np.sqrt(np.sum([(g - c) ** 2 for g, c in zip(grid, center)], axis=0))
+        labels = np.zeros(shape, dtype=np.uint8)
+        labels[tumor_dist < 0.25] = 2
+        labels[tumor_dist < 0.15] = 1
+        labels[tumor_dist < 0.08] = 4
+        label_names.append(os.path.join(p_path, p_name + '_seg.nii.gz'))
+        Nifti1Image(labels, np.eye(4)).to_filename(label_names[-1])
+        names = list()
+        for modality in ['_flair.nii.gz', '_t2.nii.gz', '_t1.nii.gz', '_t1ce.nii.gz']:
+            image = (np.random.normal(100, 20, size=shape) + labels * 10) * brain
+            names.append(os.path.join(p_path, p_name + modality))
+            Nifti1Image(image.astype(np.float32), np.eye(4)).to_filename(names[-1])
+        image_names.append(names)
+    return np.array(image_names), np.array(label_names)
+
+
+def best_time(func, repeats):
+    times = list()
+    for _ in range(repeats):
+        init = time()
+        func()
+        times.append(time() - init)
+    return min(times)
+
+
+def benchmark_get_xy(image_names, label_names, options):
+    from data_creation import get_cnn_centers, get_xy, load_norm_list
+    patch_size = (options['patch_width'],) * 3
+    centers = get_cnn_centers(image_names[:, 0], label_names)
+    batch_centers = np.random.permutation(centers)[:options['batch_size']]
+    metrics = dict()
+    for preload in [False, True]:
+        image_list = [load_norm_list(p) for p in image_names] if preload else image_names
+        t = best_time(
+            lambda: get_xy(
+                image_list, label_names, batch_centers, patch_size, None, 5, preload, True, False, 0, np.float32
+            ),
+            options['repeats']
+        )
+        metrics['get_xy.%s.samples_s' % ('preload' if preload else 'disk')] = len(batch_centers) / t
+    return metrics
+
+
+def benchmark_test_generator(image_names, label_names, options):
+    from data_creation import load_image, load_patch_batch_generator_test, sort_centers
+    from data_manipulation.generate_features import get_mask_voxels
+    patch_size = (options['patch_width'],) * 3
+    batch_size = options['batch_size']
+    p = image_names[0]
+    # The brain mask comes from the raw image (normalized images are nonzero almost everywhere).
+    centers = get_mask_voxels(load_image(p[0]).get_data().astype(np.bool))
+    steps = -(-len(centers) / batch_size)
+    metrics = dict()
+    for order in ['raster', 'morton']:
+        sorted_centers = sort_centers(centers, order)
+
+        def run_generator():
+            gen = load_patch_batch_generator_test(
+                p, sorted_centers, batch_size, patch_size, preload=True, subvolume=order == 'morton'
+            )
+            for _ in range(steps):
+                next(gen)
+        t = best_time(run_generator, options['repeats'])
+        metrics['load_patch_batch_generator_test.%s.samples_s' % order] = len(centers) / t
+    return metrics
+
+
+def benchmark_post_processing(image_names, label_names, options):
+    from nibabel import load as load_nii
+    from utils import get_biggest_region
+    labels = [load_nii(name).get_data() for name in label_names]
+    metrics = dict()
+    for opening in [False, True]:
+        t = best_time(lambda: [get_biggest_region(l, opening) for l in labels], options['repeats'])
+        metrics['get_biggest_region.%s.volumes_s' % ('opening' if opening else 'plain')] = len(labels) / t
+    return metrics
+
+
+def benchmark_test_network(image_names, label_names, options):
+    from data_creation import load_image
+    from nets import get_brats_multioutput
+    from test_brats2017 import test_network
+    patch_size = (options['patch_width'],) * 3
+    conv_blocks = (options['patch_width'] - 3) / 2
+    net = get_brats_multioutput((4,) + patch_size, [32] * conv_blocks, [3] * conv_blocks, 256)
+    p = image_names[0]
+    patient_path = os.path.dirname(p[0])
+
+    def run_test():
+        for f in os.listdir(patient_path):
+            if f.startswith('perf_gate'):
+                os.remove(os.path.join(patient_path, f))
+        test_network(net, p, options['batch_size'], patch_size, filename='perf_gate')
+    # Same brain mask as test_network (the raw image), so the throughput is measured on the brain voxels.
+    n_voxels = np.count_nonzero(load_image(p[0]).get_data())
+    t = best_time(run_test, options['repeats'])
+    return {'test_network.samples_s': n_voxels / t}
+
+
+benchmarks = {
+    'get_xy': benchmark_get_xy,
+    'test_generator': benchmark_test_generator,
+    'post_processing': benchmark_post_processing,
+    'test_network': benchmark_test_network,
+}
+
+
+def benchmark_worker(queue, name, path, options):
+    # Each benchmark runs on its own process to avoid any interference (caches, backend graphs...).
+    try:
+        image_names = np.array(json.load(open(os.path.join(path, 'images.json'))))
+        label_names = np.array(json.load(open(os.path.join(path, 'labels.json'))))
+        queue.put(benchmarks[name](image_names, label_names, options))
+    except Exception as e:
+        queue.put({'error': '%s: %s' % (name, repr(e))})
+
+
+def flatten_results(results):
+    # Results from benchmark.py are a list of dictionaries (one per architecture). We flatten them into
+    # the same metric -> value format used by the gate. Only throughputs are kept (higher is better).
+    metrics = dict()
+    for r in results if isinstance(results, list) else [results]:
+        if 'error' in r or 'name' not in r:
+            continue
+        metrics['%s.train_samples_s' % r['name']] = r['train_samples_s']
+        for batch_size, value in r['test_samples_s'].items():
+            metrics['%s.test%s_samples_s' % (r['name'], batch_size)] = value
+    return metrics
+
+
+def compare(metrics, baseline, tolerance, metric_tolerance):
+    # All our metrics are throughputs, so a regression is a value lower than the baseline minus the tolerance.
+    rows = list()
+    regressions = list()
+    for name in sorted(set(metrics) | set(baseline)):
+        if name not in baseline:
+            rows.append([name, '-', '%.2f' % metrics[name], '-', 'new'])
+        elif name not in metrics:
+            rows.append([name, '%.2f' % baseline[name], '-', '-', 'missing'])
+        elif baseline[name] <= 0:
+            # A throughput of 0 is a failed (or empty) benchmark, so there is no valid baseline to compare with.
+            regressions.append(name)
+            rows.append([name, '%.2f' % baseline[name], '%.2f' % metrics[name], '-', 'INVALID BASELINE'])
+        else:
+            tol = metric_tolerance.get(name, tolerance)
+            diff = (metrics[name] - baseline[name]) / baseline[name]
+            status = 'REGRESSION' if diff < -tol else 'ok'
+            if status != 'ok':
+                regressions.append(name)
+            rows.append([name, '%.2f' % baseline[name], '%.2f' % metrics[name], '%+.1f%%' % (100 * diff), status])
+    return rows, regressions
+
+
+def main():
+    options = parse_inputs()
+    c = color_codes()
+
+    metric_tolerance = dict(
+        (m.rsplit('=', 1)[0], float(m.rsplit('=', 1)[1])) for m in options['metric_tolerance']
+    )
+
+    metrics = dict()
+    for results in options['results']:
+        metrics.update(flatten_results(json.load(open(results))))
+
+    path = tempfile.mkdtemp(prefix='perf_gate')
+    try:
+        if options['benchmarks']:
+            shape_s = 'x'.join(['%d' % s for s in options['shape']])
+            print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Creating synthetic data ' +
+                  c['b'] + '(%d images of %s)' % (options['n_images'], shape_s) + c['nc'])
+            image_names, label_names = create_synthetic_data(path, tuple(options['shape']), options['n_images'])
+            json.dump(image_names.tolist(), open(os.path.join(path, 'images.json'), 'w'))
+            json.dump(label_names.tolist(), open(os.path.join(path, 'labels.json'), 'w'))
+        for name in options['benchmarks']:
+            print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Running ' + c['b'] + name + c['nc'])
+            sys.stdout.flush()
+            results = run_isolated(benchmark_worker, name, path, options)
+            if 'error' in results:
+                print(c['r'] + results['error'] + c['nc'])
+                sys.exit(2)
+            metrics.update(results)
+    finally:
+        shutil.rmtree(path)
+
+    if options['update']:
+        baseline = json.load(open(options['baseline'])) if os.path.isfile(options['baseline']) else dict()
+        baseline.update(metrics)
+        json.dump(baseline, open(options['baseline'], 'w'), indent=2, sort_keys=True)
+        print(c['g'] + 'Baseline ' + c['b'] + options['baseline'] + c['nc'] + c['g'] + ' updated' + c['nc'])
+        return
+
+    try:
+        baseline = json.load(open(options['baseline']))
+    except IOError:
+        print(c['r'] + 'Missing baseline ' + options['baseline'] + ' (run with --update to create it)' + c['nc'])
+        sys.exit(2)
+
+    # We only compare the metrics we actually measured.
+    baseline = dict((k, v) for k, v in baseline.items() if k in metrics)
+    rows, regressions = compare(metrics, baseline, options['tolerance'], metric_tolerance)
+    print_table(['metric', 'baseline', 'current', 'diff', 'status'], rows)
+    if regressions:
+        print(c['r'] + '%d metric(s) regressed: ' % len(regressions) + ', '.join(regressions) + c['nc'])
+        sys.exit(1)
+    print(c['g'] + 'No performance regressions' + c['nc'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+from __future__ import print_function
+import argparse
+import os
+from time import strftime
+import numpy as np
+from utils import color_codes
+from catalog import load_catalog, get_names
+from data_creation import load_patch_batch_generator_sample, load_patch_batch_train, get_center_index
+from data_creation import count_centers
+from inference import compare_nets, measure_throughput
+from benchmark import print_table
+
+
+# Layers that keep the channels (or features) apart. Filters can be removed through them as long as we remove
+# the same channels on their weights (PReLU) or the same features after them (Flatten and Concatenate).
+transparent_layers = ['Dropout', 'PReLU', 'Activation', 'Flatten', 'Concatenate']
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    parser = argparse.ArgumentParser(description='Structured (filter) pruning of a trained net.')
+    parser.add_argument('model', help='Keras model (.mdl)')
+    parser.add_argument('-f', '--folder', dest='dir_name', default='/home/mariano/DATA/Brats17Test-Training/')
+    parser.add_argument('-r', '--ratios', dest='ratios', nargs='+', type=float, default=[0.25, 0.5, 0.75])
+    parser.add_argument('--criterion', dest='criterion', choices=['l1', 'activation'], default='activation')
+    parser.add_argument('-i', '--patch-width', dest='patch_width', type=int, default=13)
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=2048)
+    parser.add_argument('-c', '--calibration-cases', dest='calibration_cases', type=int, default=4)
+    parser.add_argument('-s', '--calibration-samples', dest='calibration_samples', type=int, default=20000)
+    parser.add_argument('-t', '--test-cases', dest='test_cases', type=int, default=2)
+    parser.add_argument('-e', '--epochs', dest='epochs', type=int, default=0)
+    parser.add_argument('-D', '--down-factor', dest='dfactor', type=int, default=500)
+    parser.add_argument('-q', '--queue', action='store', dest='queue', type=int, default=10)
+    parser.add_argument('--flair', action='store', dest='flair', default='_flair.nii.gz')
+    parser.add_argument('--t1', action='store', dest='t1', default='_t1.nii.gz')
+    parser.add_argument('--t1ce', action='store', dest='t1ce', default='_t1ce.nii.gz')
+    parser.add_argument('--t2', action='store', dest='t2', default='_t2.nii.gz')
+    parser.add_argument('--labels', action='store', dest='labels', default='_seg.nii.gz')
+    return vars(parser.parse_args())
+
+
+def get_model(net):
+    # Sequential models keep the functional model inside (with the input layer).
+    return net.model if hasattr(net, 'model') else net
+
+
+def get_inputs(layer):
+    return [l.name for l in layer.inbound_nodes[0].inbound_layers] if layer.inbound_nodes else []
+
+
+def get_prunable_layers(model):
+    """
+    Function to get the Conv3D and Dense layers whose filters can be removed. That is only possible if every
+    path from the layer (through transparent layers) ends on the input of another Conv3D or Dense layer, where
+    we can remove the matching input channels. Outputs, reshapes and shared layers are left untouched.
+    :param model: Keras (functional) model.
+    :return: List of layers.
+    """
+    outputs = [l.name for l in model.output_layers]
+    consumers = dict((layer.name, list()) for layer in model.layers)
+    for layer in model.layers:
+        for node in layer.inbound_nodes:
+            for l in node.inbound_layers:
+                consumers[l.name].append(layer)
+
+    def feeds_weights(layer):
+        for consumer in consumers[layer.name]:
+            c_type = type(consumer).__name__
+            config = consumer.get_config()
+            if len(consumer.inbound_nodes) > 1:
+                return False
+            # Dense layers work on the last axis, that is only the channel one for flattened tensors.
+            elif c_type == 'Dense' and len(consumer.input_shape) > 2:
+                return False
+            elif c_type in ['Conv3D', 'Dense']:
+                continue
+            elif c_type not in transparent_layers or consumer.name in outputs:
+                return False
+            # Softmax (on the last axis) mixes the channels of convolutional layers.
+            elif c_type == 'Activation' and config['activation'] == 'softmax':
+                return False
+            elif c_type == 'Concatenate' and len(consumer.output_shape) > 2 and config['axis'] != 1:
+                return False
+            elif not feeds_weights(consumer):
+                return False
+        return len(consumers[layer.name]) > 0
+
+    return [
+        layer for layer in model.layers
+        if type(layer).__name__ in ['Conv3D', 'Dense'] and layer.name not in outputs and
+        len(layer.inbound_nodes) == 1 and feeds_weights(layer)
+    ]
+
+
+def filter_scores(model, layers, batches, criterion='activation'):
+    """
+    Function to rank the filters of a list of layers. The 'l1' criterion is the magnitude of each filter (sum of
+    the absolute weights), while 'activation' is the mean absolute output of each filter on the calibration
+    patches.
+    :return: Dictionary with the score of each filter of each layer.
+    """
+    if criterion == 'l1':
+        return dict(
+            (l.name, np.abs(l.get_weights()[0]).reshape((-1, l.get_weights()[0].shape[-1])).sum(axis=0))
+            for l in layers
+        )
+    import keras.backend as K
+    function = K.function(model.inputs + [K.learning_phase()], [l.output for l in layers])
+    sums = [0] * len(layers)
+    n_samples = 0
+    for x in batches:
+        outputs = function([x, 0])
+        sums = [s + np.abs(o.reshape(o.shape[:2] + (-1,))).mean(axis=-1).sum(axis=0) for s, o in zip(sums, outputs)]
+        n_samples += len(x)
+    return dict((l.name, s / n_samples) for l, s in zip(layers, sums))
+
+
+def select_filters(scores, ratio):
+    # The best filters of each layer (sorted to keep the original order). At least one filter is always kept.
+    return dict(
+        (name, np.sort(np.argsort(-s)[:max(1, int(round(len(s) * (1 - ratio))))])) for name, s in scores.items()
+    )
+
+
+def get_kept_channels(model, kept_filters):
+    # Original channels (or features, for flattened tensors) that remain on the output of each layer. None means
+    # that all of them remain.
+    kept = dict()
+    for layer in model.layers:
+        layer_type = type(layer).__name__
+        inputs = get_inputs(layer)
+        if layer_type in ['Conv3D', 'Dense']:
+            kept[layer.name] = kept_filters.get(layer.name)
+        elif layer_type == 'Flatten' and kept[inputs[0]] is not None:
+            size = np.prod(layer.input_shape[2:])
+            kept[layer.name] = (kept[inputs[0]][:, np.newaxis] * size + np.arange(size)).flatten()
+        elif layer_type == 'Concatenate' and any([kept[i] is not None for i in inputs]):
+            channels = [s[layer.get_config()['axis']] for s in layer.input_shape]
+            offsets = np.cumsum([0] + channels[:-1])
+            kept[layer.name] = np.concatenate([
+                (np.arange(n) if kept[i] is None else kept[i]) + o for i, n, o in zip(inputs, channels, offsets)
+            ])
+        elif layer_type in ['Dropout', 'PReLU', 'Activation']:
+            kept[layer.name] = kept[inputs[0]]
+        else:
+            kept[layer.name] = None
+    return kept
+
+
+def prune_network(net, kept_filters):
+    """
+    Function to build a smaller copy of a net without the removed filters (and the matching input channels of
+    the layers that follow them). The rest of the weights are copied from the original net.
+    :param net: Keras model.
+    :param kept_filters: Dictionary with the indices of the filters we keep for each pruned layer.
+    :return: Compiled Keras model (functional).
+    """
+    from keras.models import Model
+    model = get_model(net)
+    config = model.get_config()
+    for layer_config in config['layers']:
+        if layer_config['name'] in kept_filters:
+            key = 'filters' if layer_config['class_name'] == 'Conv3D' else 'units'
+            layer_config['config'][key] = len(kept_filters[layer_config['name']])
+    pruned = Model.from_config(config)
+
+    kept = get_kept_channels(model, kept_filters)
+    for layer in pruned.layers:
+        weights = model.get_layer(layer.name).get_weights()
+        if not weights:
+            continue
+        layer_type = type(layer).__name__
+        inputs = get_inputs(layer)
+        kept_in = kept[inputs[0]] if len(inputs) == 1 else None
+        kept_out = kept_filters.get(layer.name)
+        if layer_type in ['Conv3D', 'Dense']:
+            # The kernels of both layers have the input channels and the filters on the last two axes.
+            if kept_in is not None:
+                weights[0] = weights[0].take(kept_in, axis=-2)
+            if kept_out is not None:
+                weights = [w.take(kept_out, axis=-1) for w in weights]
+        elif layer_type == 'PReLU' and kept_in is not None and weights[0].shape[0] > 1:
+            weights = [weights[0][kept_in]]
+        layer.set_weights(weights)
+
+    pruned.compile(
+        optimizer=net.optimizer.__class__(**net.optimizer.get_config()),
+        loss=net.loss,
+        loss_weights=getattr(net, 'loss_weights', None),
+        metrics=['accuracy']
+    )
+    return pruned
+
+
+def fine_tune(net, image_names, label_names, options):
+    # Same training generator as the BraTS training scripts.
+    patch_size = (options['patch_width'],) * 3
+    centers = get_center_index(image_names[:, 0], label_names)
+    steps = -(-count_centers(centers) / options['dfactor'] / options['batch_size'])
+    n_outputs = len(net.outputs)
+    net.fit_generator(
+        generator=load_patch_batch_train(
+            image_names=image_names,
+            label_names=label_names,
+            centers=centers,
+            batch_size=options['batch_size'],
+            size=patch_size,
+            fc_shape=None,
+            nlabels=net.output_shape[-1][-1] if n_outputs > 1 else net.output_shape[-1],
+            dfactor=options['dfactor'],
+            preload=True,
+            split=n_outputs > 1,
+            datatype=np.float32
+        ),
+        steps_per_epoch=steps,
+        max_q_size=options['queue'],
+        epochs=options['epochs']
+    )
+
+
+def main():
+    from keras.models import load_model
+    options = parse_inputs()
+    c = color_codes()
+    patch_size = (options['patch_width'],) * 3
+    batch_size = options['batch_size']
+
+    suffixes = [options[m] for m in ['flair', 't2', 't1', 't1ce']]
+    image_names, label_names = get_names(load_catalog(options['dir_name'], suffixes, options['labels']))
+    n_calibration = options['calibration_cases']
+    # Held-out cases are taken from the end of the list, so they never overlap with the calibration ones.
+    test_names = image_names[-options['test_cases']:] if options['test_cases'] > 0 else []
+    test_labels = label_names[-options['test_cases']:] if options['test_cases'] > 0 else []
+
+    net = load_model(options['model'])
+    model = get_model(net)
+    layers = get_prunable_layers(model)
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Ranking the filters of ' + c['b'] +
+          '%d' % len(layers) + c['nc'] + c['g'] + ' layers (' + ', '.join([l.name for l in layers]) + ')' + c['nc'])
+    batches = load_patch_batch_generator_sample(
+        image_names[:n_calibration], options['calibration_samples'], batch_size, patch_size
+    )
+    scores = filter_scores(model, layers, batches, options['criterion'])
+
+    nets = [net]
+    rows = [['0%', '%d' % net.count_params(), ' '.join(['%d' % len(scores[l.name]) for l in layers]),
+             '%.1f' % measure_throughput(net, batch_size), '1.00']]
+    for ratio in options['ratios']:
+        kept_filters = select_filters(scores, ratio)
+        pruned = prune_network(net, kept_filters)
+        if options['epochs'] > 0:
+            print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Fine-tuning the ' + c['b'] +
+                  '%d%%' % (ratio * 100) + c['nc'] + c['g'] + ' pruned net' + c['nc'])
+            fine_tune(pruned, image_names[:n_calibration], label_names[:n_calibration], options)
+        pruned_name = options['model'].rsplit('.', 1)[0] + '.pruned%d.mdl' % (ratio * 100)
+        pruned.save(pruned_name)
+        throughput = measure_throughput(pruned, batch_size)
+        rows.append(['%d%%' % (ratio * 100), '%d' % pruned.count_params(),
+                     ' '.join(['%d' % len(kept_filters[l.name]) for l in layers]),
+                     '%.1f' % throughput, '%.2f' % (throughput / float(rows[0][3]))])
+        nets.append(pruned)
+        print(c['g'] + '    Saved ' + c['b'] + pruned_name + c['nc'] + c['g'] + ' (%.1f KB)' %
+              (os.path.getsize(pruned_name) / 1024.0) + c['nc'])
+    print_table(['pruned', 'params', 'filters', 'test (smp/s)', 'speedup'], rows)
+
+    if len(test_names) > 0:
+        print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Testing on ' + c['b'] + '%d' % len(test_names) +
+              c['nc'] + c['g'] + ' held-out cases' + c['nc'])
+        levels = ['%d%%' % (r * 100) for r in options['ratios']]
+        dsc_rows, times = compare_nets(nets, test_names, test_labels, batch_size, patch_size)
+        print_table(['case', 'label'] + ['DSC %s/0%%' % l for l in levels] + ['DSC %s' % l for l in ['0%'] + levels],
+                    dsc_rows)
+        print(c['g'] + '    Testing time: ' + ', '.join(
+            ['%s = %.1fs' % (l, t) for l, t in zip(['0%'] + levels, times)]
+        ) + c['nc'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+from time import strftime
+import numpy as np
+from utils import color_codes
+from catalog import load_catalog, get_names
+from inference import compare_nets
+from numpy_net import load_network
+from benchmark import print_table
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    # This is weight compression, not an int8 execution mode: the compressed net runs the same float32 products.
+    parser = argparse.ArgumentParser(description='Int8 weight compression of an exported net (smaller files).')
+    parser.add_argument('model', help='Exported net (.npz, see numpy_net.py)')
+    parser.add_argument('-f', '--folder', dest='dir_name', default='/home/mariano/DATA/Brats17Test-Training/')
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    parser.add_argument('-i', '--patch-width', dest='patch_width', type=int, default=13)
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=2048)
+    parser.add_argument('-t', '--test-cases', dest='test_cases', type=int, default=2)
+    parser.add_argument('--flair', action='store', dest='flair', default='_flair.nii.gz')
+    parser.add_argument('--t1', action='store', dest='t1', default='_t1.nii.gz')
+    parser.add_argument('--t1ce', action='store', dest='t1ce', default='_t1ce.nii.gz')
+    parser.add_argument('--t2', action='store', dest='t2', default='_t2.nii.gz')
+    parser.add_argument('--labels', action='store', dest='labels', default='_seg.nii.gz')
+    return vars(parser.parse_args())
+
+
+def quantize_kernel(kernel):
+    # Per channel (filter) symmetric quantization. The last axis of Keras kernels is always the output one.
+    max_values = np.abs(kernel.reshape((-1, kernel.shape[-1]))).max(axis=0)
+    scale = np.where(max_values > 0, max_values / 127.0, 1.0).astype(np.float32)
+    return np.clip(np.round(kernel / scale), -127, 127).astype(np.int8), scale
+
+
+def quantize_network(filename, output):
+    """
+    Function to compress an exported net by storing the kernels of every Conv3D and Dense layer as int8 (the
+    rest of the weights are kept as they are). This is only a storage format: numpy_net dequantizes the kernels
+    when loading the net, so the file is smaller but inference runs the same float32 products (it is not faster).
+    :param filename: Exported net (.npz).
+    :param output: Name of the quantized net. The quantized layers keep 3 weights: the int8 kernel, the scale of
+     each filter and the bias.
+    """
+    data = np.load(filename)
+    graph = json.loads(str(data['graph']))
+    arrays = dict((name, data[name]) for name in data.files if name != 'graph')
+    for node in graph['nodes']:
+        if node['type'] not in ['Conv3D', 'Dense']:
+            continue
+        kernel = arrays.pop('%s/0' % node['name'])
+        bias = arrays.pop('%s/1' % node['name']) if node['weights'] > 1\
+            else np.zeros(kernel.shape[-1], dtype=np.float32)
+        q_kernel, kernel_scale = quantize_kernel(kernel)
+        arrays['%s/0' % node['name']] = q_kernel
+        arrays['%s/1' % node['name']] = kernel_scale
+        arrays['%s/2' % node['name']] = bias
+        node['weights'] = 3
+        node['quantized'] = True
+    np.savez(output, graph=json.dumps(graph), **arrays)
+
+
+def main():
+    options = parse_inputs()
+    c = color_codes()
+    output = options['output'] if options['output'] is not None else options['model'].rsplit('.', 1)[0] + '.int8.npz'
+    patch_size = (options['patch_width'],) * 3
+    batch_size = options['batch_size']
+
+    suffixes = [options[m] for m in ['flair', 't2', 't1', 't1ce']]
+    image_names, label_names = get_names(load_catalog(options['dir_name'], suffixes, options['labels']))
+    test_names = image_names[-options['test_cases']:] if options['test_cases'] > 0 else []
+    test_labels = label_names[-options['test_cases']:] if options['test_cases'] > 0 else []
+
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Compressing ' + c['b'] + options['model'] + c['nc'])
+    quantize_network(options['model'], output)
+    size_float = os.path.getsize(options['model'])
+    size_int8 = os.path.getsize(output)
+    print(c['g'] + '    Saved ' + c['b'] + output + c['nc'] + c['g'] +
+          ' (%.1f KB, %.1fx smaller)' % (size_int8 / 1024.0, float(size_float) / size_int8) + c['nc'])
+
+    if len(test_names) > 0:
+        print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Testing on ' + c['b'] + '%d' % len(test_names) +
+              c['nc'] + c['g'] + ' cases' + c['nc'])
+        # Both nets run the same float32 products (the int8 weights are dequantized when loading), so we only
+        # compare their segmentations.
+        net_float = load_network(options['model'])
+        net_int8 = load_network(output)
+        rows, _ = compare_nets([net_float, net_int8], test_names, test_labels, batch_size, patch_size)
+        print_table(['case', 'label', 'DSC int8/float32', 'DSC float32', 'DSC int8'], rows)
+
+
+if __name__ == '__main__':
+    main()
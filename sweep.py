@@ -0,0 +1,241 @@
+from __future__ import print_function
+import argparse
+import itertools
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import traceback
+from time import strftime
+import numpy as np
+from utils import color_codes
+from data_creation import patch_cache_stats
+from instrumentation import disable_trace
+from benchmark import print_table
+from fold_scheduler import get_script, get_script_options, prepare_store, prepare_patients, run_processes
+
+
+# Hyperparameters we can sweep: (option name, flag of the training scripts, prefix for the configuration name).
+hyperparameters = [
+    ('patch_width', '-i', 'p'),
+    ('conv_blocks', '-c', 'c'),
+    ('n_filters', '-n', 'n'),
+    ('dense_size', '-d', 'd'),
+    ('dfactor', '-D', 'D'),
+    ('experimental', '-E', 'E'),
+]
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    # Unknown parameters are passed to the training script (for every configuration).
+    parser = argparse.ArgumentParser(description='Run a hyperparameter sweep of a training script.')
+    parser.add_argument('script', choices=['brats', 'iseg'])
+    parser.add_argument('-i', '--patch-width', dest='patch_width', nargs='+', type=int, default=[None])
+    parser.add_argument('-c', '--conv-blocks', dest='conv_blocks', nargs='+', type=int, default=[None])
+    parser.add_argument('-n', '--num-filters', dest='n_filters', nargs='+', type=int, default=[None])
+    parser.add_argument('-d', '--dense-size', dest='dense_size', nargs='+', type=int, default=[None])
+    parser.add_argument('-D', '--down-factor', dest='dfactor', nargs='+', type=int, default=[None])
+    parser.add_argument('-E', '--experimental', dest='experimental', nargs='+', type=int, default=[None])
+    parser.add_argument('-r', '--random', dest='random', type=int, default=None)
+    parser.add_argument('--seed', dest='seed', type=int, default=None)
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=2)
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=4)
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    parser.add_argument('--no-convert', action='store_false', dest='convert', default=True)
+    parser.add_argument('--worker', dest='worker', default=None, help=argparse.SUPPRESS)
+    options, script_args = parser.parse_known_args()
+    return vars(options), script_args
+
+
+def get_configurations(options):
+    """
+    Function to list the configurations of the sweep. Every combination of the given values is a configuration
+    (grid search), unless a number of random configurations is asked for. In that case, they are sampled from the
+    same grid (without repetitions).
+    :param options: Options of the sweep.
+    :return: List of configurations (dictionaries with the hyperparameters that were given).
+    """
+    names = [name for name, _, _ in hyperparameters if not (name == 'experimental' and options['script'] == 'brats')]
+    configurations = [
+        dict([(name, value) for name, value in zip(names, values) if value is not None])
+        for values in itertools.product(*[options[name] for name in names])
+    ]
+    if options['random'] is not None and options['random'] < len(configurations):
+        random = np.random.RandomState(options['seed'])
+        indices = sorted(random.choice(len(configurations), options['random'], replace=False))
+        configurations = [configurations[i] for i in indices]
+    return configurations
+
+
+def configuration_args(configuration):
+    # Command line parameters of the training script for a configuration.
+    return [arg for name, flag, _ in hyperparameters if name in configuration
+            for arg in [flag, '%d' % configuration[name]]]
+
+
+def configuration_name(configuration):
+    # The default configuration (no hyperparameters given) is just called default.
+    names = [s + '%d' % configuration[name] for name, _, s in hyperparameters if name in configuration]
+    return '.'.join(names) if names else 'default'
+
+
+def group_configurations(configurations):
+    # The patch cache (and the brain crops) depend on the patch width, while the rest of the hyperparameters only
+    # change the net (or the sampling). Configurations with the same patch width run on the same process, one
+    # after the other, so they can reuse the patches. The training centers are shared by every group (they are
+    # cached on disk by prepare_patients).
+    groups = dict()
+    for configuration in configurations:
+        groups.setdefault(configuration.get('patch_width'), list()).append(configuration)
+    return [groups[width] for width in sorted(groups)]
+
+
+def get_stage_durations(trace_name, stage_name):
+    if not os.path.isfile(trace_name):
+        return list()
+    events = [json.loads(line) for line in open(trace_name)]
+    return [e['duration'] for e in events if e['ph'] == 'X' and e['stage'] == stage_name]
+
+
+def run_configuration(script, script_args, configuration, path):
+    """
+    Function to train and test a configuration on the current process, so the patch cache and the crops of the
+    previous configurations are reused. The training script traces its stages and writes its DSC results on path,
+    and from them we get the training time, the testing time per case and the mean DSC of each label.
+    :param script: Training script module.
+    :param script_args: Common arguments of the training script.
+    :param configuration: Configuration to run.
+    :param path: Folder for the trace and DSC results.
+    :return: Dictionary with the results.
+    """
+    name = configuration_name(configuration)
+    trace_name = os.path.join(path, name + '.trace.json')
+    dsc_name = os.path.join(path, name + '.dsc.pkl')
+    argv = sys.argv
+    sys.argv = [script.__file__] + script_args + configuration_args(configuration) + [
+        '--trace', trace_name, '--dsc-output', dsc_name, '--center-cache'
+    ]
+    cache_stats = patch_cache_stats()
+    error = None
+    try:
+        script.main()
+    except Exception:
+        traceback.print_exc()
+        error = traceback.format_exc().splitlines()[-1]
+    finally:
+        sys.argv = argv
+        disable_trace()
+    new_stats = patch_cache_stats()
+    hits, misses = new_stats['hits'] - cache_stats['hits'], new_stats['misses'] - cache_stats['misses']
+
+    # Nets (or segmentations) that were already on disk are not trained (or tested) again, so they have no times.
+    predict_times = get_stage_durations(trace_name, 'predict')
+    dsc_results = pickle.load(open(dsc_name, 'rb')) if os.path.isfile(dsc_name) else list()
+    n_labels = max([len(results) for results in dsc_results]) - 1 if dsc_results else 0
+    return {
+        'name': name,
+        'configuration': configuration,
+        'error': error,
+        'train_time': sum(get_stage_durations(trace_name, 'fit')),
+        'test_time': np.mean(predict_times) if predict_times else None,
+        'hit_rate': float(hits) / (hits + misses) if hits + misses > 0 else None,
+        'dsc': [
+            np.mean([results[l + 1] for results in dsc_results if len(results) > l + 1]) for l in range(n_labels)
+        ],
+    }
+
+
+def run_worker(group_name):
+    # Worker process of a group: its configurations are run sequentially and the results written next to the group.
+    group = json.load(open(group_name))
+    script = get_script(group['script'])
+    path = os.path.dirname(group_name)
+    results = [
+        run_configuration(script, group['script_args'], configuration, path)
+        for configuration in group['configurations']
+    ]
+    json.dump(results, open(group_name[:-len('json')] + 'results.json', 'w'))
+
+
+def print_results(results):
+    n_labels = max([len(r['dsc']) for r in results] + [0])
+    header = ['configuration', 'train (s)', 'test (s/case)', 'cache hits'] +\
+             ['DSC %d' % (l + 1) for l in range(n_labels)]
+    rows = list()
+    for r in results:
+        if r['error'] is not None:
+            rows.append([r['name'], r['error']] + [''] * (len(header) - 2))
+        else:
+            rows.append(
+                [r['name'], '%.1f' % r['train_time'],
+                 '%.1f' % r['test_time'] if r['test_time'] is not None else '-',
+                 '%.1f%%' % (100 * r['hit_rate']) if r['hit_rate'] is not None else '-'] +
+                ['%f' % dsc for dsc in r['dsc']] + ['-'] * (n_labels - len(r['dsc']))
+            )
+    print_table(header, rows)
+
+
+def main():
+    options, script_args = parse_inputs()
+    if options['worker'] is not None:
+        run_worker(options['worker'])
+        return
+    c = color_codes()
+    name = options['script']
+    script = get_script(name)
+    script_options = get_script_options(script, script_args)
+    path = script_options['dir_name']
+    jobs = options['jobs']
+    threads = options['threads']
+
+    script_args = prepare_store(name, script_options, script_args, options['convert'], jobs * threads)
+
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Preparing the patients' + c['nc'])
+    sys.stdout.flush()
+    prepare_patients(name, script, script_options)
+
+    configurations = get_configurations(options)
+    groups = group_configurations(configurations)
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + c['g'] + 'Running ' + c['b'] + '%d' % len(configurations) +
+          c['nc'] + c['g'] + ' configurations in ' + c['b'] + '%d' % len(groups) + c['nc'] + c['g'] + ' groups (' +
+          c['b'] + '%d' % jobs + c['nc'] + c['g'] + ' at a time, ' + c['b'] + '%d' % threads + c['nc'] + c['g'] +
+          ' threads each)' + c['nc'])
+    group_path = tempfile.mkdtemp(prefix='sweep')
+    try:
+        group_names = [os.path.join(group_path, 'group%d.json' % i) for i in range(len(groups))]
+        for group_name, group in zip(group_names, groups):
+            json.dump({'script': name, 'script_args': script_args, 'configurations': group}, open(group_name, 'w'))
+        sweep_name = os.path.abspath(__file__).rsplit('.', 1)[0] + '.py'
+        codes = run_processes(
+            [[sys.executable, sweep_name, name, '--worker', group_name] for group_name in group_names],
+            ['Group ' + ', '.join([configuration_name(conf) for conf in group]) for group in groups],
+            [os.path.join(path, 'sweep.group%d.log' % i) for i in range(len(groups))],
+            jobs,
+            threads
+        )
+        results = list()
+        for group_name, group, code in zip(group_names, groups, codes):
+            results_name = group_name[:-len('json')] + 'results.json'
+            if os.path.isfile(results_name):
+                results += json.load(open(results_name))
+            else:
+                results += [
+                    {'name': configuration_name(conf), 'configuration': conf, 'error': 'group failed (%d)' % code,
+                     'dsc': list()}
+                    for conf in group
+                ]
+    finally:
+        shutil.rmtree(group_path)
+
+    print_results(results)
+    if options['output'] is not None:
+        json.dump(results, open(options['output'], 'w'), indent=2)
+    if any([r['error'] is not None for r in results]):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
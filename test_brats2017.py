@@ -2,7 +2,6 @@ from __future__ import print_function
 import argparse
 import pickle
 import os
-import sys
 from itertools import product
 from time import strftime
 import numpy as np
@@ -12,16 +11,20 @@ from keras.models import Model
 from keras.layers import Conv3D, Dropout, Input, Reshape, Lambda, Dense
 from nibabel import load as load_nii
 from utils import color_codes, get_biggest_region
-from data_creation import load_norm_list, clip_to_roi
-from data_creation import load_patch_batch_generator_test
-from data_manipulation.generate_features import get_mask_voxels, get_patches
+from catalog import load_catalog, get_names
+from data_creation import load_norm_list, clip_to_roi, get_brain_crop, load_image, open_store
+from data_creation import get_image_patches
+from inference import predict_to_volume, predict_models_to_volume
+from data_manipulation.generate_features import get_mask_voxels
 from data_manipulation.metrics import dsc_seg
+from instrumentation import stage, enable_trace
 from scipy.ndimage.interpolation import zoom
+from scipy.ndimage.morphology import binary_dilation as imdilate
 from skimage.measure import compare_ssim as ssim
 
 
 def check_dsc(gt_name, image):
-    gt_nii = load_nii(gt_name)
+    gt_nii = load_image(gt_name)
     gt = np.copy(gt_nii.get_data()).astype(dtype=np.uint8)
     labels = np.unique(gt.flatten())
     return [dsc_seg(gt == l, image == l) for l in labels[1:]]
@@ -44,34 +47,26 @@ def parse_inputs():
     parser.add_argument('--no-t1ce', action='store_false', dest='use_t1ce', default=True)
     parser.add_argument('--no-t2', action='store_false', dest='use_t2', default=True)
     parser.add_argument('--no-dsc', action='store_false', dest='use_dsc', default=True)
+    parser.add_argument('--cascade', action='store', dest='cascade', type=int, default=0)
+    parser.add_argument('--morton', action='store_true', dest='morton', default=False)
+    parser.add_argument('--crop', action='store_true', dest='crop', default=False)
+    parser.add_argument('--store', action='store', dest='store', default=None)
+    parser.add_argument('--ensemble', action='store', dest='ensemble', nargs='+', default=[])
+    parser.add_argument('--cascade-margin', action='store', dest='cascade_margin', type=int, default=2)
     parser.add_argument('--flair', action='store', dest='flair', default='_flair.nii.gz')
     parser.add_argument('--t1', action='store', dest='t1', default='_t1.nii.gz')
     parser.add_argument('--t1ce', action='store', dest='t1ce', default='_t1ce.nii.gz')
     parser.add_argument('--t2', action='store', dest='t2', default='_t2.nii.gz')
     parser.add_argument('--labels', action='store', dest='labels', default='_seg.nii.gz')
+    parser.add_argument('--trace', action='store', dest='trace', default=None)
+    parser.add_argument('--trace-rss', action='store', dest='trace_rss', type=float, default=None)
     return vars(parser.parse_args())
 
 
-def list_directories(path):
-    return filter(os.path.isdir, [os.path.join(path, f) for f in os.listdir(path)])
-
-
 def get_names_from_path(path, options):
-    patients = sorted(list_directories(path))
-
-    # Prepare the names
-    flair_names = [os.path.join(path, p, p.split('/')[-1] + options['flair'])
-                   for p in patients]
-    t2_names = [os.path.join(path, p, p.split('/')[-1] + options['t2'])
-                for p in patients]
-    t1_names = [os.path.join(path, p, p.split('/')[-1] + options['t1'])
-                for p in patients]
-    t1ce_names = [os.path.join(path, p, p.split('/')[-1] + options['t1ce'])
-                  for p in patients]
-    label_names = np.array([os.path.join(path, p, p.split('/')[-1] + options['labels']) for p in patients])
-    image_names = np.stack(filter(None, [flair_names, t2_names, t1_names, t1ce_names]), axis=1)
-
-    return image_names, label_names
+    suffixes = [options[m] for m in ['flair', 't2', 't1', 't1ce']]
+    catalog = load_catalog(path, suffixes, options['labels'])
+    return get_names(catalog)
 
 
 def transfer_learning(
@@ -114,9 +109,7 @@ def transfer_learning(
     centers = [tuple(center) for center in np.random.permutation(train_centers)[::d_factor]]
     print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Preparing ' + c['b'] + 'net' + c['nc'] +
           c['g'] + ' data (' + c['b'] + '%d' % len(centers) + c['nc'] + c['g'] + ' samples)' + c['nc'])
-    x = [get_patches(image, centers, patch_size)
-         for image in train_image]
-    x = np.stack(x, axis=1).astype(np.float32)
+    x = get_image_patches(train_image, centers, patch_size, True).astype(np.float32)
     y = np.array([train_labels[center] for center in centers])
     y = [
         keras.utils.to_categorical(
@@ -143,7 +136,8 @@ def transfer_learning(
         print(c['b'] + 'Epoch %d/%d ' % (e+1, epochs) + c['nc'])
         print(''.join([' ']*14) + c['g'] + c['b'] + 'Domain' + c['nc'] + c['g'] + ' net ' + c['nc'] +
               c['b'] + '(%d parameters)' % net_domain_params + c['nc'])
-        net_domain.fit(np.expand_dims(data, axis=0), conv_data, epochs=1, batch_size=1)
+        with stage('fit', net='domain'):
+            net_domain.fit(np.expand_dims(data, axis=0), conv_data, epochs=1, batch_size=1)
         for layer in net.layers:
             if isinstance(layer, Dense):
                 if layer.name in ['core', 'tumor', 'enhancing']:
@@ -154,7 +148,8 @@ def transfer_learning(
         net_params = np.sum([K.count_params(p) for p in set(net.trainable_weights)])
         print(''.join([' ']*14) + c['g'] + c['b'] + 'Original (dense)' + c['nc'] + c['g'] + ' net ' + c['nc'] +
               c['b'] + '(%d parameters)' % net_params + c['nc'])
-        net.fit(x, y, epochs=net_epochs, batch_size=batch_size)
+        with stage('fit', net='dense'):
+            net.fit(x, y, epochs=net_epochs, batch_size=batch_size)
         for layer in net.layers:
             if isinstance(layer, Dense):
                 if layer.name in ['core', 'tumor', 'enhancing']:
@@ -165,18 +160,143 @@ def transfer_learning(
         net_params = np.sum([K.count_params(p) for p in set(net.trainable_weights)])
         print(''.join([' ']*14) + c['g'] + c['b'] + 'Original (out)' + c['nc'] + c['g'] + ' net ' + c['nc'] +
               c['b'] + '(%d parameters)' % net_params + c['nc'])
-        net.fit(x, y, epochs=net_epochs, batch_size=batch_size)
+        with stage('fit', net='out'):
+            net.fit(x, y, epochs=net_epochs, batch_size=batch_size)
         # We transfer the convolutional weights after retraining the net
     for l_new, l_orig in zip(net_domain_conv_layers, net_conv_layers):
         l_orig.set_weights(l_new.get_weights())
 
 
-def test_network(net, p, batch_size, patch_size, queue=50, sufix='', centers=None, filename=None):
+def predict_centers(
+        net, p, centers, batch_size, patch_size, shape, heads=None, queue=50, order='raster', crop=None
+):
+    # The net can also be a list of nets (an ensemble).
+    p_name = p[0].rsplit('/')[-2]
+    with stage('predict', patient=p_name):
+        if isinstance(net, list):
+            return predict_models_to_volume(
+                [net], p, centers, batch_size, patch_size, shape,
+                heads=heads, queue=queue, order=order, subvolume=order == 'morton', crop=crop
+            )[0]
+        return predict_to_volume(
+            net, p, centers, batch_size, patch_size, shape,
+            heads=heads, queue=queue, order=order, subvolume=order == 'morton', crop=crop
+        )
+
+
+def test_network(
+        net, p, batch_size, patch_size, queue=50, sufix='', centers=None, filename=None, order='raster', crop=None
+):
+    return test_networks([net], p, batch_size, patch_size, queue, [sufix], centers, [filename], order, crop)[0]
+
+
+def test_networks(
+        nets,
+        p,
+        batch_size,
+        patch_size,
+        queue=50,
+        sufixes=None,
+        centers=None,
+        filenames=None,
+        order='raster',
+        crop=None
+):
+    # Each element of nets can also be a list of nets (an ensemble). All the nets whose results are not
+    # on disk are tested together, extracting each batch of patches only once for all of them.
+    c = color_codes()
+    p_name = p[0].rsplit('/')[-2]
+    patient_path = '/'.join(p[0].rsplit('/')[:-1])
+    sufixes = [''] * len(nets) if sufixes is None else sufixes
+    filenames = [None] * len(nets) if filenames is None else filenames
+    outputnames = [
+        filename if filename is not None else 'deep-brats17.test.' + sufix
+        for filename, sufix in zip(filenames, sufixes)
+    ]
+    outputname_paths = [os.path.join(patient_path, outputname + '.nii.gz') for outputname in outputnames]
+    roinames = [os.path.join(patient_path, outputname + '.roi.nii.gz') for outputname in outputnames]
+    images = [None] * len(nets)
+    for i, (outputname_path, roiname) in enumerate(zip(outputname_paths, roinames)):
+        try:
+            images[i] = load_nii(outputname_path).get_data()
+            load_nii(roiname)
+        except IOError:
+            pass
+    missing = [i for i, image in enumerate(images) if image is None]
+    if missing:
+        print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Testing ' +
+              c['b'] + ', '.join([sufixes[i] for i in missing]) + c['nc'] + c['g'] + ' network(s)' + c['nc'])
+        roi_nii = load_image(p[0])
+        roi = roi_nii.get_data().astype(dtype=np.bool)
+        centers = get_mask_voxels(roi) if centers is None else centers
+        test_samples = len(centers)
+        print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] +
+              '<Creating the probability map ' + c['b'] + p_name + c['nc'] + c['g'] +
+              ' (%d samples)>' % test_samples + c['nc'])
+        with stage('predict', patient=p_name):
+            results = predict_models_to_volume(
+                [nets[i] for i in missing],
+                p,
+                centers,
+                batch_size,
+                patch_size,
+                roi.shape,
+                heads=[0, -1],
+                queue=queue,
+                order=order,
+                subvolume=order == 'morton',
+                crop=crop
+            )
 
+        for i, (tumor, image) in zip(missing, results):
+            net = nets[i][0] if isinstance(nets[i], list) else nets[i]
+            is_roi = len(net.outputs) == 1
+
+            # We save the ROI
+            roi_nii.get_data()[:] = tumor
+            with stage('nifti_save', image=roinames[i]):
+                roi_nii.to_filename(roinames[i])
+
+            # We save the results
+            image = tumor if is_roi else image
+            # Post-processing (Basically keep the biggest connected region)
+            with stage('post_processing', patient=p_name):
+                image = get_biggest_region(image, is_roi)
+            print(c['g'] + '                   -- Saving image ' + c['b'] + outputname_paths[i] + c['nc'])
+            roi_nii.get_data()[:] = image
+            with stage('nifti_save', image=outputname_paths[i]):
+                roi_nii.to_filename(outputname_paths[i])
+            images[i] = image
+    return images
+
+
+def test_network_cascade(
+        net_roi,
+        net,
+        p,
+        batch_size,
+        patch_size,
+        stride=4,
+        margin=2,
+        queue=50,
+        filename=None,
+        roi_filename=None,
+        order='raster',
+        crop=None
+):
+    # Coarse-to-fine testing. The tumor is a small fraction of the brain, so instead of classifying every brain
+    # voxel with both nets we:
+    # 1 - Run the ROI net on a strided grid of brain voxels (every stride-th voxel on each axis).
+    # 2 - Dilate the tumor voxels of the grid (to cover the gaps of the grid) and run the ROI net densely there.
+    # 3 - Dilate the dense tumor ROI (to avoid cropping the tumor boundary) and only run the multi-class net
+    #     on those voxels. The rest of the brain is labeled as background.
+    # The multi-class net can also be a list of nets (an ensemble). If roi_filename is given, the dense ROI is also
+    # saved with the same names test_network uses for the ROI net, so it can be loaded instead of testing the ROI
+    # net again on the whole brain.
     c = color_codes()
     p_name = p[0].rsplit('/')[-2]
     patient_path = '/'.join(p[0].rsplit('/')[:-1])
-    outputname = filename if filename is not None else 'deep-brats17.test.' + sufix
+    outputname = filename if filename is not None else 'deep-brats17.test.cascade'
     outputname_path = os.path.join(patient_path, outputname + '.nii.gz')
     roiname = os.path.join(patient_path, outputname + '.roi.nii.gz')
     try:
@@ -184,54 +304,65 @@ def test_network(net, p, batch_size, patch_size, queue=50, sufix='', centers=Non
         load_nii(roiname)
     except IOError:
         print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Testing ' +
-              c['b'] + sufix + c['nc'] + c['g'] + ' network' + c['nc'])
-        roi_nii = load_nii(p[0])
-        roi = roi_nii.get_data().astype(dtype=np.bool)
-        centers = get_mask_voxels(roi) if centers is None else centers
-        test_samples = np.count_nonzero(roi)
-        image = np.zeros_like(roi).astype(dtype=np.uint8)
-        print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] +
-              '<Creating the probability map ' + c['b'] + p_name + c['nc'] + c['g'] +
-              ' (%d samples)>' % test_samples + c['nc'])
-        test_steps_per_epoch = -(-test_samples / batch_size)
-        y_pr_pred = net.predict_generator(
-            generator=load_patch_batch_generator_test(
-                image_names=p,
-                centers=centers,
-                batch_size=batch_size,
-                size=patch_size,
-                preload=True,
-            ),
-            steps=test_steps_per_epoch,
-            max_q_size=queue
-        )
-        print(' '.join([''] * 50), end='\r')
-        sys.stdout.flush()
-        [x, y, z] = np.stack(centers, axis=1)
-
-        if isinstance(y_pr_pred, list):
-            tumor = np.argmax(y_pr_pred[0], axis=1)
-            y_pr_pred = y_pr_pred[-1]
-            is_roi = False
-        else:
-            tumor = np.argmax(y_pr_pred, axis=1)
-            is_roi = True
-
-        # We save the ROI
-        roi = np.zeros_like(roi).astype(dtype=np.uint8)
-        roi[x, y, z] = tumor
+              c['b'] + 'cascade' + c['nc'] + c['g'] + ' network' + c['nc'])
+        roi_nii = load_image(p[0])
+        brain = roi_nii.get_data().astype(dtype=np.bool)
+        n_brain = np.count_nonzero(brain)
+
+        # Coarse ROI (strided grid)
+        grid = np.zeros_like(brain)
+        grid[::stride, ::stride, ::stride] = True
+        centers = get_mask_voxels(np.logical_and(brain, grid))
+        print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + '<Coarse ROI ' + c['b'] + p_name + c['nc'] +
+              c['g'] + ' (%d/%d samples)>' % (len(centers), n_brain) + c['nc'])
+        coarse = predict_centers(
+            net_roi, p, centers, batch_size, patch_size, brain.shape, [0], queue, order, crop
+        )[0]
+        strel = np.ones((2 * stride - 1,) * 3, dtype=np.bool)
+        candidates = np.logical_and(imdilate(coarse.astype(np.bool), strel), brain)
+
+        # Dense ROI (only on the candidates)
+        roi = np.zeros_like(brain).astype(dtype=np.uint8)
+        if np.count_nonzero(candidates) > 0:
+            centers = get_mask_voxels(candidates)
+            print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + '<Dense ROI ' + c['b'] + p_name +
+                  c['nc'] + c['g'] + ' (%d/%d samples)>' % (len(centers), n_brain) + c['nc'])
+            roi = predict_centers(
+                net_roi, p, centers, batch_size, patch_size, brain.shape, [0], queue, order, crop
+            )[0]
         roi_nii.get_data()[:] = roi
-        roi_nii.to_filename(roiname)
+        with stage('nifti_save', image=roiname):
+            roi_nii.to_filename(roiname)
+        if roi_filename is not None:
+            tumor_roiname = os.path.join(patient_path, roi_filename + '.roi.nii.gz')
+            with stage('nifti_save', image=tumor_roiname):
+                roi_nii.to_filename(tumor_roiname)
+            tumor_name = os.path.join(patient_path, roi_filename + '.nii.gz')
+            with stage('post_processing', patient=p_name):
+                roi_nii.get_data()[:] = get_biggest_region(roi, True)
+            with stage('nifti_save', image=tumor_name):
+                roi_nii.to_filename(tumor_name)
+
+        # Multi-class segmentation (only on the dilated tumor)
+        image = np.zeros_like(brain).astype(dtype=np.uint8)
+        tumor = np.logical_and(imdilate(roi.astype(np.bool), iterations=margin), brain) if margin > 0\
+            else roi.astype(np.bool)
+        if np.count_nonzero(tumor) > 0:
+            centers = get_mask_voxels(tumor)
+            print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] +
+                  '<Creating the probability map ' + c['b'] + p_name + c['nc'] + c['g'] +
+                  ' (%d/%d samples)>' % (len(centers), n_brain) + c['nc'])
+            image = predict_centers(
+                net, p, centers, batch_size, patch_size, brain.shape, [-1], queue, order, crop
+            )[0]
 
-        y_pred = np.argmax(y_pr_pred, axis=1)
-
-        # We save the results
-        image[x, y, z] = tumor if is_roi else y_pred
         # Post-processing (Basically keep the biggest connected region)
-        image = get_biggest_region(image, is_roi)
+        with stage('post_processing', patient=p_name):
+            image = get_biggest_region(image)
         print(c['g'] + '                   -- Saving image ' + c['b'] + outputname_path + c['nc'])
         roi_nii.get_data()[:] = image
-        roi_nii.to_filename(outputname_path)
+        with stage('nifti_save', image=outputname_path):
+            roi_nii.to_filename(outputname_path)
     return image
 
 
@@ -305,7 +436,7 @@ def get_best_roi(base_roi, image_list, labels_list):
     best_rate = None
     for i, (p, gt_name) in enumerate(zip(image_list, labels_list)):
         im = np.stack(load_norm_list(p)).astype(dtype=np.float32)
-        gt_nii = load_nii(gt_name)
+        gt_nii = load_image(gt_name)
         gt = gt_nii.get_data().astype(dtype=np.bool)
         im_clipped, clip = clip_to_roi(im, gt)
         zoom_rate = [float(b_len)/i_len for b_len, i_len in zip(base_roi.shape[1:], im_clipped.shape[1:])]
@@ -325,6 +456,10 @@ def get_best_roi(base_roi, image_list, labels_list):
 def main():
     options = parse_inputs()
     c = color_codes()
+    if options['trace'] is not None:
+        enable_trace(options['trace'], rss_interval=options['trace_rss'])
+    if options['store'] is not None:
+        open_store(options['store'])
 
     path = options['dir_name']
     test_data, test_labels = get_names_from_path(path, options)
@@ -341,6 +476,7 @@ def main():
     conv_width = options['conv_width']
     kernel_size_list = conv_width if isinstance(conv_width, list) else [conv_width]*conv_blocks
     options_s = 'e%d.E%d.D%d.' % (options['epochs'], options['net_epochs'], options['down_factor'])
+    order = 'morton' if options['morton'] else 'raster'
 
     print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + 'Starting testing' + c['nc'])
     # Testing. We retrain the convolutionals and then apply testing. We also check the results without doing it.
@@ -349,11 +485,15 @@ def main():
 
     net_roi_name = os.path.join(path, 'CBICA-brats2017.D25.p13.c3c3c3c3c3.n32n32n32n32n32.d256.e50.mdl')
     net_roi = keras.models.load_model(net_roi_name)
+    tumor_name = 'deep-brats17.test.tumor'
+    # Cross-validation models (or any other set of models) can be averaged as an ensemble for the original net.
+    net_ensemble = [keras.models.load_model(os.path.join(path, name)) for name in options['ensemble']]
     for i, (p, gt_name) in enumerate(zip(test_data, test_labels)):
         p_name = p[0].rsplit('/')[-2]
         patient_path = '/'.join(p[0].rsplit('/')[:-1])
         print(c['c'] + '[' + strftime("%H:%M:%S") + ']  ' + c['nc'] + 'Case ' + c['c'] + c['b'] + p_name + c['nc'] +
               c['c'] + ' (%d/%d):' % (i + 1, len(test_data)) + c['nc'])
+        crop = get_brain_crop(p[0], patch_width / 2) if options['crop'] else None
         try:
             image_o = load_nii(os.path.join(patient_path, p_name + '.nii.gz')).get_data()
         except IOError:
@@ -364,7 +504,35 @@ def main():
                 cmp=lambda x, y: int(x.name[7:]) - int(y.name[7:])
             )
 
-            image_o = test_network(net_orig, p, batch_size, patch_size, sufix='original', filename=p_name)
+            if options['cascade'] > 0:
+                # The dense ROI of the cascade is saved as the tumor ROI, so the domain adaptation loads it
+                # instead of testing the ROI net on the whole brain.
+                image_o = test_network_cascade(
+                    net_roi,
+                    net_ensemble if net_ensemble else net_orig,
+                    p,
+                    batch_size,
+                    patch_size,
+                    stride=options['cascade'],
+                    margin=options['cascade_margin'],
+                    filename=p_name,
+                    roi_filename=tumor_name,
+                    order=order,
+                    crop=crop
+                )
+            else:
+                # The tumor ROI is also needed for the domain adaptation, so we test both nets at once to
+                # extract the patches only once.
+                image_o, _ = test_networks(
+                    [net_ensemble if net_ensemble else net_orig, net_roi],
+                    p,
+                    batch_size,
+                    patch_size,
+                    sufixes=['original', 'tumor'],
+                    filenames=[p_name, tumor_name],
+                    order=order,
+                    crop=crop
+                )
 
         try:
             outputname = 'deep-brats17.test.' + options_s + 'domain'
@@ -383,7 +551,9 @@ def main():
                 net_new_conv_layers = [l for l in net_new.layers if 'conv' in l.name]
             except IOError:
                 # First we get the tumor ROI
-                image_r = test_network(net_roi, p, batch_size, patch_size, sufix='tumor', filename=outputname)
+                image_r = test_network(
+                    net_roi, p, batch_size, patch_size, sufix='tumor', filename=tumor_name, order=order, crop=crop
+                )
                 roi = np.logical_and(image_r.astype(dtype=np.bool), image_o.astype(dtype=np.bool))
                 p_images = np.stack(load_norm_list(p)).astype(dtype=np.float32)
                 data, clip = clip_to_roi(p_images, roi) if np.count_nonzero(roi) > 0 else clip_to_roi(p_images, image_r)
@@ -403,7 +573,7 @@ def main():
                 except IOError:
                     train_num, train_roi, train_rate = get_best_roi(data, train_data, train_labels)
                     train_image = np.stack(load_norm_list(train_data[train_num])).astype(dtype=np.float32)
-                    train_mask = load_nii(train_labels[train_num]).get_data().astype(dtype=np.uint8)
+                    train_mask = load_image(train_labels[train_num]).get_data().astype(dtype=np.uint8)
                     pickle.dump(train_roi, open(roi_name, 'wb'))
                     pickle.dump(train_mask, open(mask_name, 'wb'))
                     pickle.dump(train_image, open(image_name, 'wb'))
@@ -430,7 +600,9 @@ def main():
             for l_new, l_orig in zip(net_new_conv_layers, net_orig_conv_layers):
                 l_orig.set_weights(l_new.get_weights())
 
-            image_d = test_network(net_orig, p, batch_size, patch_size, sufix=options_s + 'domain')
+            image_d = test_network(
+                net_orig, p, batch_size, patch_size, sufix=options_s + 'domain', order=order, crop=crop
+            )
 
         if options['use_dsc']:
             results_o = check_dsc(gt_name, image_o)
@@ -3,12 +3,15 @@ import argparse
 import os
 from time import strftime
 import numpy as np
-import keras as K
 from keras.callbacks import EarlyStopping, ModelCheckpoint
-from keras.models import Model, load_model
-from keras.layers import Dense, Conv3D, Dropout, Flatten, PReLU, Input, Reshape, Permute, Activation, concatenate
+from keras.models import load_model
 from utils import color_codes
-from data_creation import get_cnn_centers, load_patches_train
+from catalog import load_catalog, get_names
+from data_creation import get_center_index, count_centers, load_patches_train, get_brain_crop, open_store
+from data_creation import write_patch_dataset, load_patch_dataset_generator, enable_patch_cache, patch_cache_stats
+from data_parallel import fit_data_parallel, get_array_batch_functions, split_validation
+from nets import get_brats_fc
+from instrumentation import stage, enable_trace
 
 
 def parse_inputs():
@@ -37,33 +40,36 @@ def parse_inputs():
     parser.add_argument('--t1ce', action='store', dest='t1ce', default='_t1ce.nii.gz')
     parser.add_argument('--t2', action='store', dest='t2', default='_t2.nii.gz')
     parser.add_argument('--labels', action='store', dest='labels', default='_seg.nii.gz')
-    return vars(parser.parse_args())
-
-
-def list_directories(path):
-    return filter(os.path.isdir, [os.path.join(path, f) for f in os.listdir(path)])
+    parser.add_argument('--trace', action='store', dest='trace', default=None)
+    parser.add_argument('--trace-rss', action='store', dest='trace_rss', type=float, default=None)
+    parser.add_argument('--crop', action='store_true', dest='crop', default=False)
+    parser.add_argument('--store', action='store', dest='store', default=None)
+    parser.add_argument('--patch-cache', action='store', dest='patch_cache', type=int, default=0)
+    parser.add_argument('--disk-dataset', action='store_true', dest='disk_dataset', default=False)
+    parser.add_argument('--workers', action='store', dest='workers', type=int, default=1)
+    parser.add_argument('--sync-steps', action='store', dest='sync_steps', type=int, default=1)
+    options = vars(parser.parse_args())
+    # Data-parallel training works on the patches in memory.
+    if options['workers'] > 1 and options['disk_dataset']:
+        parser.error('--workers can not be used with --disk-dataset')
+    return options
 
 
 def get_names_from_path(options):
-    path = options['dir_name']
-
-    patients = sorted(list_directories(path))
-
-    # Prepare the names
-    flair_names = [os.path.join(path, p, p.split('/')[-1] + options['flair']) for p in patients]
-    t2_names = [os.path.join(path, p, p.split('/')[-1] + options['t2']) for p in patients]
-    t1_names = [os.path.join(path, p, p.split('/')[-1] + options['t1']) for p in patients]
-    t1ce_names = [os.path.join(path, p, p.split('/')[-1] + options['t1ce']) for p in patients]
-
-    label_names = np.array([os.path.join(path, p, p.split('/')[-1] + options['labels']) for p in patients])
-    image_names = np.stack(filter(None, [flair_names, t2_names, t1_names, t1ce_names]), axis=1)
-
-    return image_names, label_names
+    suffixes = [options[m] for m in ['flair', 't2', 't1', 't1ce']]
+    catalog = load_catalog(options['dir_name'], suffixes, options['labels'])
+    return get_names(catalog)
 
 
 def main():
     options = parse_inputs()
     c = color_codes()
+    if options['trace'] is not None:
+        enable_trace(options['trace'], rss_interval=options['trace_rss'])
+    if options['store'] is not None:
+        open_store(options['store'])
+    if options['patch_cache'] > 0:
+        enable_patch_cache(options['patch_cache'])
 
     # Prepare the net architecture parameters
     dfactor = options['dfactor']
@@ -107,40 +113,7 @@ def main():
     print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Creating and compiling the model ' + c['nc'])
     input_shape = (train_data.shape[1],) + patch_size
 
-    # Sequential model that merges all 4 images. This architecture is just a set of convolutional blocks
-    #  that end in a dense layer. This is supposed to be an original baseline.
-    inputs = Input(shape=input_shape, name='merged_inputs')
-    conv = inputs
-    for filters, kernel_size in zip(filters_list, kernel_size_list):
-        conv = Conv3D(filters, kernel_size=kernel_size, activation='relu', data_format='channels_first')(conv)
-        conv = Dropout(0.5)(conv)
-
-    full = Conv3D(dense_size, kernel_size=(1, 1, 1), data_format='channels_first')(conv)
-    full = PReLU()(full)
-    full = Conv3D(2, kernel_size=(1, 1, 1), data_format='channels_first')(full)
-
-    rf = concatenate([conv, full], axis=1)
-
-    while np.product(K.int_shape(rf)[2:]) > 1:
-        rf = Conv3D(dense_size, kernel_size=(3, 3, 3), data_format='channels_first')(rf)
-        rf = Dropout(0.5)(rf)
-
-    full = Reshape((2, -1))(full)
-    full = Permute((2, 1))(full)
-    full_out = Activation('softmax', name='fc_out')(full)
-
-    tumor = Dense(2, activation='softmax', name='tumor')(rf)
-
-    outputs = [tumor, full_out]
-
-    net = Model(inputs=inputs, outputs=outputs)
-
-    net.compile(
-        optimizer='adadelta',
-        loss='categorical_crossentropy',
-        loss_weights=[0.8, 1.0],
-        metrics=['accuracy']
-    )
+    net = get_brats_fc(input_shape, filters_list, kernel_size_list, dense_size)
 
     fc_width = patch_width - sum(kernel_size_list) + conv_blocks
     fc_shape = (fc_width,) * 3
@@ -155,30 +128,72 @@ def main():
         try:
             net = load_model(net_name + ('e%d.' % i) + 'mdl')
         except IOError:
-            train_centers = get_cnn_centers(train_data[:, 0], train_labels, balanced=balanced)
-            train_samples = len(train_centers) / dfactor
+            crops = [get_brain_crop(p[0], patch_width / 2) for p in train_data] if options['crop'] else None
+            train_centers = get_center_index(train_data[:, 0], train_labels, balanced=balanced, crops=crops)
+            train_samples = count_centers(train_centers) / dfactor
             print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Loading data ' +
-                  c['b'] + '(%d centers)' % (len(train_centers) / dfactor) + c['nc'])
-            x, y = load_patches_train(
-                image_names=train_data,
-                label_names=train_labels,
-                centers=train_centers,
-                size=patch_size,
-                fc_shape=fc_shape,
-                nlabels=2,
-                dfactor=dfactor,
-                preload=preload,
-                split=True,
-                iseg=False,
-                experimental=1,
-                datatype=np.float32
-            )
+                  c['b'] + '(%d centers)' % train_samples + c['nc'])
+            data_parameters = {
+                'image_names': train_data,
+                'label_names': train_labels,
+                'centers': train_centers,
+                'size': patch_size,
+                'fc_shape': fc_shape,
+                'nlabels': 2,
+                'dfactor': dfactor,
+                'preload': preload,
+                'split': True,
+                'iseg': False,
+                'experimental': 1,
+                'datatype': np.float32,
+                'crops': crops
+            }
+            # With a disk dataset, the patches are written to disk once and then streamed while training. That
+            # way, the number of samples (and the patch size) is not limited by the memory.
+            if options['disk_dataset']:
+                dataset_name = net_name + ('e%d.' % i) + 'patches.h5'
+                n_train, n_val = write_patch_dataset(
+                    dataset_name, val_rate=val_rate, batch_size=batch_size, **data_parameters
+                )
+            else:
+                x, y = load_patches_train(**data_parameters)
 
             print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Training the model for ' +
                   c['b'] + '(%d parameters)' % net.count_params() + c['nc'])
             print(net.summary())
 
-            net.fit(x, y, batch_size=batch_size, validation_split=val_rate, epochs=epochs, callbacks=callbacks)
+            with stage('fit', repetition=i):
+                if options['disk_dataset']:
+                    net.fit_generator(
+                        generator=load_patch_dataset_generator(dataset_name, batch_size),
+                        steps_per_epoch=-(-n_train / batch_size),
+                        validation_data=load_patch_dataset_generator(dataset_name, batch_size, validation=True),
+                        validation_steps=-(-n_val / batch_size),
+                        max_q_size=queue,
+                        epochs=epochs,
+                        callbacks=callbacks
+                    )
+                elif options['workers'] > 1:
+                    # Data-parallel training works on the patches in memory (and without the callbacks of fit).
+                    (x, y), validation_data = split_validation(x, y, val_rate)
+                    sample_func, batch_func = get_array_batch_functions(x, y)
+                    fit_data_parallel(
+                        net,
+                        sample_func,
+                        batch_func,
+                        batch_size,
+                        epochs,
+                        options['workers'],
+                        sync_steps=options['sync_steps'],
+                        validation_data=validation_data,
+                        queue=queue
+                    )
+                else:
+                    net.fit(x, y, batch_size=batch_size, validation_split=val_rate, epochs=epochs, callbacks=callbacks)
+            if options['patch_cache'] > 0:
+                cache_stats = patch_cache_stats()
+                print(c['g'] + '    Patch cache: %d hits, %d misses (' % (cache_stats['hits'], cache_stats['misses']) +
+                      c['b'] + '%.1f%%' % (100 * cache_stats['hit_rate']) + c['nc'] + c['g'] + ' hit rate)' + c['nc'])
             net.save(net_name + ('e%d.' % i) + 'mdl')
 
 
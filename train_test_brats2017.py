@@ -1,19 +1,25 @@
 from __future__ import print_function
 import argparse
 import os
+import pickle
 from time import strftime
 import numpy as np
 import keras
-from keras.models import Sequential, Model
-from keras.layers import Dense, Conv3D, Dropout, Flatten, Input, concatenate, Reshape, Lambda, Permute
-from keras.layers.recurrent import LSTM
 from nibabel import load as load_nii
 from utils import color_codes, nfold_cross_validation, get_biggest_region
+from catalog import load_catalog, get_names
 from itertools import izip
-from data_creation import load_patch_batch_train, get_cnn_centers
-from data_creation import load_patch_batch_generator_test
+from data_creation import load_patch_batch_train, get_center_index, count_centers, get_brain_crop, load_image
+from data_creation import open_store, load_validation_set, enable_patch_cache, patch_cache_stats
+from data_creation import create_hard_sampler, load_hard_patch_batch_train, set_hard_sampler_train_function
+from data_creation import get_patch_batch_functions
+from data_parallel import fit_data_parallel
+from checkpoints import new_stream, load_checkpoint, restore_checkpoint, get_checkpoint_callback, fit_resumable
+from inference import predict_to_volume
 from data_manipulation.generate_features import get_mask_voxels
 from data_manipulation.metrics import dsc_seg
+from nets import get_brats_sequential, get_brats_multioutput
+from instrumentation import stage, enable_trace
 
 
 def parse_inputs():
@@ -34,6 +40,22 @@ def parse_inputs():
     parser.add_argument('-s', '--sequential', action='store_true', dest='sequential', default=False)
     parser.add_argument('-r', '--recurrent', action='store_true', dest='recurrent', default=False)
     parser.add_argument('--preload', action='store_true', dest='preload', default=False)
+    parser.add_argument('--morton', action='store_true', dest='morton', default=False)
+    parser.add_argument('--crop', action='store_true', dest='crop', default=False)
+    parser.add_argument('--store', action='store', dest='store', default=None)
+    parser.add_argument('--patch-cache', action='store', dest='patch_cache', type=int, default=0)
+    parser.add_argument('--fixed-validation', action='store_true', dest='fixed_validation', default=False)
+    parser.add_argument('--validation-cache', action='store_true', dest='validation_cache', default=False)
+    parser.add_argument('--hard-sampling', action='store_true', dest='hard_sampling', default=False)
+    parser.add_argument('--hard-floor', action='store', dest='hard_floor', type=float, default=0.1)
+    parser.add_argument('--checkpoint-steps', action='store', dest='checkpoint_steps', type=int, default=None)
+    parser.add_argument('--checkpoint-minutes', action='store', dest='checkpoint_minutes', type=float, default=None)
+    parser.add_argument('--resume', action='store_true', dest='resume', default=False)
+    parser.add_argument('--fold', action='store', dest='fold', nargs='+', type=int, default=None)
+    parser.add_argument('--dsc-output', action='store', dest='dsc_output', default=None)
+    parser.add_argument('--center-cache', action='store_true', dest='center_cache', default=False)
+    parser.add_argument('--workers', action='store', dest='workers', type=int, default=1)
+    parser.add_argument('--sync-steps', action='store', dest='sync_steps', type=int, default=1)
     parser.add_argument('--padding', action='store', dest='padding', default='valid')
     parser.add_argument('--no-flair', action='store_false', dest='use_flair', default=True)
     parser.add_argument('--no-t1', action='store_false', dest='use_t1', default=True)
@@ -46,36 +68,38 @@ def parse_inputs():
     parser.add_argument('--t2', action='store', dest='t2', default='_t2.nii.gz')
     parser.add_argument('--labels', action='store', dest='labels', default='_seg.nii.gz')
     parser.add_argument('-m', '--multi-channel', action='store_true', dest='multi', default=False)
-    return vars(parser.parse_args())
-
-
-def list_directories(path):
-    return filter(os.path.isdir, [os.path.join(path, f) for f in os.listdir(path)])
+    parser.add_argument('--trace', action='store', dest='trace', default=None)
+    parser.add_argument('--trace-rss', action='store', dest='trace_rss', type=float, default=None)
+    options = vars(parser.parse_args())
+    # Training checkpoints (and resuming from them) only work with the default sampler. The hard example sampler
+    # depends on the losses of every center, which are not checkpointed.
+    checkpoints = options['resume'] or options['checkpoint_steps'] is not None or\
+        options['checkpoint_minutes'] is not None
+    if options['hard_sampling'] and checkpoints:
+        parser.error('--hard-sampling can not be used with --resume, --checkpoint-steps or --checkpoint-minutes')
+    # Data-parallel training has its own training loop, so it does not support hard sampling or checkpoints.
+    if options['workers'] > 1 and (options['hard_sampling'] or checkpoints):
+        parser.error('--workers can not be used with --hard-sampling, --resume, --checkpoint-steps or '
+                     '--checkpoint-minutes')
+    return options
 
 
 def get_names_from_path(options):
-    path = options['dir_name']
-
-    patients = sorted(list_directories(path))
-
-    # Prepare the names
-    flair_names = [os.path.join(path, p, p.split('/')[-1] + options['flair'])
-                   for p in patients] if options['use_flair'] else None
-    t2_names = [os.path.join(path, p, p.split('/')[-1] + options['t2'])
-                for p in patients] if options['use_t2'] else None
-    t1_names = [os.path.join(path, p, p.split('/')[-1] + options['t1'])
-                for p in patients] if options['use_t1'] else None
-    t1ce_names = [os.path.join(path, p, p.split('/')[-1] + options['t1ce'])
-                  for p in patients] if options['use_t1ce'] else None
-    label_names = np.array([os.path.join(path, p, p.split('/')[-1] + options['labels']) for p in patients])
-    image_names = np.stack(filter(None, [flair_names, t2_names, t1_names, t1ce_names]), axis=1)
-
-    return image_names, label_names
+    modalities = ['flair', 't2', 't1', 't1ce']
+    suffixes = [options[m] for m in modalities if options['use_' + m]]
+    catalog = load_catalog(options['dir_name'], suffixes, options['labels'])
+    return get_names(catalog)
 
 
 def main():
     options = parse_inputs()
     c = color_codes()
+    if options['trace'] is not None:
+        enable_trace(options['trace'], rss_interval=options['trace_rss'])
+    if options['store'] is not None:
+        open_store(options['store'])
+    if options['patch_cache'] > 0:
+        enable_patch_cache(options['patch_cache'])
 
     # Prepare the net architecture parameters
     sequential = options['sequential']
@@ -98,6 +122,16 @@ def main():
     # Data loading parameters
     preload = options['preload']
     queue = options['queue']
+    order = 'morton' if options['morton'] else 'raster'
+    crop = options['crop']
+    # With a fixed validation set, the validation patches are extracted once per fold (and kept on disk with the
+    # validation cache) instead of sampling and extracting new ones after every epoch.
+    fixed_validation = options['fixed_validation'] or options['validation_cache']
+    # Hard sampling and checkpoints are exclusive (see parse_inputs).
+    resumable = options['resume'] or options['checkpoint_steps'] is not None or\
+        options['checkpoint_minutes'] is not None
+    # Data-parallel training does not support hard sampling or checkpoints (see parse_inputs).
+    data_parallel = options['workers'] > 1
 
     # Prepare the sufix that will be added to the results for the net and images
     path = options['dir_name']
@@ -121,6 +155,9 @@ def main():
     fold_generator = izip(nfold_cross_validation(data_names, label_names, n=folds, val_data=0.25), xrange(folds))
     dsc_results = list()
     for (train_data, train_labels, val_data, val_labels, test_data, test_labels), i in fold_generator:
+        # Only some folds might be run (see fold_scheduler.py)
+        if options['fold'] is not None and i not in options['fold']:
+            continue
         print(c['c'] + '[' + strftime("%H:%M:%S") + ']  ' + c['nc'] + 'Fold %d/%d: ' % (i+1, folds) + c['g'] +
               'Number of training/validation/testing images (%d=%d/%d=%d/%d)'
               % (len(train_data), len(train_labels), len(val_data), len(val_labels), len(test_data)) + c['nc'])
@@ -133,162 +170,183 @@ def main():
             net = keras.models.load_model(net_name)
         except IOError:
             # NET definition using Keras
-            train_centers = get_cnn_centers(train_data[:, 0], train_labels, balanced=balanced)
-            val_centers = get_cnn_centers(val_data[:, 0], val_labels, balanced=balanced)
-            train_samples = len(train_centers)/dfactor
-            val_samples = len(val_centers) / dfactor
+            # The margin of the crop (half a patch) guarantees that the patches are the same ones we would get from
+            # the whole volume.
+            train_crops = [get_brain_crop(p[0], patch_width / 2) for p in train_data] if crop else None
+            val_crops = [get_brain_crop(p[0], patch_width / 2) for p in val_data] if crop else None
+            checkpoint_name = net_name[:-len('mdl')] + 'checkpoint.pkl'
+            checkpoint = load_checkpoint(checkpoint_name) if resumable and options['resume'] else None
+            if checkpoint is not None:
+                train_centers, val_centers = checkpoint['data']
+            else:
+                train_centers = get_center_index(
+                    train_data[:, 0], train_labels, balanced=balanced, crops=train_crops, cache=options['center_cache']
+                )
+                val_centers = get_center_index(
+                    val_data[:, 0], val_labels, balanced=balanced, crops=val_crops, cache=options['center_cache']
+                )
+            train_samples = count_centers(train_centers)/dfactor
+            val_samples = count_centers(val_centers) / dfactor
             print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Creating and compiling the model ' +
                   c['b'] + '(%d samples)' % train_samples + c['nc'])
             train_steps_per_epoch = -(-train_samples/batch_size)
             val_steps_per_epoch = -(-val_samples / batch_size)
             input_shape = (n_channels,) + patch_size
             if sequential:
-                # Sequential model that merges all 4 images. This architecture is just a set of convolutional blocks
-                # that end in a dense layer. This is supposed to be an original baseline.
-                net = Sequential()
-                net.add(Conv3D(
-                    filters_list[0],
-                    kernel_size=kernel_size_list[0],
-                    input_shape=input_shape,
-                    activation='relu',
-                    data_format='channels_first'
-                ))
-                for filters, kernel_size in zip(filters_list[1:], kernel_size_list[1:]):
-                    net.add(Dropout(0.5))
-                    net.add(Conv3D(filters, kernel_size=kernel_size, activation='relu', data_format='channels_first'))
-                net.add(Dropout(0.5))
-                net.add(Flatten())
-                net.add(Dense(dense_size, activation='relu'))
-                net.add(Dropout(0.5))
-                net.add(Dense(num_classes, activation='softmax'))
+                net = get_brats_sequential(input_shape, filters_list, kernel_size_list, dense_size, num_classes)
             else:
-                # This architecture is based on the functional Keras API to introduce 3 output paths:
-                # - Whole tumor segmentation
-                # - Core segmentation (including whole tumor)
-                # - Whole segmentation (tumor, core and enhancing parts)
-                # The idea is to let the network work on the three parts to improve the multiclass segmentation.
-                merged_inputs = Input(shape=(4,) + patch_size, name='merged_inputs')
-                flair = Reshape((1,) + patch_size)(
-                    Lambda(
-                        lambda l: l[:, 0, :, :, :],
-                        output_shape=(1,) + patch_size)(merged_inputs),
-                )
-                t2 = Reshape((1,) + patch_size)(
-                    Lambda(lambda l: l[:, 1, :, :, :], output_shape=(1,) + patch_size)(merged_inputs)
+                net = get_brats_multioutput(
+                    input_shape,
+                    filters_list,
+                    kernel_size_list,
+                    dense_size,
+                    num_classes,
+                    recurrent
                 )
-                t1 = Lambda(lambda l: l[:, 2:, :, :, :], output_shape=(2,) + patch_size)(merged_inputs)
-                for filters, kernel_size in zip(filters_list, kernel_size_list):
-                    flair = Conv3D(filters,
-                                   kernel_size=kernel_size,
-                                   activation='relu',
-                                   data_format='channels_first'
-                                   )(flair)
-                    t2 = Conv3D(filters,
-                                kernel_size=kernel_size,
-                                activation='relu',
-                                data_format='channels_first'
-                                )(t2)
-                    t1 = Conv3D(filters,
-                                kernel_size=kernel_size,
-                                activation='relu',
-                                data_format='channels_first'
-                                )(t1)
-                    flair = Dropout(0.5)(flair)
-                    t2 = Dropout(0.5)(t2)
-                    t1 = Dropout(0.5)(t1)
-
-                # We only apply the RCNN to the multioutput approach (we keep the simple one, simple)
-                if recurrent:
-                    flair = Conv3D(
-                        dense_size,
-                        kernel_size=(1, 1, 1),
-                        activation='relu',
-                        data_format='channels_first',
-                        name='fcn_flair'
-                    )(flair)
-                    flair = Dropout(0.5)(flair)
-                    t2 = concatenate([flair, t2], axis=1)
-                    t2 = Conv3D(
-                        dense_size,
-                        kernel_size=(1, 1, 1),
-                        activation='relu',
-                        data_format='channels_first',
-                        name='fcn_t2'
-                    )(t2)
-                    t2 = Dropout(0.5)(t2)
-                    t1 = concatenate([t2, t1], axis=1)
-                    t1 = Conv3D(
-                        dense_size,
-                        kernel_size=(1, 1, 1),
-                        activation='relu',
-                        data_format='channels_first',
-                        name='fcn_t1'
-                    )(t1)
-                    t1 = Dropout(0.5)(t1)
-                    flair = Dropout(0.5)(flair)
-                    t2 = Dropout(0.5)(t2)
-                    t1 = Dropout(0.5)(t1)
-                    lstm_instance = LSTM(dense_size, implementation=1, name='rf_layer')
-                    flair = lstm_instance(Permute((2, 1))(Reshape((dense_size, -1))(flair)))
-                    t2 = lstm_instance(Permute((2, 1))(Reshape((dense_size, -1))(t2)))
-                    t1 = lstm_instance(Permute((2, 1))(Reshape((dense_size, -1))(t1)))
-
-                else:
-                    flair = Flatten()(flair)
-                    t2 = Flatten()(t2)
-                    t1 = Flatten()(t1)
-                    flair = Dense(dense_size, activation='relu')(flair)
-                    flair = Dropout(0.5)(flair)
-                    t2 = concatenate([flair, t2])
-                    t2 = Dense(dense_size, activation='relu')(t2)
-                    t2 = Dropout(0.5)(t2)
-                    t1 = concatenate([t2, t1])
-                    t1 = Dense(dense_size, activation='relu')(t1)
-                    t1 = Dropout(0.5)(t1)
 
-                tumor = Dense(2, activation='softmax', name='tumor')(flair)
-                core = Dense(3, activation='softmax', name='core')(t2)
-                enhancing = Dense(num_classes, activation='softmax', name='enhancing')(t1)
-
-                net = Model(inputs=merged_inputs, outputs=[tumor, core, enhancing])
-
-            net.compile(optimizer='adadelta', loss='categorical_crossentropy', metrics=['accuracy'])
+            if checkpoint is not None:
+                restore_checkpoint(net, checkpoint)
+                print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Resuming from ' + c['b'] +
+                      'epoch %d, batch %d' % (checkpoint['epoch'] + 1, checkpoint['batch']) + c['nc'])
 
             print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' +
                   c['g'] + 'Training the model with a generator for ' +
                   c['b'] + '(%d parameters)' % net.count_params() + c['nc'])
             print(net.summary())
-            net.fit_generator(
-                generator=load_patch_batch_train(
-                    image_names=train_data,
-                    label_names=train_labels,
-                    centers=train_centers,
-                    batch_size=batch_size,
+            if fixed_validation:
+                val_cache = net_name[:-len('mdl')] + 'validation' if options['validation_cache'] else None
+                validation_data = load_validation_set(
+                    image_names=val_data,
+                    label_names=val_labels,
+                    centers=val_centers,
                     size=patch_size,
+                    fc_shape=None,
                     nlabels=num_classes,
                     dfactor=dfactor,
                     preload=preload,
                     split=not sequential,
-                    datatype=np.float32
-                ),
-                validation_data=load_patch_batch_train(
+                    datatype=np.float32,
+                    crops=val_crops,
+                    cache=val_cache
+                )
+            else:
+                validation_data = load_patch_batch_train(
                     image_names=val_data,
                     label_names=val_labels,
                     centers=val_centers,
                     batch_size=batch_size,
                     size=patch_size,
+                    fc_shape=None,
+                    nlabels=num_classes,
+                    dfactor=dfactor,
+                    preload=preload,
+                    split=not sequential,
+                    datatype=np.float32,
+                    order=order,
+                    subvolume=options['morton'],
+                    crops=val_crops
+                )
+            # With hard sampling, the centers of each epoch are sampled according to the loss they had the last
+            # time they were used (the training function keeps track of those losses).
+            if options['hard_sampling']:
+                sampler = create_hard_sampler(train_centers, options['hard_floor'])
+                stream = None
+                train_generator = lambda: load_hard_patch_batch_train(
+                    sampler=sampler,
+                    image_names=train_data,
+                    label_names=train_labels,
+                    batch_size=batch_size,
+                    size=patch_size,
+                    fc_shape=None,
+                    nlabels=num_classes,
+                    dfactor=dfactor,
+                    preload=preload,
+                    split=not sequential,
+                    datatype=np.float32,
+                    crops=train_crops
+                )
+                set_hard_sampler_train_function(net, sampler)
+                callbacks = []
+            else:
+                # With checkpoints, the training generator keeps track of its position (stream) so that we can
+                # resume from the last checkpointed batch.
+                stream = new_stream(checkpoint) if resumable else None
+                train_generator = lambda: load_patch_batch_train(
+                    image_names=train_data,
+                    label_names=train_labels,
+                    centers=train_centers,
+                    batch_size=batch_size,
+                    size=patch_size,
+                    fc_shape=None,
                     nlabels=num_classes,
                     dfactor=dfactor,
                     preload=preload,
                     split=not sequential,
-                    datatype=np.float32
-                ),
-                steps_per_epoch=train_steps_per_epoch,
-                validation_steps=val_steps_per_epoch,
-                max_q_size=queue,
-                epochs=epochs
-            )
+                    datatype=np.float32,
+                    order=order,
+                    subvolume=options['morton'],
+                    crops=train_crops,
+                    stream=stream
+                )
+                callbacks = [get_checkpoint_callback(
+                    checkpoint_name,
+                    net,
+                    stream,
+                    data=(train_centers, val_centers),
+                    steps=options['checkpoint_steps'],
+                    minutes=options['checkpoint_minutes'],
+                    initial_batch=checkpoint['batch'] % train_steps_per_epoch if checkpoint is not None else 0
+                )] if resumable else []
+            with stage('fit', fold=i):
+                if data_parallel:
+                    sample_func, batch_func = get_patch_batch_functions(
+                        image_names=train_data,
+                        label_names=train_labels,
+                        centers=train_centers,
+                        size=patch_size,
+                        fc_shape=None,
+                        nlabels=num_classes,
+                        dfactor=dfactor,
+                        preload=preload,
+                        split=not sequential,
+                        datatype=np.float32,
+                        order=order,
+                        subvolume=options['morton'],
+                        crops=train_crops
+                    )
+                    fit_data_parallel(
+                        net,
+                        sample_func,
+                        batch_func,
+                        batch_size,
+                        epochs,
+                        options['workers'],
+                        sync_steps=options['sync_steps'],
+                        validation_data=validation_data,
+                        validation_steps=val_steps_per_epoch,
+                        queue=queue
+                    )
+                else:
+                    fit_resumable(
+                        net,
+                        train_generator,
+                        stream,
+                        train_steps_per_epoch,
+                        epochs,
+                        checkpoint=checkpoint,
+                        callbacks=callbacks,
+                        validation_data=validation_data,
+                        validation_steps=val_steps_per_epoch,
+                        max_q_size=queue
+                    )
+            if options['patch_cache'] > 0:
+                cache_stats = patch_cache_stats()
+                print(c['g'] + '    Patch cache: %d hits, %d misses (' % (cache_stats['hits'], cache_stats['misses']) +
+                      c['b'] + '%.1f%%' % (100 * cache_stats['hit_rate']) + c['nc'] + c['g'] + ' hit rate)' + c['nc'])
             net.save(net_name)
+            # Once the net is saved, its checkpoint is no longer needed.
+            if os.path.isfile(checkpoint_name):
+                os.remove(checkpoint_name)
 
         # Then we test the net.
         use_gt = options['use_gt']
@@ -299,44 +357,41 @@ def main():
             try:
                 load_nii(outputname)
             except IOError:
-                roi_nii = load_nii(p[0])
+                roi_nii = load_image(p[0])
                 roi = roi_nii.get_data().astype(dtype=np.bool)
                 centers = get_mask_voxels(roi)
                 test_samples = np.count_nonzero(roi)
-                image = np.zeros_like(roi).astype(dtype=np.uint8)
                 print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] +
                       '<Creating the probability map ' + c['b'] + p_name + c['nc'] + c['g'] +
                       ' (%d samples)>' % test_samples + c['nc'])
-                test_steps_per_epoch = -(-test_samples / batch_size)
-                y_pr_pred = net.predict_generator(
-                    generator=load_patch_batch_generator_test(
+                with stage('predict', patient=p_name):
+                    tumor, image = predict_to_volume(
+                        net,
                         image_names=p,
                         centers=centers,
                         batch_size=batch_size,
-                        size=patch_size,
+                        patch_size=patch_size,
+                        shape=roi.shape,
+                        heads=[0, -1],
                         preload=preload,
-                    ),
-                    steps=test_steps_per_epoch,
-                    max_q_size=queue
-                )
-                [x, y, z] = np.stack(centers, axis=1)
+                        queue=queue,
+                        order=order,
+                        subvolume=options['morton'],
+                        # Same margin as the training crops (half a patch).
+                        crop=get_brain_crop(p[0], patch_width / 2) if crop else None
+                    )
 
                 if not sequential:
-                    tumor = np.argmax(y_pr_pred[0], axis=1)
-                    y_pr_pred = y_pr_pred[-1]
-                    roi = np.zeros_like(roi).astype(dtype=np.uint8)
-                    roi[x, y, z] = tumor
-                    roi_nii.get_data()[:] = roi
+                    roi_nii.get_data()[:] = tumor
                     roiname = os.path.join(patient_path, 'deep-brats17' + sufix + 'test.roi.nii.gz')
-                    roi_nii.to_filename(roiname)
-
-                y_pred = np.argmax(y_pr_pred, axis=1)
+                    with stage('nifti_save', image=roiname):
+                        roi_nii.to_filename(roiname)
 
-                image[x, y, z] = y_pred
                 # Post-processing (Basically keep the biggest connected region)
-                image = get_biggest_region(image)
+                with stage('post_processing', patient=p_name):
+                    image = get_biggest_region(image)
                 if use_gt:
-                    gt_nii = load_nii(gt_name)
+                    gt_nii = load_image(gt_name)
                     gt = np.copy(gt_nii.get_data()).astype(dtype=np.uint8)
                     labels = np.unique(gt.flatten())
                     results = (p_name,) + tuple([dsc_seg(gt == l, image == l) for l in labels[1:]])
@@ -346,7 +401,11 @@ def main():
 
                 print(c['g'] + '                   -- Saving image ' + c['b'] + outputname + c['nc'])
                 roi_nii.get_data()[:] = image
-                roi_nii.to_filename(outputname)
+                with stage('nifti_save', image=outputname):
+                    roi_nii.to_filename(outputname)
+
+    if options['dsc_output'] is not None:
+        pickle.dump(dsc_results, open(options['dsc_output'], 'wb'))
 
 
 if __name__ == '__main__':
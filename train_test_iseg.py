@@ -1,6 +1,7 @@
 from __future__ import print_function
 import argparse
 import os
+import pickle
 from time import strftime
 import numpy as np
 from keras.models import load_model
@@ -8,13 +9,19 @@ from keras.callbacks import EarlyStopping, ModelCheckpoint
 from nibabel import load as load_nii
 from nibabel import save as save_nii
 from utils import color_codes, nfold_cross_validation, get_patient_info
+from catalog import load_catalog, get_names, get_labeled_patients
 from itertools import izip
-from data_creation import load_patches_train, get_cnn_centers
-from data_creation import load_patch_batch_generator_test
+from data_creation import load_patches_train, get_center_index, count_centers, get_brain_crop, load_image
+from data_creation import open_store, write_patch_dataset, load_patch_dataset_generator
+from data_creation import enable_patch_cache, patch_cache_stats
+from data_parallel import fit_data_parallel, get_array_batch_functions, split_validation
+from checkpoints import new_stream, load_checkpoint, restore_checkpoint, get_checkpoint_callback, fit_resumable
+from inference import predict_to_volume
 from data_manipulation.generate_features import get_mask_voxels
 from data_manipulation.metrics import dsc_seg
 from nets import get_iseg_baseline, get_iseg_experimental1, get_iseg_experimental2, get_iseg_experimental3
 from nets import get_iseg_experimental4
+from instrumentation import stage, enable_trace
 
 
 def parse_inputs():
@@ -34,14 +41,32 @@ def parse_inputs():
     parser.add_argument('-q', '--queue', action='store', dest='queue', type=int, default=100)
     parser.add_argument('-s', '--sequential', action='store_true', dest='sequential', default=False)
     parser.add_argument('--preload', action='store_true', dest='preload', default=False)
+    parser.add_argument('--morton', action='store_true', dest='morton', default=False)
+    parser.add_argument('--crop', action='store_true', dest='crop', default=False)
+    parser.add_argument('--store', action='store', dest='store', default=None)
+    parser.add_argument('--patch-cache', action='store', dest='patch_cache', type=int, default=0)
+    parser.add_argument('--disk-dataset', action='store_true', dest='disk_dataset', default=False)
+    parser.add_argument('--checkpoint-steps', action='store', dest='checkpoint_steps', type=int, default=None)
+    parser.add_argument('--checkpoint-minutes', action='store', dest='checkpoint_minutes', type=float, default=None)
+    parser.add_argument('--resume', action='store_true', dest='resume', default=False)
+    parser.add_argument('--fold', action='store', dest='fold', nargs='+', type=int, default=None)
+    parser.add_argument('--dsc-output', action='store', dest='dsc_output', default=None)
+    parser.add_argument('--center-cache', action='store_true', dest='center_cache', default=False)
+    parser.add_argument('--workers', action='store', dest='workers', type=int, default=1)
+    parser.add_argument('--sync-steps', action='store', dest='sync_steps', type=int, default=1)
     parser.add_argument('--t1', action='store', dest='t1', default='-T1.hdr')
     parser.add_argument('--t2', action='store', dest='t2', default='-T2.hdr')
     parser.add_argument('--labels', action='store', dest='labels', default='-label.hdr')
-    return vars(parser.parse_args())
-
-
-def list_directories(path):
-    return filter(os.path.isdir, [os.path.join(path, f) for f in os.listdir(path)])
+    parser.add_argument('--trace', action='store', dest='trace', default=None)
+    parser.add_argument('--trace-rss', action='store', dest='trace_rss', type=float, default=None)
+    options = vars(parser.parse_args())
+    # Data-parallel training works on the patches in memory, while checkpoints need a disk dataset.
+    checkpoints = options['resume'] or options['checkpoint_steps'] is not None or\
+        options['checkpoint_minutes'] is not None
+    if options['workers'] > 1 and (options['disk_dataset'] or checkpoints):
+        parser.error('--workers can not be used with --disk-dataset, --resume, --checkpoint-steps or '
+                     '--checkpoint-minutes')
+    return options
 
 
 def get_sufix(options):
@@ -68,17 +93,9 @@ def get_sufix(options):
 
 
 def get_names_from_path(options):
-    path = options['dir_name']
-
-    patients = range(10)
-
-    # Prepare the names
-    t1_names = [os.path.join(path, 'subject-%d' % (p+1) + options['t1']) for p in patients]
-    t2_names = [os.path.join(path, 'subject-%d' % (p+1) + options['t2']) for p in patients]
-    label_names = np.array([os.path.join(path, 'subject-%d' % (p+1) + options['labels']) for p in patients])
-    image_names = np.stack([t1_names, t2_names], axis=1)
-
-    return image_names, label_names
+    # The test subjects (without labels) can be on the same folder, but cross-validation only uses the labeled ones.
+    catalog = load_catalog(options['dir_name'], [options['t1'], options['t2']], options['labels'], layout='iseg')
+    return get_names(catalog, get_labeled_patients(catalog))
 
 
 def train_net(fold_n, train_data, train_labels, options):
@@ -101,6 +118,14 @@ def train_net(fold_n, train_data, train_labels, options):
     fc_shape = (fc_width,) * 3
     # Data loading parameters
     preload = options['preload']
+    # Training checkpoints need the position of the generator inside the training set, so the training set is
+    # always a disk dataset when we use them.
+    resumable = options['resume'] or options['checkpoint_steps'] is not None or\
+        options['checkpoint_minutes'] is not None
+    disk_dataset = options['disk_dataset'] or resumable
+    # Data-parallel training works on the patches in memory (and without the callbacks of fit). It can not be used
+    # with a disk dataset (see parse_inputs).
+    data_parallel = options['workers'] > 1
 
     # Prepare the sufix that will be added to the results for the net and images
     path = options['dir_name']
@@ -115,24 +140,38 @@ def train_net(fold_n, train_data, train_labels, options):
         net.load_weights(os.path.join(path, checkpoint))
     except IOError:
         # Data loading
-        train_centers = get_cnn_centers(train_data[:, 0], train_labels)
-        train_samples = len(train_centers) / dfactor
+        crops = [get_brain_crop(p[0], patch_width / 2) for p in train_data] if options['crop'] else None
+        training_checkpoint = net_name[:-len('mdl')] + 'checkpoint.pkl'
+        resume_checkpoint = load_checkpoint(training_checkpoint) if options['resume'] else None
+        if resume_checkpoint is not None:
+            train_centers = resume_checkpoint['data']
+        else:
+            train_centers = get_center_index(train_data[:, 0], train_labels, crops=crops, cache=options['center_cache'])
+        train_samples = count_centers(train_centers) / dfactor
         print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Loading data ' +
-              c['b'] + '(%d centers)' % len(train_centers) + c['nc'])
-        x, y = load_patches_train(
-            image_names=train_data,
-            label_names=train_labels,
-            centers=train_centers,
-            size=patch_size,
-            fc_shape=fc_shape,
-            nlabels=4,
-            dfactor=dfactor,
-            preload=preload,
-            split=True,
-            iseg=True,
-            experimental=experimental,
-            datatype=np.float32
-        )
+              c['b'] + '(%d centers)' % count_centers(train_centers) + c['nc'])
+        data_parameters = {
+            'image_names': train_data,
+            'label_names': train_labels,
+            'centers': train_centers,
+            'size': patch_size,
+            'fc_shape': fc_shape,
+            'nlabels': 4,
+            'dfactor': dfactor,
+            'preload': preload,
+            'split': True,
+            'iseg': True,
+            'experimental': experimental,
+            'datatype': np.float32,
+            'crops': crops
+        }
+        # With a disk dataset, the patches are written to disk once and then streamed while training. That way,
+        # the number of samples (and the patch size) is not limited by the memory.
+        if disk_dataset:
+            dataset_name = net_name[:-len('mdl')] + 'patches.h5'
+            n_train, n_val = write_patch_dataset(dataset_name, val_rate=0.25, batch_size=batch_size, **data_parameters)
+        else:
+            x, y = load_patches_train(**data_parameters)
         # NET definition using Keras
         print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Creating and compiling the model ' +
               c['b'] + '(%d samples)' % train_samples + c['nc'])
@@ -156,6 +195,11 @@ def train_net(fold_n, train_data, train_labels, options):
             dense_size
         )
 
+        if resume_checkpoint is not None:
+            restore_checkpoint(net, resume_checkpoint)
+            print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Resuming from ' + c['b'] +
+                  'epoch %d, batch %d' % (resume_checkpoint['epoch'] + 1, resume_checkpoint['batch']) + c['nc'])
+
         print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' +
               c['g'] + 'Training the model ' + c['b'] + '(%d parameters)' % net.count_params() + c['nc'])
         print(net.summary())
@@ -164,7 +208,62 @@ def train_net(fold_n, train_data, train_labels, options):
             ModelCheckpoint(os.path.join(path, checkpoint), monitor='val_brain_loss', save_best_only=True)
         ]
         net.save(net_name)
-        net.fit(x, y, batch_size=batch_size, validation_split=0.25, epochs=epochs, callbacks=callbacks)
+        with stage('fit', fold=fold_n):
+            if resumable:
+                stream = new_stream(resume_checkpoint)
+                train_steps = -(-n_train / batch_size)
+                fit_resumable(
+                    net,
+                    lambda: load_patch_dataset_generator(dataset_name, batch_size, stream=stream),
+                    stream,
+                    train_steps,
+                    epochs,
+                    checkpoint=resume_checkpoint,
+                    callbacks=callbacks + [get_checkpoint_callback(
+                        training_checkpoint,
+                        net,
+                        stream,
+                        data=train_centers,
+                        steps=options['checkpoint_steps'],
+                        minutes=options['checkpoint_minutes'],
+                        initial_batch=resume_checkpoint['batch'] % train_steps if resume_checkpoint is not None else 0
+                    )],
+                    validation_data=load_patch_dataset_generator(dataset_name, batch_size, validation=True),
+                    validation_steps=-(-n_val / batch_size),
+                    max_q_size=options['queue']
+                )
+                if os.path.isfile(training_checkpoint):
+                    os.remove(training_checkpoint)
+            elif disk_dataset:
+                net.fit_generator(
+                    generator=load_patch_dataset_generator(dataset_name, batch_size),
+                    steps_per_epoch=-(-n_train / batch_size),
+                    validation_data=load_patch_dataset_generator(dataset_name, batch_size, validation=True),
+                    validation_steps=-(-n_val / batch_size),
+                    max_q_size=options['queue'],
+                    epochs=epochs,
+                    callbacks=callbacks
+                )
+            elif data_parallel:
+                (x, y), validation_data = split_validation(x, y, 0.25)
+                sample_func, batch_func = get_array_batch_functions(x, y)
+                fit_data_parallel(
+                    net,
+                    sample_func,
+                    batch_func,
+                    batch_size,
+                    epochs,
+                    options['workers'],
+                    sync_steps=options['sync_steps'],
+                    validation_data=validation_data,
+                    queue=options['queue']
+                )
+            else:
+                net.fit(x, y, batch_size=batch_size, validation_split=0.25, epochs=epochs, callbacks=callbacks)
+        if options['patch_cache'] > 0:
+            cache_stats = patch_cache_stats()
+            print(c['g'] + '    Patch cache: %d hits, %d misses (' % (cache_stats['hits'], cache_stats['misses']) +
+                  c['b'] + '%.1f%%' % (100 * cache_stats['hit_rate']) + c['nc'] + c['g'] + ' hit rate)' + c['nc'])
         net.load_weights(os.path.join(path, checkpoint))
     return net
 
@@ -196,39 +295,37 @@ def test_net(net, p, gt_name, options):
     p_name = '-'.join(p[0].rsplit('/')[-1].rsplit('.')[0].rsplit('-')[:-1])
     patient_path = '/'.join(p[0].rsplit('/')[:-1])
     outputname = os.path.join(patient_path, 'deep-' + p_name + sufix + 'brain.hdr')
-    gt_nii = load_nii(gt_name)
+    gt_nii = load_image(gt_name)
     gt = np.copy(np.squeeze(gt_nii.get_data()))
     vals = np.unique(gt.flatten())
     try:
         image = np.squeeze(load_nii(outputname).get_data())
     except IOError:
-        roi = np.squeeze(load_nii(p[0]).get_data())
+        roi = np.squeeze(load_image(p[0]).get_data())
         centers = get_mask_voxels(roi.astype(dtype=np.bool))
         test_samples = np.count_nonzero(roi)
-        image = np.zeros_like(roi).astype(dtype=np.uint8)
         print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] +
               '<Creating the probability map ' + c['b'] + p_name + c['nc'] + c['g'] +
               ' (%d samples)>' % test_samples + c['nc'])
-        test_steps_per_epoch = -(-test_samples / batch_size)
-        y_pr_pred = net.predict_generator(
-            generator=load_patch_batch_generator_test(
+        # The fully convolutional output (experimental >= 3) is not a voxel-wise output.
+        heads = range(len(net.outputs) - 1) if options['experimental'] >= 3 else None
+        with stage('predict', patient=p_name):
+            y_pr_pred = predict_to_volume(
+                net,
                 image_names=p,
                 centers=centers,
                 batch_size=batch_size,
-                size=patch_size,
+                patch_size=patch_size,
+                shape=roi.shape,
+                heads=heads,
                 preload=preload,
-            ),
-            steps=test_steps_per_epoch,
-            max_q_size=queue
-        )
-        [x, y, z] = np.stack(centers, axis=1)
-
-        if options['experimental'] >= 3:
-            y_pr_pred = y_pr_pred[:-1]
+                queue=queue,
+                order='morton' if options['morton'] else 'raster',
+                subvolume=options['morton'],
+                crop=get_brain_crop(p[0], patch_width / 2) if options['crop'] else None
+            )
 
-        for num, results in enumerate(y_pr_pred):
-            brain = np.argmax(results, axis=1)
-            image[x, y, z] = brain
+        for num, image in enumerate(y_pr_pred):
             if num is 0:
                 im = sufix + 'csf.'
                 gt_nii.get_data()[:] = np.expand_dims(image, axis=3)
@@ -249,13 +346,13 @@ def test_net(net, p, gt_name, options):
                 gt_nii.get_data()[:] = np.expand_dims(vals[image], axis=3)
             roiname = os.path.join(patient_path, 'deep-' + p_name + im + 'roi.hdr')
             print(c['g'] + '                   -- Saving image ' + c['b'] + roiname + c['nc'])
-            save_nii(gt_nii, roiname)
-
-        y_pred = np.argmax(y_pr_pred[-1], axis=1)
+            with stage('nifti_save', image=roiname):
+                save_nii(gt_nii, roiname)
 
-        image[x, y, z] = y_pred
+        image = y_pr_pred[-1]
         gt_nii.get_data()[:] = np.expand_dims(image, axis=3)
-        save_nii(gt_nii, outputname)
+        with stage('nifti_save', image=outputname):
+            save_nii(gt_nii, outputname)
 
     return image, gt
 
@@ -263,6 +360,12 @@ def test_net(net, p, gt_name, options):
 def main():
     options = parse_inputs()
     c = color_codes()
+    if options['trace'] is not None:
+        enable_trace(options['trace'], rss_interval=options['trace_rss'])
+    if options['store'] is not None:
+        open_store(options['store'])
+    if options['patch_cache'] > 0:
+        enable_patch_cache(options['patch_cache'])
 
     experimental = options['experimental']
 
@@ -274,6 +377,9 @@ def main():
     fold_generator = izip(nfold_cross_validation(data_names, label_names, n=folds), xrange(folds))
     dsc_results = list()
     for (train_data, train_labels, test_data, test_labels), i in fold_generator:
+        # Only some folds might be run (see fold_scheduler.py)
+        if options['fold'] is not None and i not in options['fold']:
+            continue
         print(c['c'] + '[' + strftime("%H:%M:%S") + ']  ' + c['nc'] + 'Fold %d/%d: ' % (i+1, folds) + c['g'] +
               'Number of training/testing images (%d=%d/%d)'
               % (len(train_data), len(train_labels), len(test_data)) + c['nc'])
@@ -304,6 +410,8 @@ def main():
             dsc_results.append(results)
             print('%s DSC: %f/%f/%f' % results)
 
+    if options['dsc_output'] is not None:
+        pickle.dump(dsc_results, open(options['dsc_output'], 'wb'))
     dsc_results = sorted(dsc_results, cmp=lambda x, y: int(x[0][8:]) - int(y[0][8:]))
     for results in dsc_results:
         print(c['c'] + '%s DSC: \033[32;1m%f/%f/%f' % results + c['nc'])